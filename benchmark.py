@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from datetime import date
+
+from config import START_ID, END_ID, CATEGORIES, START_DATE, END_DATE, FETCHING_BATCH_SIZE, NUM_FETCHING_THREADS
+from utils import get_id_from_arxiv_link
+
+
+def is_in_id_range(paper_id:str, start_id:str, end_id:str) -> bool:
+    '''
+    Check whether a new-style ID (format: 'xxxx.xxxxx') lies within start_id and end_id
+    '''
+    return '/' not in paper_id and start_id <= paper_id <= end_id
+
+
+def run_discovery(name:str, crawl_latest) -> dict:
+    '''
+    A function to measure one discovery function (latest versions only)
+
+    Return
+    ------
+    dict
+        {'papers': list of arxiv.Result, 'requests': int, 'seconds': float}
+    '''
+    import scraper
+
+    scraper.REQUEST_COUNTS.clear()
+    start_time = time.time()
+    paper_list, _ = crawl_latest()
+    seconds = time.time() - start_time
+
+    sys.stdout.write('\n')
+    return {'name': name, 'papers': paper_list, 'requests': sum(scraper.REQUEST_COUNTS.values()), 'seconds': seconds}
+
+
+def compare_discovery(start_id:str, end_id:str, categories:list[str], start_date:date, end_date:date, num_threads:int=NUM_FETCHING_THREADS) -> list[dict]:
+    '''
+    A function to compare ID enumeration, category/date queries and OAI-PMH harvesting on the same target set
+
+    The target set is the papers of `categories` whose ID lies within start_id and end_id; the date window should
+    cover the submission dates of that ID range. Papers found outside the target set are wasted discovery traffic
+    (and would be wasted downloads).
+
+    Return
+    ------
+    list of dict
+        one summary per discovery mode
+    '''
+    from scraper import crawl_lastest_papers_multithread, crawl_latest_papers_by_query
+    from oai_harvest import harvest_records, records_to_results
+
+    def crawl_oai():
+        # every version is returned, the latest one of each paper comes last
+        paper_list = records_to_results(harvest_records(start_date.isoformat(), end_date.isoformat()), categories)
+        return paper_list, []
+
+    runs = [
+        run_discovery('id', lambda: crawl_lastest_papers_multithread(start_id, end_id, FETCHING_BATCH_SIZE, num_threads)),
+        run_discovery('query', lambda: crawl_latest_papers_by_query(categories, start_date, end_date)),
+        run_discovery('oai', crawl_oai),
+    ]
+
+    summaries = []
+    for run in runs:
+        found_ids = {get_id_from_arxiv_link(paper.entry_id, with_version=False): paper for paper in run['papers']}
+        target_ids = {
+            paper_id for paper_id, paper in found_ids.items()
+            if is_in_id_range(paper_id, start_id, end_id) and set(paper.categories) & set(categories)
+        }
+        summaries.append({
+            'name': run['name'],
+            'requests': run['requests'],
+            'seconds': run['seconds'],
+            'found': len(found_ids),
+            'target': target_ids,
+        })
+
+    all_target_ids = set().union(*(summary['target'] for summary in summaries))
+    for summary in summaries:
+        summary['recall'] = len(summary['target']) / len(all_target_ids) if all_target_ids else 0
+        summary['papers_per_second'] = len(summary['target']) / summary['seconds'] if summary['seconds'] else 0
+
+    return summaries
+
+
+# Commands that must start quickly (no arxiv/requests/numpy import), timed by `python benchmark.py startup`
+STARTUP_COMMANDS = (['--help'], ['status'], ['check', '2306.14505', '--offline'], ['run', '--help'])
+STARTUP_TARGET_MS = 100
+
+
+def measure_startup(command:list[str], runs:int) -> float:
+    '''
+    Median wall time (ms) of `python cli.py <command>` over several runs
+    '''
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, cli_path, *command], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings)
+
+
+def slowest_imports(command:list[str], top:int) -> list[tuple[int, str]]:
+    '''
+    The modules with the largest cumulative import time (us) of `python -X importtime cli.py <command>`
+    '''
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    result = subprocess.run([sys.executable, '-X', 'importtime', cli_path, *command],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].strip()))
+
+    return sorted(imports, reverse=True)[:top]
+
+
+def startup(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the startup time of the cli.py commands')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=0, help='also list the N slowest imports of every command')
+    args = parser.parse_args(argv)
+
+    print('=' * 50)
+    print(f'STARTUP (median of {args.runs} runs, target {STARTUP_TARGET_MS} ms):')
+    for command in STARTUP_COMMANDS:
+        median = measure_startup(command, args.runs)
+        verdict = 'ok' if median <= STARTUP_TARGET_MS else 'SLOW'
+        print(f"- cli.py {' '.join(command)}: {median:.0f} ms ({verdict})")
+
+        if args.imports:
+            for cumulative, module in slowest_imports(command, args.imports):
+                print(f'    {cumulative / 1000:7.1f} ms  {module}')
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ['startup']:
+        return startup(argv[1:])
+
+    parser = argparse.ArgumentParser(description='Benchmark the discovery modes on the same target set '
+                                                 '(`benchmark.py startup` times the cli.py commands instead)')
+    parser.add_argument('--start-id', default=START_ID)
+    parser.add_argument('--end-id', default=END_ID)
+    parser.add_argument('--categories', default=','.join(CATEGORIES))
+    parser.add_argument('--start-date', default=START_DATE)
+    parser.add_argument('--end-date', default=END_DATE)
+    args = parser.parse_args(argv)
+
+    summaries = compare_discovery(
+        args.start_id, args.end_id, args.categories.split(','),
+        date.fromisoformat(args.start_date), date.fromisoformat(args.end_date)
+    )
+
+    print('=' * 50)
+    print('DISCOVERY:')
+    for summary in summaries:
+        print(f"- {summary['name']}: {summary['requests']} requests, {summary['seconds']:.1f}s, "
+              f"{summary['found']} papers found, {len(summary['target'])} in target set "
+              f"(recall {summary['recall'] * 100:.1f}%, {summary['papers_per_second']:.2f} target papers/s)")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import zipfile
+import tempfile
+import argparse
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from config import CASSETTE_PATH, CASSETTE_TIMING
+
+# A cassette is one zip archive:
+#   index.json         {request key: [exchange number, ...]} in recording order, plus a summary
+#   <n>.json           method, URL, status, reason, headers and timings of exchange n
+#   <n>.body           body bytes as the caller read them (stored as is when already gzip/PDF, deflated otherwise)
+INDEX_FILE = 'index.json'
+STORED_MAGICS = (b'\x1f\x8b', b'%P', b'PK')
+BODY_MEMORY_SIZE = 1 << 20      # larger bodies are spooled to a temp file while they are recorded
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def request_key(method: str, url: str) -> str:
+    '''
+    Key of a request in the cassette: method and URL with sorted query parameters
+    '''
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f'{method.upper()} {urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))}'
+
+
+class Cassette:
+    '''
+    Compressed, indexed archive of upstream HTTP exchanges (arXiv API, e-prints, Semantic Scholar, OAI-PMH)
+
+    'record' writes every exchange of the shared session, 'replay' serves them back: with the original
+    latency and transfer rate (timing='original') or as fast as they are read (timing='none').
+    Requests of one key are answered in recording order, the last answer is repeated once they run out.
+
+    Usage
+    -----
+    cassette = Cassette('run.cassette', mode='record')
+    network.use_cassette(cassette)
+    ...
+    cassette.close()
+    '''
+    def __init__(self, path: str = CASSETTE_PATH, mode: str = 'replay', timing: str = CASSETTE_TIMING):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"unknown cassette mode '{mode}', choose among record, replay")
+        if timing not in ('original', 'none'):
+            raise ValueError(f"unknown cassette timing '{timing}', choose among original, none")
+
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.lock = threading.Lock()
+        self.closed = False
+
+        if mode == 'record':
+            # Written to a temp file: a cassette is only readable once its index is written by close()
+            self.archive = zipfile.ZipFile(f'{path}.tmp', 'w', compression=zipfile.ZIP_DEFLATED)
+            self.index = {}
+            self.count = 0
+            self.started = time.time()
+            self.pending = set()
+            atexit.register(self.close)
+        else:
+            self.archive = zipfile.ZipFile(path, 'r')
+            self.index = json.loads(self.archive.read(INDEX_FILE))['exchanges']
+            self.positions = {}
+            self.misses = 0
+
+    def add(self, key: str, meta: dict, body):
+        '''
+        Add an exchange, its body being a file object positioned at its start (copied in chunks)
+        '''
+        compress_type = zipfile.ZIP_STORED if body.read(2) in STORED_MAGICS else zipfile.ZIP_DEFLATED
+        body.seek(0)
+
+        with self.lock:
+            if self.closed:
+                return
+
+            number = self.count
+            self.count += 1
+            self.archive.writestr(f'{number}.json', json.dumps(meta, ensure_ascii=False))
+
+            info = zipfile.ZipInfo(f'{number}.body', date_time=time.localtime()[:6])
+            info.compress_type = compress_type
+            with self.archive.open(info, 'w', force_zip64=True) as f:
+                shutil.copyfileobj(body, f, COPY_CHUNK_SIZE)
+            self.index.setdefault(key, []).append(number)
+
+    def next_exchange(self, key: str) -> tuple[dict, object, int] | None:
+        '''
+        Next recorded answer of a key: (meta, body file object, body size), None when the key was never recorded
+        '''
+        with self.lock:
+            numbers = self.index.get(key)
+            if not numbers:
+                self.misses += 1
+                return None
+
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            number = numbers[min(position, len(numbers) - 1)]
+
+            # The body is read from the archive as the caller reads it, never loaded whole
+            return (json.loads(self.archive.read(f'{number}.json')), self.archive.open(f'{number}.body'),
+                    self.archive.getinfo(f'{number}.body').file_size)
+
+    def close(self):
+        '''
+        Finish the exchanges still being read, write the index (record) and close the archive
+        '''
+        if self.mode == 'record':
+            for stream in list(self.pending):
+                stream.finish()
+
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+
+            if self.mode == 'record':
+                summary = {'exchanges': self.count, 'seconds': time.time() - self.started}
+                self.archive.writestr(INDEX_FILE, json.dumps({'summary': summary, 'exchanges': self.index}))
+                self.archive.close()
+                os.replace(f'{self.path}.tmp', self.path)
+            else:
+                self.archive.close()
+
+        if self.mode == 'replay' and self.misses:
+            sys.stdout.write('\n')
+            print(f'[CASSETTE]: {self.misses} request(s) were not in {self.path}')
+
+
+class RecordingStream:
+    '''
+    Body of a live response that keeps a copy of every byte the caller reads, added to the cassette at the end
+    of the body or when the response is closed (a caller may stop reading early, e.g. at MAX_SOURCE_SIZE)
+
+    The copy is spooled to a temp file past BODY_MEMORY_SIZE, so a large e-print is never held in memory
+    '''
+    def __init__(self, raw, cassette: Cassette, key: str, meta: dict):
+        self.raw = raw
+        self.cassette = cassette
+        self.key = key
+        self.meta = meta
+        self.copy = tempfile.SpooledTemporaryFile(max_size=BODY_MEMORY_SIZE)
+        self.first_read = None
+        self.finished = False
+        cassette.pending.add(self)
+
+    def _keep(self, data: bytes) -> bytes:
+        if self.first_read is None:
+            self.first_read = time.time()
+        self.copy.write(data)
+        return data
+
+    def read(self, amt=None, decode_content=None, **kwargs):
+        data = self._keep(self.raw.read(amt, decode_content=decode_content, **kwargs))
+        if not data or amt is None:
+            self.finish(complete=True)
+        return data
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        for data in self.raw.stream(amt, decode_content=decode_content):
+            yield self._keep(data)
+        self.finish(complete=True)
+
+    def finish(self, complete: bool = False):
+        if self.finished:
+            return
+        self.finished = True
+        self.cassette.pending.discard(self)
+
+        self.meta['complete'] = complete
+        self.meta['duration'] = time.time() - self.first_read if self.first_read is not None else 0.0
+        with self.copy:
+            self.copy.seek(0)
+            self.cassette.add(self.key, self.meta, self.copy)
+
+    def close(self):
+        self.finish()
+        self.raw.close()
+
+    def release_conn(self):
+        self.raw.release_conn()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class ReplayStream:
+    '''
+    Body of a replayed response, read from the cassette as the caller reads it and paced to its recorded
+    transfer time when the timings are kept
+    '''
+    def __init__(self, body, size: int, duration: float):
+        self.body = body
+        self.size = size
+        self.duration = duration
+        self.position = 0
+        self.started = None
+        self.closed = False
+
+    def read(self, amt=None, decode_content=None, **kwargs) -> bytes:
+        if self.closed:
+            return b''
+        if self.started is None:
+            self.started = time.time()
+
+        data = self.body.read(-1 if amt is None else amt)
+        self.position += len(data)
+        if len(data) == 0 or self.position >= self.size:
+            self.close()
+
+        if self.duration and self.size:
+            delay = self.started + self.duration * self.position / self.size - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        while data := self.read(amt):
+            yield data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.body.close()
+
+    def release_conn(self):
+        pass
+
+
+class CassetteAdapter(HTTPAdapter):
+    '''
+    Transport of the shared session (network.get_session) that records exchanges into, or serves them from, a cassette
+    '''
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url)
+        if self.cassette.mode == 'replay':
+            return self.replay(request, key)
+
+        start = time.time()
+        response = super().send(request, **kwargs)
+        meta = {
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+            'started': start - self.cassette.started,
+            'latency': time.time() - start,
+        }
+        response.raw = RecordingStream(response.raw, self.cassette, key, meta)
+        return response
+
+    def replay(self, request, key: str) -> Response:
+        exchange = self.cassette.next_exchange(key)
+        if exchange is None:
+            raise ConnectionError(f'{key} is not in the cassette {self.cassette.path}', request=request)
+
+        meta, body, size = exchange
+        keep_timing = self.cassette.timing == 'original'
+        if keep_timing:
+            time.sleep(meta['latency'])
+
+        response = Response()
+        response.status_code = meta['status']
+        response.reason = meta['reason']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = ReplayStream(body, size, meta['duration'] if keep_timing else 0.0)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+def describe(path: str) -> dict:
+    '''
+    Summary of a cassette: exchanges, body bytes and recorded seconds per host
+    '''
+    hosts = {}
+    with zipfile.ZipFile(path) as archive:
+        index = json.loads(archive.read(INDEX_FILE))
+
+        for key, numbers in index['exchanges'].items():
+            host = urlsplit(key.split(' ', 1)[1]).netloc
+            summary = hosts.setdefault(host, {'exchanges': 0, 'bytes': 0, 'seconds': 0.0, 'statuses': {}})
+
+            for number in numbers:
+                meta = json.loads(archive.read(f'{number}.json'))
+                summary['exchanges'] += 1
+                summary['bytes'] += archive.getinfo(f'{number}.body').file_size
+                summary['seconds'] += meta['latency'] + meta['duration']
+                summary['statuses'][meta['status']] = summary['statuses'].get(meta['status'], 0) + 1
+
+    return {'summary': index['summary'], 'hosts': hosts}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect a cassette of recorded upstream traffic '
+                                                 '(record with `cli.py run --record PATH`, replay with `--replay PATH`)')
+    parser.add_argument('path', nargs='?', default=CASSETTE_PATH)
+    args = parser.parse_args(argv)
+
+    info = describe(args.path)
+    print(f"{info['summary']['exchanges']} exchanges recorded over {info['summary']['seconds']:.1f}s")
+    for host, summary in sorted(info['hosts'].items()):
+        statuses = ', '.join(f'{status}: {count}' for status, count in sorted(summary['statuses'].items()))
+        print(f"- {host}: {summary['exchanges']} exchanges, {summary['bytes'] / (1024 * 1024):.1f} MB, "
+              f"{summary['seconds']:.1f}s upstream ({statuses})")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import re
+import sys
+import time
+import threading
+
+from task_watchdog import heartbeat
+from config import CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN, CIRCUIT_BREAKER_MAX_COOLDOWN
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class ThrottledError(Exception):
+    '''
+    Raised when an upstream host answers 429 (Too Many Requests) or 503 (Service Unavailable)
+    '''
+
+
+THROTTLE_STATUSES = (429, 503)
+
+
+def is_throttle_error(e: Exception) -> bool:
+    '''
+    Check whether an exception comes from a throttled answer (arxiv.HTTPError carries the status code)
+    '''
+    if isinstance(e, ThrottledError) or getattr(e, 'status', None) in THROTTLE_STATUSES:
+        return True
+    # Do not match the bare code: the request URL in the message contains paper IDs such as 2306.14290
+    return re.search(r'HTTP (429|503)\b', str(e)) is not None
+
+
+class CircuitBreaker:
+    '''
+    A circuit breaker shared by every worker calling one upstream host
+
+    closed: requests go through; CIRCUIT_BREAKER_THRESHOLD consecutive throttled answers open the circuit
+    open: every worker is parked in before_request() until the cooldown has elapsed
+    half-open: a single worker sends a probe request; success closes the circuit and releases everyone,
+               another throttled answer re-opens it with a doubled cooldown
+
+    Usage
+    -----
+    breaker.before_request()
+    try:
+        response = ...
+    except Exception as e:
+        breaker.record_error(e)   # throttled: retry without spending the retry budget
+        raise
+    breaker.record_success()
+    '''
+    def __init__(self, name: str, threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+                 cooldown: float = CIRCUIT_BREAKER_COOLDOWN, max_cooldown: float = CIRCUIT_BREAKER_MAX_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self.condition = threading.Condition()
+        self.state = CLOSED
+        self.consecutive_throttles = 0
+        self.cooldown = cooldown
+        self.opened_until = 0.0
+        self.probing = False
+        self.times_opened = 0
+
+    def before_request(self):
+        '''
+        Block while the circuit is open; in half-open state only one caller (the probe) goes through
+        Every request starts here, so this is also where the task of the caller reports progress to the watchdog
+        '''
+        heartbeat()
+        try:
+            self._wait_for_circuit()
+        finally:
+            heartbeat()
+
+    def _wait_for_circuit(self):
+        with self.condition:
+            while True:
+                if self.state == CLOSED:
+                    return
+
+                if self.state == OPEN:
+                    remaining = self.opened_until - time.time()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                        continue
+
+                    self.state = HALF_OPEN
+                    self.probing = False
+
+                if not self.probing:
+                    self.probing = True
+                    return
+
+                self.condition.wait()
+
+    def record_success(self):
+        with self.condition:
+            if self.state != CLOSED:
+                sys.stdout.write('\n')
+                print(f'[CIRCUIT][{self.name}]: closed, resuming requests')
+
+            self.state = CLOSED
+            self.consecutive_throttles = 0
+            self.cooldown = self.base_cooldown
+            self.probing = False
+            self.condition.notify_all()
+
+    def record_throttle(self):
+        with self.condition:
+            if self.state == HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open()
+            elif self.state == CLOSED:
+                self.consecutive_throttles += 1
+                if self.consecutive_throttles >= self.threshold:
+                    self._open()
+
+    def record_error(self, e: Exception) -> bool:
+        '''
+        Record a failed request
+
+        Return
+        ------
+        bool
+            True when the error is a throttled answer (the request should be retried once the circuit allows it)
+        '''
+        if is_throttle_error(e):
+            self.record_throttle()
+            return True
+
+        with self.condition:
+            # A probe that failed for another reason tells nothing about the throttling: let another worker probe
+            if self.state == HALF_OPEN and self.probing:
+                self.probing = False
+                self.condition.notify_all()
+        return False
+
+    def _open(self):
+        self.state = OPEN
+        self.probing = False
+        self.consecutive_throttles = 0
+        self.opened_until = time.time() + self.cooldown
+        self.times_opened += 1
+        self.condition.notify_all()
+
+        sys.stdout.write('\n')
+        print(f'[CIRCUIT][{self.name}]: open, pausing all requests for {self.cooldown:.1f}s')
+
+    def status(self) -> dict:
+        with self.condition:
+            return {
+                'state': self.state,
+                'cooldown': self.cooldown,
+                'times_opened': self.times_opened,
+                'reopens_in': max(0.0, self.opened_until - time.time()) if self.state == OPEN else 0.0
+            }
+
+
+BREAKERS = {
+    'arxiv_api': CircuitBreaker('arxiv_api'),
+    'eprint': CircuitBreaker('eprint'),
+    'semantic': CircuitBreaker('semantic'),
+}
@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import threading
+import numpy as np
+
+from config import CITATION_GRAPH_DIR
+from layout import get_paper_folder_name, iter_paper_dirs
+
+NODES_FILE = 'nodes.txt'
+ARRAY_FILES = ('forward_indptr', 'forward_indices', 'backward_indptr', 'backward_indices')
+
+
+def build_csr(rows: np.ndarray, columns: np.ndarray, num_nodes: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    A function to build CSR arrays from edges already sorted by row
+
+    Return
+    ------
+    tuple of np.ndarray
+        (indptr of length num_nodes + 1 (int64), indices (int32))
+    '''
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    return indptr, columns.astype(np.int32)
+
+
+def csr_edges(indptr: np.ndarray, indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    (rows, columns) of every edge of CSR arrays, in their stored order
+    '''
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    return rows, np.asarray(indices, dtype=np.int64)
+
+
+def merge_sorted(old_keys: np.ndarray, new_keys: np.ndarray) -> np.ndarray:
+    '''
+    Merge a few sorted new keys into the sorted keys of the graph (no sort over every edge)
+    '''
+    merged = np.empty(len(old_keys) + len(new_keys), dtype=np.int64)
+    new_positions = np.searchsorted(old_keys, new_keys) + np.arange(len(new_keys))
+    is_old = np.ones(len(merged), dtype=bool)
+    is_old[new_positions] = False
+
+    merged[new_positions] = new_keys
+    merged[is_old] = old_keys
+    return merged
+
+
+class CitationGraph:
+    '''
+    Citation graph of the corpus, built incrementally from the references saved by the pipeline
+
+    Papers are integer nodes (their IDs are kept once in nodes.txt), edges 'citing -> cited' are stored as CSR
+    arrays in both directions, so "what does X cite" and "who cites X" are two slices. New references are buffered
+    and merged into the sorted arrays by compact() (only the buffered rows are sorted); the arrays are saved as
+    .npy files, only when they changed, and memory-mapped on load.
+
+    Example
+    -------
+    graph = CitationGraph()
+    graph.add_references('2306.14505', {'2106-09685': {...}, '1706-03762': {...}})
+    graph.save()
+    graph.predecessors('1706-03762')  # papers citing 1706-03762
+    '''
+    def __init__(self, graph_dir: str = CITATION_GRAPH_DIR):
+        self.graph_dir = graph_dir
+        self.lock = threading.Lock()
+        self.nodes = []
+        self.node_index = {}
+        self.pending = {}
+        self.changed = False
+
+        empty_indptr, empty_indices = np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        self.forward_indptr, self.forward_indices = empty_indptr, empty_indices
+        self.backward_indptr, self.backward_indices = empty_indptr, empty_indices
+
+        if os.path.exists(os.path.join(graph_dir, NODES_FILE)):
+            self._load()
+
+    def _load(self):
+        with open(os.path.join(self.graph_dir, NODES_FILE), encoding='utf-8') as f:
+            self.nodes = f.read().split('\n')[:-1]
+        self.node_index = {node: index for index, node in enumerate(self.nodes)}
+
+        arrays = {name: np.load(os.path.join(self.graph_dir, f'{name}.npy'), mmap_mode='r') for name in ARRAY_FILES}
+        self.forward_indptr, self.forward_indices = arrays['forward_indptr'], arrays['forward_indices']
+        self.backward_indptr, self.backward_indices = arrays['backward_indptr'], arrays['backward_indices']
+
+    def _node(self, paper_id: str) -> int:
+        index = self.node_index.get(paper_id)
+
+        if index is None:
+            index = len(self.nodes)
+            self.nodes.append(paper_id)
+            self.node_index[paper_id] = index
+        return index
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def num_edges(self) -> int:
+        self.compact()
+        return len(self.forward_indices)
+
+    def add_references(self, paper_id: str, references: dict):
+        '''
+        Replace the outgoing edges of a paper with its saved references
+
+        Parameters
+        ----------
+        paper_id: str
+            citing paper's ID (format: 'xxxx.xxxxx' or 'xxxx-xxxxx')
+        references: dict
+            references.json content, keyed by cited paper ID (format: 'xxxx-xxxxx')
+        '''
+        with self.lock:
+            source = self._node(get_paper_folder_name(paper_id))
+            self.pending[source] = [self._node(cited_id) for cited_id in references]
+
+    def compact(self):
+        '''
+        Merge the buffered references into the CSR arrays
+        '''
+        with self.lock:
+            if not self.pending:
+                return
+
+            num_nodes = len(self.nodes)
+            is_pending = np.zeros(num_nodes, dtype=bool)
+            is_pending[np.fromiter(self.pending, dtype=np.int64, count=len(self.pending))] = True
+
+            new_sources = np.fromiter((source for source, targets in self.pending.items() for _ in targets), dtype=np.int64)
+            new_targets = np.fromiter((target for targets in self.pending.values() for target in targets), dtype=np.int64)
+
+            # One key per edge (row * num_nodes + column): unique() sorts and dedups the buffered edges only
+            new_keys = np.unique(new_sources * num_nodes + new_targets)
+            new_sources, new_targets = new_keys // num_nodes, new_keys % num_nodes
+
+            # Forward: the rows of the buffered papers are replaced, the other rows are kept as they are
+            sources, targets = csr_edges(self.forward_indptr, self.forward_indices)
+            keep = ~is_pending[sources]
+            keys = merge_sorted(sources[keep] * num_nodes + targets[keep], new_keys)
+            self.forward_indptr, self.forward_indices = build_csr(keys // num_nodes, keys % num_nodes, num_nodes)
+
+            # Backward: the edges coming from the buffered papers are replaced in every row they appear in
+            targets, sources = csr_edges(self.backward_indptr, self.backward_indices)
+            keep = ~is_pending[sources]
+            keys = merge_sorted(targets[keep] * num_nodes + sources[keep], np.sort(new_targets * num_nodes + new_sources))
+            self.backward_indptr, self.backward_indices = build_csr(keys // num_nodes, keys % num_nodes, num_nodes)
+
+            self.pending = {}
+            self.changed = True
+
+    def _neighbors(self, paper_id: str, direction: str) -> list[str]:
+        self.compact()
+        indptr, indices = getattr(self, f'{direction}_indptr'), getattr(self, f'{direction}_indices')
+        index = self.node_index.get(get_paper_folder_name(paper_id))
+
+        if index is None or index >= len(indptr) - 1:
+            return []
+        return [self.nodes[neighbor] for neighbor in indices[indptr[index]:indptr[index + 1]]]
+
+    def successors(self, paper_id: str) -> list[str]:
+        '''
+        Papers cited by paper_id
+        '''
+        return self._neighbors(paper_id, 'forward')
+
+    def predecessors(self, paper_id: str) -> list[str]:
+        '''
+        Papers citing paper_id
+        '''
+        return self._neighbors(paper_id, 'backward')
+
+    def out_degrees(self) -> np.ndarray:
+        self.compact()
+        return np.diff(self.forward_indptr)
+
+    def in_degrees(self) -> np.ndarray:
+        self.compact()
+        return np.diff(self.backward_indptr)
+
+    def degree_stats(self, top: int = 10) -> dict:
+        '''
+        A function to summarize the degrees of the graph
+
+        Return
+        ------
+        dict
+            number of nodes/edges, mean/max/percentiles of in- and out-degrees, and the most cited papers
+        '''
+        in_degrees, out_degrees = self.in_degrees(), self.out_degrees()
+        citing = out_degrees[out_degrees > 0]
+
+        stats = {'nodes': self.num_nodes, 'edges': int(len(self.forward_indices)), 'citing papers': int(len(citing))}
+
+        for name, degrees in (('in-degree', in_degrees), ('out-degree (citing papers)', citing)):
+            if len(degrees) == 0:
+                continue
+            p50, p90, p99 = np.percentile(degrees, [50, 90, 99])
+            stats[name] = {'mean': round(float(degrees.mean()), 3), 'max': int(degrees.max()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+
+        most_cited = np.argsort(in_degrees)[::-1][:top]
+        stats['most cited'] = [(self.nodes[index], int(in_degrees[index])) for index in most_cited if in_degrees[index] > 0]
+        return stats
+
+    def save(self):
+        '''
+        Persist the graph: files are written to a temporary folder which then replaces the current one
+        (nothing is written when no reference was merged since the last save)
+        '''
+        self.compact()
+
+        with self.lock:
+            if not self.changed and os.path.exists(self.graph_dir):
+                return
+
+            temp_dir = self.graph_dir.rstrip('/\\') + '.tmp'
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            os.makedirs(temp_dir)
+
+            with open(os.path.join(temp_dir, NODES_FILE), 'w', encoding='utf-8') as f:
+                f.writelines(node + '\n' for node in self.nodes)
+
+            arrays = (self.forward_indptr, self.forward_indices, self.backward_indptr, self.backward_indices)
+            for name, array in zip(ARRAY_FILES, arrays):
+                np.save(os.path.join(temp_dir, f'{name}.npy'), np.ascontiguousarray(array))
+
+            old_dir = self.graph_dir.rstrip('/\\') + '.old'
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if os.path.exists(self.graph_dir):
+                os.rename(self.graph_dir, old_dir)
+            os.rename(temp_dir, self.graph_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+            self.changed = False
+
+        self._load()
+
+
+def build_graph(save_root: str = './Save', graph_dir: str = CITATION_GRAPH_DIR) -> CitationGraph:
+    '''
+    A function to build the citation graph of an existing ./Save tree from scratch
+    '''
+    shutil.rmtree(graph_dir, ignore_errors=True)
+    graph = CitationGraph(graph_dir)
+
+    for name, path in iter_paper_dirs(save_root):
+        try:
+            with open(os.path.join(path, 'references.json'), encoding='utf-8') as f:
+                graph.add_references(name, json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    graph.save()
+    return graph
+
+
+CITATION_GRAPH = CitationGraph()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or query the citation graph of the corpus')
+    parser.add_argument('--graph-dir', default=CITATION_GRAPH_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='build the graph from every references.json of a ./Save tree')
+    build_parser.add_argument('--save-root', default='./Save')
+    subparsers.add_parser('stats', help='print degree statistics')
+    subparsers.add_parser('cites', help='papers cited by a paper').add_argument('paper_id')
+    subparsers.add_parser('cited-by', help='papers citing a paper').add_argument('paper_id')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        graph = build_graph(args.save_root, args.graph_dir)
+        print(f'Built a graph of {graph.num_nodes} papers and {graph.num_edges} citations')
+        return
+
+    graph = CitationGraph(args.graph_dir)
+
+    if args.command == 'stats':
+        for key, value in graph.degree_stats().items():
+            print(f'- {key}: {value}')
+    else:
+        neighbors = graph.successors(args.paper_id) if args.command == 'cites' else graph.predecessors(args.paper_id)
+        print('\n'.join(neighbors))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
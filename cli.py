@@ -0,0 +1,313 @@
+import os
+import sys
+import time
+import argparse
+
+import config
+
+# Tools with their own command line, run as `python cli.py <tool> ...` (their module is imported only then)
+TOOLS = {
+    'analyze': ('corpus_analysis', 'reference statistics and size metrics of a ./Save tree'),
+    'sizes': ('size_ledger', 'size statistics of the downloaded versions, per month or category'),
+    'negative-cache': ('negative_cache', 'report or purge the negative cache'),
+    'index': ('corpus_index', 'build or query the memory-mapped corpus index'),
+    'graph': ('citation_graph', 'build or query the citation graph'),
+    'storage': ('storage', 'train the zstd dictionary or export a plain copy of the corpus'),
+    'migrate': ('migrate_layout', 'move ./Save to another folder layout'),
+    'oai': ('oai_harvest', 'harvest OAI-PMH records or serve recorded pages'),
+    'broker': ('rate_broker', 'serve or show the rate broker shared by the scraper processes of this machine'),
+    'cassette': ('cassette', 'summarize a cassette of recorded upstream traffic'),
+    'benchmark': ('benchmark', 'compare discovery modes or measure the startup time of the commands'),
+}
+
+
+def apply_overrides(args):
+    '''
+    Write the options given on the command line into config before any pipeline module reads it
+    (modules copy config values with `from config import ...` when they are first imported)
+    '''
+    for option, name in (('storage_mode', 'STORAGE_MODE'), ('layout', 'SAVE_LAYOUT'), ('start_date', 'START_DATE'),
+                         ('end_date', 'END_DATE')):
+        value = getattr(args, option, None)
+        if value is not None:
+            setattr(config, name, value)
+
+    if getattr(args, 'categories', None):
+        config.CATEGORIES = tuple(category.strip() for category in args.categories.split(',') if category.strip())
+
+    if getattr(args, 'record', None) or getattr(args, 'replay', None):
+        config.CASSETTE_MODE = 'record' if args.record else 'replay'
+        config.CASSETTE_PATH = args.record or args.replay
+    if getattr(args, 'replay_timing', None):
+        config.CASSETTE_TIMING = args.replay_timing
+
+
+def enter_cassette_workdir(args, parser) -> str:
+    '''
+    Move a recording or replaying run into a scratch folder of its own
+
+    ./Save, the caches, the index and the size ledger are relative paths, so both runs start from the same empty
+    local state: nothing saved or negatively cached by an earlier run skips a request or changes its key, and a
+    replay sends exactly the requests that were recorded.
+
+    Return
+    ------
+    str
+        the folder the run works in
+    '''
+    import tempfile
+
+    config.CASSETTE_PATH = os.path.abspath(config.CASSETTE_PATH)
+
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+        if os.path.isdir(workdir) and os.listdir(workdir):
+            parser.error(f'--workdir {workdir} is not empty, a cassette run must start from an empty folder')
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix=f'{os.path.basename(config.CASSETTE_PATH)}.{config.CASSETTE_MODE}.',
+                                   dir=os.path.dirname(config.CASSETTE_PATH))
+
+    os.chdir(workdir)
+    print(f'[CASSETTE]: {config.CASSETTE_MODE} run working in {workdir}')
+    return workdir
+
+
+def print_metrics(metrics: dict):
+    print('=' * 50)
+
+    for analysis_field, sub_dict in metrics.items():
+        print(f'{analysis_field.upper()}:')
+        for key, value in sub_dict.items():
+            print(f'- {key}: {value}')
+
+
+def run_command(args, parser) -> int:
+    apply_overrides(args)
+
+    workdir = enter_cassette_workdir(args, parser) if config.CASSETTE_MODE is not None else None
+
+    # Heavy imports (arxiv, requests, psutil...) happen here, after the overrides
+    import main
+    from thread_process import PAPER_STAGES
+    from utils import convert_second_to_format
+    from profiling import MemoryProfiler, CpuProfiler
+    from network import close_cassette
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in PAPER_STAGES]
+    if unknown_stages or not stages:
+        parser.error(f"unknown stages {unknown_stages}, choose among {', '.join(PAPER_STAGES)}")
+
+    ranges = None
+    if args.ranges:
+        ranges = [tuple(part.strip() for part in item.split(':')) for item in args.ranges.split(',') if item.strip()]
+        if any(len(item) != 2 for item in ranges):
+            parser.error('--ranges expects START:END pairs separated by commas')
+
+    memory_profiler = MemoryProfiler() if args.profile_memory else None
+    cpu_profiler = CpuProfiler() if args.profile_cpu else None
+    for profiler in (memory_profiler, cpu_profiler):
+        if profiler is not None:
+            profiler.start()
+
+    start_time = time.time()
+
+    if ranges:
+        paper_size = main.run_ranges(ranges, max_workers=args.workers, stages=stages, discovery_mode=args.discovery,
+                                     refresh=args.refresh)
+        if 'sources' in stages:
+            paper_size.save(config.SIZE_LEDGER_PATH)
+        metrics = {}
+    else:
+        metrics = main.main(start_id=args.start_id, end_id=args.end_id, max_workers=args.workers,
+                            withAnalysis=args.analysis, stages=stages, discovery_mode=args.discovery, refresh=args.refresh)
+
+    for profiler in (memory_profiler, cpu_profiler):
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_report()
+
+    close_cassette()
+
+    if metrics != {}:
+        print_metrics(metrics)
+    else:
+        print('=' * 50)
+
+    print("Overall Time: ", convert_second_to_format(time.time() - start_time))
+    if workdir is not None:
+        print(f'Outputs: {workdir}')
+    return 0
+
+
+def status_command(args) -> int:
+    '''
+    Summarize what is on disk: saved papers, caches, interrupted harvest, index (reads files only, no network)
+    '''
+    import json
+    from layout import iter_paper_dirs
+
+    print('SAVE:')
+    if os.path.isdir(args.save_root):
+        papers = sum(1 for _ in iter_paper_dirs(args.save_root))
+        print(f'- {args.save_root}: {papers} papers (layout for new papers: {config.SAVE_LAYOUT}, storage: {config.STORAGE_MODE})')
+    else:
+        print(f'- {args.save_root}: missing')
+
+    print('CACHES:')
+    if os.path.exists(config.VALIDATOR_STORE_PATH):
+        from validator_store import VALIDATOR_STORE
+        print(f'- validators: {len(VALIDATOR_STORE.records)} versions')
+    else:
+        print('- validators: none')
+
+    from negative_cache import NEGATIVE_CACHE
+    summary = NEGATIVE_CACHE.report()
+    summary.pop('hits')
+    for endpoint, reasons in sorted(summary.items()):
+        counts = ', '.join(f"{reason} {count['active']}" for reason, count in sorted(reasons.items()))
+        print(f'- negative cache ({endpoint}): {counts}')
+
+    print('OAI-PMH:')
+    if os.path.exists(config.OAI_STATE_PATH):
+        with open(config.OAI_STATE_PATH, encoding='utf-8') as f:
+            state = json.load(f)
+        print(f"- interrupted harvest, resumable ({', '.join(f'{key}={value}' for key, value in state.items() if key != 'resumption_token')})")
+    else:
+        print('- no interrupted harvest')
+
+    print('RATE LIMITS:')
+    from rate_broker import read_status, print_status
+    print_status(read_status())
+
+    print('INDEX:')
+    try:
+        from corpus_index import CorpusIndex
+        with CorpusIndex(config.CORPUS_INDEX_DIR) as index:
+            print(f'- corpus index: {len(index)} papers')
+    except (OSError, ValueError):
+        print('- corpus index: none')
+
+    if os.path.isdir(config.CITATION_GRAPH_DIR):
+        size = sum(entry.stat().st_size for entry in os.scandir(config.CITATION_GRAPH_DIR) if entry.is_file())
+        print(f'- citation graph: {size / (1024 * 1024):.1f} MB')
+    else:
+        print('- citation graph: none')
+
+    return 0
+
+
+def check_command(args) -> int:
+    '''
+    Look one ID up: on disk, in the negative cache, and on arXiv
+    '''
+    from layout import get_paper_dir
+    from negative_cache import NEGATIVE_CACHE
+
+    paper_id = args.paper_id.replace('-', '.')
+    paper_dir = get_paper_dir(paper_id, args.save_root)
+
+    print(f'{paper_id}:')
+    print(f"- on disk: {paper_dir if os.path.isdir(paper_dir) else 'no'}")
+    for endpoint in ('arxiv', 'semantic'):
+        reason = NEGATIVE_CACHE.get(endpoint, paper_id)
+        if reason is not None:
+            print(f'- negative cache ({endpoint}): {reason}')
+
+    if args.offline:
+        return 0
+
+    from extract_data import get_paper_from_id
+
+    papers = get_paper_from_id([paper_id])
+    if not papers:
+        print('- arXiv: not found')
+        return 1
+
+    paper = papers[0]
+    print(f'- arXiv: {paper.title}')
+    print(f"- latest version: {paper.entry_id.rsplit('/', 1)[-1]}, updated {paper.updated.date()}")
+    print(f"- categories: {', '.join(paper.categories)}")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='arXiv paper scraper', prog='cli.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='discover papers and run the pipeline (options override config.py)')
+    run_parser.add_argument('--start-id', default=config.START_ID)
+    run_parser.add_argument('--end-id', default=config.END_ID)
+    run_parser.add_argument('--start-date', default=None, help=f'first date of --discovery query/oai (default: {config.START_DATE})')
+    run_parser.add_argument('--end-date', default=None, help=f'last date of --discovery query/oai (default: {config.END_DATE})')
+    run_parser.add_argument('--categories', default=None, help=f"comma-separated categories (default: {','.join(config.CATEGORIES)})")
+    run_parser.add_argument('--stages', default=','.join(config.RUN_STAGES),
+                            help='comma-separated stages to run among sources, metadata, references (default: %(default)s)')
+    run_parser.add_argument('--discovery', choices=['id', 'query', 'oai'], default=config.DISCOVERY_MODE,
+                            help='enumerate IDs within --start-id/--end-id, search the categories within the dates '
+                                 'or harvest them through OAI-PMH (default: %(default)s)')
+    run_parser.add_argument('--ranges', default=None,
+                            help="comma-separated START:END ranges processed side by side in one process, "
+                                 "IDs for --discovery id (2306.00001:2306.99999), dates otherwise (2023-06-01:2023-06-30)")
+    run_parser.add_argument('--refresh', action=argparse.BooleanOptionalAction, default=config.REFRESH_MODE,
+                            help='only fetch the versions newer than what ./Save holds, re-resolve the references of '
+                                 'revised papers and append their revised dates (default: %(default)s)')
+    run_parser.add_argument('--workers', type=int, default=config.NUM_FETCHING_THREADS, help='discovery threads (default: %(default)s)')
+    run_parser.add_argument('--analysis', action=argparse.BooleanOptionalAction, default=config.ANALYSIS_MODE,
+                            help='measure time, memory and disk usage (default: %(default)s)')
+    run_parser.add_argument('--storage-mode', choices=['extract', 'archive', 'zstd'], default=None,
+                            help=f'how sources are saved (default: {config.STORAGE_MODE})')
+    run_parser.add_argument('--layout', choices=['flat', 'hashed'], default=None, help=f'layout of ./Save (default: {config.SAVE_LAYOUT})')
+    run_parser.add_argument('--profile-memory', action='store_true', default=config.PROFILE_MEMORY,
+                            help='sample the RSS finely and report the top allocators of every stage (slower, see config.py)')
+    run_parser.add_argument('--profile-cpu', action='store_true', default=config.PROFILE_CPU,
+                            help='sample the stacks of every thread and write per-stage CPU tables and a flamegraph input')
+    cassette_group = run_parser.add_mutually_exclusive_group()
+    cassette_group.add_argument('--record', metavar='PATH', default=None,
+                                help='record every upstream exchange into a cassette (see cassette.py)')
+    cassette_group.add_argument('--replay', metavar='PATH', default=None,
+                                help='serve the upstream exchanges from a recorded cassette instead of the network')
+    run_parser.add_argument('--workdir', metavar='PATH', default=None,
+                            help='empty folder a --record/--replay run works in (./Save, caches, index), '
+                                 'default: a new folder next to the cassette')
+    run_parser.add_argument('--replay-timing', choices=['original', 'none'], default=None,
+                            help=f'keep the recorded latency and transfer rate, or none (no rate limits either) '
+                                 f'(default: {config.CASSETTE_TIMING})')
+
+    status_parser = subparsers.add_parser('status', help='summarize the saved corpus, the caches and the index')
+    status_parser.add_argument('--save-root', default='./Save')
+
+    check_parser = subparsers.add_parser('check', help='look one paper ID up on disk, in the caches and on arXiv')
+    check_parser.add_argument('paper_id')
+    check_parser.add_argument('--save-root', default='./Save')
+    check_parser.add_argument('--offline', action='store_true', help='do not query arXiv')
+
+    for name, (_, description) in TOOLS.items():
+        subparsers.add_parser(name, help=description, add_help=False)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # Tools parse their own arguments
+    if argv and argv[0] in TOOLS:
+        import importlib
+        module = importlib.import_module(TOOLS[argv[0]][0])
+        return module.main(argv[1:]) or 0
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        return run_command(args, parser)
+    elif args.command == 'status':
+        return status_command(args)
+    else:
+        return check_command(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,127 @@
-import threading
-import arxiv
+# Plain constants only: config is imported by every command, importing it must stay instant
+# (the arXiv client is created on first use by network.get_client)
 
 # ========== Rate limit ==========
 ARXIV_RATE_LIMIT = 3.4
 SEMANTIC_RATE_LIMIT = 1.3
-CLIENT = arxiv.Client(delay_seconds=0.2)
+ARXIV_CLIENT_DELAY = 0.2    # delay of arxiv.Client between the pages of one search
 
 
 # ========== Threading management ==========
-ARXIV_DELAY_LOCK = threading.Lock()
-arxiv_last_request_time = 0.0
-
-SEMANTIC_DELAY_LOCK = threading.Lock()
-semantic_last_request_time = 0.0
+# Rate limits and HTTP connections are shared by every pipeline of the process (see network.py)
+HTTP_POOL_SIZE = 32         # connections kept per host
 
 NUM_DOWNLOAD_THREADS = 5
-NUM_EXTRACT_THREADS = 3
-NUM_SAVE_THREADS = 4
+NUM_EXTRACT_THREADS = 1     # metadata extraction is local, one thread keeps up with the other stages
+NUM_REFERENCE_THREADS = 3   # reference resolution waits on Semantic Scholar and arXiv rate limits
 NUM_FETCHING_THREADS = 3
+# metadata.json / references.json are written by one writer thread per pipeline, in groups (see group_writer.py)
+WRITE_BATCH_SIZE = 64       # records committed together
+WRITE_BATCH_DELAY = 0.2     # seconds a group waits for more records after its first one
+WRITE_FSYNC = True          # sync each group before renaming it into place
 
 FETCHING_BATCH_SIZE = 200
 # ========== Paper management ==========
 START_ID = '2306.14505'
 END_ID = '2307.11656'
-ANALYSIS_MODE = True
\ No newline at end of file
+ANALYSIS_MODE = True
+
+# Discovery: 'id' enumerates every ID within START_ID and END_ID,
+# 'query' searches the papers of CATEGORIES first submitted within START_DATE and END_DATE,
+# 'oai' harvests the OAI-PMH records of CATEGORIES updated within START_DATE and END_DATE
+DISCOVERY_MODE = 'id'
+CATEGORIES = ('cs.CL', 'cs.LG')
+START_DATE = '2023-06-26'
+END_DATE = '2023-07-20'
+QUERY_PAGE_SIZE = 1000      # results per search request (arXiv allows up to 2000)
+QUERY_WINDOW_DAYS = 7       # one paged query per window of submission dates
+
+# Stages to run: 'sources' (tex files), 'metadata' (metadata.json), 'references' (references.json)
+RUN_STAGES = ('sources', 'metadata', 'references')
+SIZE_LEDGER_PATH = './paper_sizes.npz'   # sizes of every downloaded version (see size_ledger.py)
+REFRESH_MODE = False        # only fetch the versions newer than what ./Save holds (see refresh.py)
+
+# ========== Local caches ==========
+CACHE_DIR = './.cache'
+VALIDATOR_STORE_PATH = f'{CACHE_DIR}/validators.json'
+
+
+# Off by default: the caches, the citation graph and ./Save are shared files without cross-process locking,
+# so only enable it for processes that work on separate save roots and cache folders
+RATE_BROKER = False                                 # share the rate limits with the other scraper processes of this machine
+RATE_BROKER_SOCKET = '~/.cache/scrape-paper/rate_broker.sock'   # Unix socket of the broker, per user (see rate_broker.py)
+RATE_BROKER_TIMEOUT = 600                           # seconds a token request may wait before the process uses its own limits
+
+
+# ========== Storage ==========
+# 'extract': extract every version into Save/<id>/tex/<idvN>/
+# 'archive': keep one filtered zip archive per version with a member index (see storage.ArchiveReader)
+# 'zstd': keep the extracted tree, every file compressed with a shared dictionary (see storage.SourceReader)
+STORAGE_MODE = 'extract'
+ZSTD_LEVEL = 19
+ZSTD_DICT_SIZE = 112640       # bytes, trained with `python storage.py train-dict`
+ZSTD_DICT_SAMPLES = 5000      # files sampled to train the dictionary
+NEGATIVE_CACHE_PATH = f'{CACHE_DIR}/negative_cache.json'
+
+# Time to live (seconds) of a negative cache entry, per reason
+NEGATIVE_CACHE_TTL = {
+    'deleted': 30 * 24 * 3600,       # e-print answered 404
+    'pdf_only': 90 * 24 * 3600,      # e-print is a PDF, no LaTeX source
+    'withdrawn': 90 * 24 * 3600,     # version withdrawn by its authors
+    'not_found': 7 * 24 * 3600,      # not (yet) indexed by Semantic Scholar
+    'missing': 24 * 3600,            # ID not returned by the arXiv API (not assigned yet or removed)
+    'oversized': 90 * 24 * 3600,     # e-print past MAX_SOURCE_SIZE before any .tex/.bib member was read
+}
+
+
+# ========== Circuit breakers ==========
+CIRCUIT_BREAKER_THRESHOLD = 3       # consecutive 429/503 answers that open the circuit of a host
+CIRCUIT_BREAKER_COOLDOWN = 30.0     # seconds before the first probe request
+CIRCUIT_BREAKER_MAX_COOLDOWN = 600.0
+
+
+# ========== OAI-PMH discovery ==========
+OAI_BASE_URL = 'https://oaipmh.arxiv.org/oai'
+OAI_SET = 'cs'                                   # OAI set to harvest (None for every archive)
+OAI_STATE_PATH = f'{CACHE_DIR}/oai_state.json'   # resumption token of an interrupted harvest
+OAI_RECORDS_PATH = f'{CACHE_DIR}/oai_records.jsonl'
+# Layout of ./Save: 'flat' writes Save/<yymm-nnnnn>/, 'hashed' writes Save/<yymm>/<nn>/<yymm-nnnnn>/
+# (nn = last two digits of the ID). Move an existing tree with `python migrate_layout.py --to hashed`.
+SAVE_LAYOUT = 'flat'
+
+
+# ========== Corpus index ==========
+CORPUS_INDEX_DIR = './Index'   # built with `python corpus_index.py build`, updated after every pipeline run
+CORPUS_INDEX_COMPACT_RATIO = 2.0   # compact the blob once it holds this many times the size of its live records
+CITATION_GRAPH_DIR = f'{CORPUS_INDEX_DIR}/citations'
+
+
+# ========== Timeouts ==========
+REQUEST_TIMEOUT = (10, 60)   # (connect, read) seconds of every HTTP request, read = longest silence between two packets
+API_CALL_TIMEOUT = 120       # seconds for one arXiv API page (arxiv.Client has no socket timeout)
+DOWNLOAD_DEADLINE = 600      # seconds to download one e-print, however slowly the bytes trickle in
+STALL_TIMEOUT = 900          # seconds without progress before the watchdog cancels an in-flight task
+STALL_GRACE = 60             # seconds a cancelled task gets to stop by itself before it is abandoned
+STALL_RETRY_BUDGET = 2       # times a stalled task is requeued before its ID is reported as stalled
+
+
+# ========== Download size caps ==========
+LARGE_SOURCE_SIZE = 20 * 1024 * 1024   # bytes (Content-Length) above which a tarball is filtered while it streams, only .tex/.bib reach the disk
+MAX_SOURCE_SIZE = 100 * 1024 * 1024    # bytes read from one e-print at most, reading stops there and keeps the members already read
+
+
+# ========== Record / replay ==========
+CASSETTE_MODE = None                # 'record' or 'replay' the upstream traffic of the shared session (see cassette.py)
+CASSETTE_PATH = './run.cassette'
+CASSETTE_TIMING = 'original'        # replay with the recorded latency and transfer rate, or 'none'
+
+
+# ========== Profiling ==========
+PROFILE_DIR = './Profile'        # reports written by `python main.py --profile-memory / --profile-cpu`
+PROFILE_MEMORY = False
+PROFILE_CPU = False
+CPU_SAMPLE_INTERVAL = 0.01       # seconds between two samples of every thread's stack
+MEMORY_SAMPLE_INTERVAL = 0.01    # seconds between two RSS samples
+MEMORY_SNAPSHOT_INTERVAL = 30    # seconds between two tracemalloc snapshots (each one walks every live allocation)
+MEMORY_TRACE_FRAMES = 25         # frames kept per allocation, deep enough to reach the stage function
+PROFILE_TOP_N = 15               # rows per table of a report
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from config import SIZE_LEDGER_PATH
+from layout import iter_paper_dirs
+from size_ledger import SizeLedger
+
+ANALYSIS_CACHE_PATH = './.cache/analysis_cache.json'
+CHUNK_SIZE = 512
+
+
+def scan_paper_folder(folder_path: str, cached: dict | None) -> dict:
+    '''
+    A function to compute the stats of one paper folder, reusing the cached stats when references.json is unchanged
+
+    Return
+    ------
+    dict
+        {
+            'references_mtime': int or None (mtime_ns of references.json),
+            'has_metadata': bool,
+            'num_references': int or None (None when there is no references.json)
+        }
+    '''
+    references_stat, has_metadata = None, False
+
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name == 'references.json':
+                references_stat = entry.stat()
+            elif entry.name == 'metadata.json':
+                has_metadata = True
+
+    if references_stat is None:
+        return {'references_mtime': None, 'has_metadata': has_metadata, 'num_references': None}
+
+    references_mtime = references_stat.st_mtime_ns
+    if cached is not None and cached.get('references_mtime') == references_mtime:
+        return {**cached, 'has_metadata': has_metadata}
+
+    try:
+        with open(os.path.join(folder_path, 'references.json'), encoding='utf-8') as f:
+            num_references = len(json.load(f))
+    except (OSError, ValueError):
+        # Truncated or unreadable file: count the paper as having no references, retry on the next run
+        return {'references_mtime': None, 'has_metadata': has_metadata, 'num_references': None}
+
+    return {'references_mtime': references_mtime, 'has_metadata': has_metadata, 'num_references': num_references}
+
+
+def scan_chunk(chunk: list[tuple[str, str, dict | None]]) -> list[tuple[str, dict]]:
+    result = []
+
+    for name, folder_path, cached in chunk:
+        try:
+            result.append((name, scan_paper_folder(folder_path, cached)))
+        except OSError:
+            continue
+
+    return result
+
+
+def load_cache(cache_path: str, save_root: str) -> dict:
+    if not os.path.exists(cache_path):
+        return {}
+
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # The cache only describes the corpus it was built from
+    if cache.get('save_root') != os.path.abspath(save_root):
+        return {}
+    return cache.get('papers', {})
+
+
+def save_cache(papers: dict, cache_path: str, save_root: str):
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+
+    with open(cache_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'save_root': os.path.abspath(save_root), 'papers': papers}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def scan_corpus(save_root: str = './Save', cache_path: str | None = ANALYSIS_CACHE_PATH, max_workers: int | None = None) -> dict:
+    '''
+    A function to compute per-paper stats of the whole corpus across a process pool
+
+    Per-paper stats are cached by the mtime of references.json, so only new or rewritten papers are parsed again.
+
+    Parameters
+    ----------
+    save_root: str
+        root folder of the corpus
+    cache_path: str or None
+        path of the incremental cache, None to disable it
+    max_workers: int or None
+        number of processes (default: number of CPUs)
+
+    Return
+    ------
+    dict
+        key: paper folder name, value: stats returned by scan_paper_folder
+    '''
+    if not os.path.isdir(save_root):
+        return {}
+
+    cache = load_cache(cache_path, save_root) if cache_path else {}
+    tasks = [(name, path, cache.get(name)) for name, path in iter_paper_dirs(save_root)]
+    chunks = [tasks[i:i + CHUNK_SIZE] for i in range(0, len(tasks), CHUNK_SIZE)]
+
+    stats = {}
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            stats.update(scan_chunk(chunk))
+    else:
+        # Spawned, not forked: main.main calls this with the pipeline, writer and watchdog threads still around
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for result in executor.map(scan_chunk, chunks):
+                stats.update(result)
+
+    if cache_path:
+        save_cache(stats, cache_path, save_root)
+
+    return stats
+
+
+def summarize_references(stats: dict) -> tuple[float, int]:
+    '''
+    A function to compute the reference metrics of a corpus
+
+    Return
+    ------
+    tuple of (float, int)
+        (rate of papers having references.json, average number of references per such paper)
+    '''
+    reference_counts = [paper['num_references'] for paper in stats.values() if paper['num_references'] is not None]
+
+    rate_success = len(reference_counts) / len(stats) if stats else 0
+    count_reference_per_paper_average = sum(reference_counts) // len(reference_counts) if reference_counts else 0
+
+    return rate_success, count_reference_per_paper_average
+
+
+def compute_general_metrics(
+    save_root: str = './Save',
+    paper_sizes: SizeLedger | str | None = SIZE_LEDGER_PATH,
+    expected_papers: int | None = None,
+    cache_path: str | None = ANALYSIS_CACHE_PATH,
+    max_workers: int | None = None,
+    references: bool = True
+) -> dict:
+    '''
+    A function to compute the metrics['general'] fields, for main.main after a run or from an existing corpus
+
+    Parameters
+    ----------
+    save_root: str
+        root folder of the corpus
+    paper_sizes: SizeLedger, str or None
+        size ledger of the run, or the path of a saved one (.npz, or a paper_sizes.json list of size reports);
+        None when the 'sources' stage did not run (no size fields)
+    expected_papers: int or None
+        number of papers expected in the scraped range; defaults to the papers seen on disk or in the size ledger
+    references: bool
+        whether to scan the corpus for the reference fields ('references' stage)
+    '''
+    stats = scan_corpus(save_root, cache_path, max_workers) if references else {}
+    if isinstance(paper_sizes, str):
+        paper_sizes = SizeLedger.load(paper_sizes)
+
+    if expected_papers is None:
+        expected_papers = len(set(stats) | (set(paper_sizes.paper_ids()) if paper_sizes is not None else set()))
+
+    general = {}
+    general['Number of expected crawled papers'] = expected_papers
+
+    if paper_sizes is not None:
+        size_stats = paper_sizes.stats()
+        crawled_papers = size_stats['papers']
+        general['Number of successfully crawled papers'] = crawled_papers
+
+        if expected_papers == 0:
+            general['Overall success rate'] = '0%'
+        else:
+            general['Overall success rate'] = f'{(crawled_papers / expected_papers) * 100:.3f}%'
+
+    if references:
+        rate_success, count_reference_per_paper_average = summarize_references(stats)
+        general['Average number of references per paper'] = f'{count_reference_per_paper_average}'
+        general['Average success rate for scraping reference metadata'] = f'{rate_success * 100:.3f}%'
+
+    if paper_sizes is not None and len(paper_sizes):
+        general['Average paper size before removing figures'] = f"{round(size_stats['before']['mean'] / 1024, 3)} KB"
+        general['Average paper size after removing figures'] = f"{round(size_stats['after']['mean'] / 1024, 3)} KB"
+        general['Paper size after removing figures (p50 / p90 / p99)'] = \
+            ' / '.join(f"{round(size_stats['after'][f'p{q}'] / 1024, 3)} KB" for q in (50, 90, 99))
+
+        if size_stats['oversized']:
+            general['Number of oversized papers'] = f"{size_stats['oversized']} ({size_stats['truncated']} stopped at the size cap)"
+
+        if size_stats['compression_ratio'] is not None:
+            general['Average paper size after compression'] = f"{round(size_stats['compressed']['mean'] / 1024, 3)} KB"
+            general['Compression ratio'] = f"{size_stats['compression_ratio']:.2f}x"
+
+    return general
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute corpus statistics from an existing ./Save tree without scraping')
+    parser.add_argument('--save-root', default='./Save')
+    parser.add_argument('--paper-sizes', default=SIZE_LEDGER_PATH, help='size ledger (.npz) or paper_sizes.json')
+    parser.add_argument('--expected', type=int, default=None, help='number of papers expected in the scraped range')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--no-cache', action='store_true', help='ignore and do not update the incremental cache')
+    args = parser.parse_args(argv)
+
+    general = compute_general_metrics(
+        save_root=args.save_root,
+        paper_sizes=args.paper_sizes,
+        expected_papers=args.expected,
+        cache_path=None if args.no_cache else ANALYSIS_CACHE_PATH,
+        max_workers=args.workers
+    )
+
+    print('GENERAL:')
+    for key, value in general.items():
+        print(f'- {key}: {value}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,407 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:     # Windows: no lock, run one indexing process at a time
+    fcntl = None
+
+from config import CORPUS_INDEX_DIR, CORPUS_INDEX_COMPACT_RATIO
+from layout import get_paper_dir, get_paper_folder_name, iter_paper_dirs
+from utils import display_progress
+
+INDEX_FILE = 'corpus.idx'
+LOCK_FILE = 'corpus.lock'
+MAGIC = b'CIDX'
+FORMAT_VERSION = 2
+
+HEADER_FORMAT = '<4sIQQ'               # magic, format version, number of entries, blob generation
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+KEY_SIZE = 24
+ENTRY_FORMAT = f'<{KEY_SIZE}sQIQI'     # key, metadata offset/length, references offset/length
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+RECORD_FILES = {'metadata': 'metadata.json', 'references': 'references.json'}
+
+
+def encode_key(paper_id: str) -> bytes:
+    key = get_paper_folder_name(paper_id).encode('ascii')
+
+    if len(key) > KEY_SIZE:
+        raise ValueError(f'Paper ID {paper_id} is longer than {KEY_SIZE} bytes')
+    return key.ljust(KEY_SIZE, b'\0')
+
+
+class CorpusIndex:
+    '''
+    Read-only, memory-mapped index of the corpus
+
+    corpus.idx holds a header and fixed-width entries sorted by paper ID, each pointing at the compact JSON of the
+    paper's metadata and references in corpus-<generation>.blob. A lookup is a binary search over the mapped index
+    followed by the parsing of only the requested record.
+
+    An open index stays valid while the index is updated or rebuilt: updates only append to the blob, and a rebuild
+    writes a blob of a new generation before swapping corpus.idx, the old files living on until their readers close.
+
+    Example
+    -------
+    with CorpusIndex() as index:
+        metadata = index.get_metadata('2306.14505')
+        references = index.get_references('2306-14505')
+    '''
+    def __init__(self, index_dir: str = CORPUS_INDEX_DIR):
+        for attempt in range(3):
+            self.index_file = open(os.path.join(index_dir, INDEX_FILE), 'rb')
+            self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, version, self.count, generation = read_header(self.index, index_dir)
+            try:
+                self.blob_file = open(get_blob_path(index_dir, generation), 'rb')
+                break
+            except FileNotFoundError:
+                # A rebuild replaced the index and removed its blob between the two opens
+                self.index.close()
+                self.index_file.close()
+                if attempt == 2:
+                    raise
+
+        self.blob = mmap.mmap(self.blob_file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self.blob_file.fileno()).st_size else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.index.close()
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.index_file.close()
+        self.blob_file.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, paper_id: str) -> bool:
+        return self._find(encode_key(paper_id)) is not None
+
+    def _key_at(self, position: int) -> bytes:
+        start = HEADER_SIZE + position * ENTRY_SIZE
+        return self.index[start:start + KEY_SIZE]
+
+    def _find(self, key: bytes) -> tuple | None:
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.count and self._key_at(low) == key:
+            return struct.unpack_from(ENTRY_FORMAT, self.index, HEADER_SIZE + low * ENTRY_SIZE)
+        return None
+
+    def ids(self) -> list[str]:
+        return [self._key_at(position).rstrip(b'\0').decode('ascii') for position in range(self.count)]
+
+    def get_raw(self, paper_id: str, kind: str) -> bytes | None:
+        '''
+        A function to get the compact JSON bytes of one record
+
+        Parameters
+        ----------
+        kind: str
+            'metadata' or 'references'
+        '''
+        entry = self._find(encode_key(paper_id))
+        if entry is None:
+            return None
+
+        _, metadata_offset, metadata_length, references_offset, references_length = entry
+        offset, length = (metadata_offset, metadata_length) if kind == 'metadata' else (references_offset, references_length)
+
+        if length == 0:
+            return None
+        return bytes(self.blob[offset:offset + length])
+
+    def get_metadata(self, paper_id: str) -> dict | None:
+        raw = self.get_raw(paper_id, 'metadata')
+        return json.loads(raw) if raw is not None else None
+
+    def get_references(self, paper_id: str) -> dict | None:
+        raw = self.get_raw(paper_id, 'references')
+        return json.loads(raw) if raw is not None else None
+
+
+def get_blob_path(index_dir: str, generation: int) -> str:
+    return os.path.join(index_dir, f'corpus-{generation}.blob')
+
+
+def read_header(data, index_dir: str) -> tuple:
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f'{index_dir} does not contain a corpus index (version {FORMAT_VERSION}), run `build`')
+
+    magic, version, count, generation = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f'{index_dir} does not contain a corpus index (version {FORMAT_VERSION}), run `build`')
+    return magic, version, count, generation
+
+
+@contextmanager
+def index_lock(index_dir: str):
+    '''
+    Exclusive lock of the index writers (pipelines of several processes, `build`), readers never wait
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+
+    with open(os.path.join(index_dir, LOCK_FILE), 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_entries(index_dir: str) -> tuple[dict, int]:
+    '''
+    A function to load the entries of an existing index
+
+    Return
+    ------
+    tuple of (dict, int)
+        {encoded key: (metadata offset, metadata length, references offset, references length)}, blob generation
+    '''
+    entries = {}
+
+    with open(os.path.join(index_dir, INDEX_FILE), 'rb') as f:
+        data = f.read()
+
+    _, _, count, generation = read_header(data, index_dir)
+    for position in range(count):
+        key, *pointers = struct.unpack_from(ENTRY_FORMAT, data, HEADER_SIZE + position * ENTRY_SIZE)
+        entries[key] = tuple(pointers)
+
+    return entries, generation
+
+
+def write_entries(entries: dict, index_dir: str, generation: int):
+    temp_path = os.path.join(index_dir, f'{INDEX_FILE}.{os.getpid()}.tmp')
+
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, len(entries), generation))
+        for key in sorted(entries):
+            f.write(struct.pack(ENTRY_FORMAT, key, *entries[key]))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, os.path.join(index_dir, INDEX_FILE))
+
+
+def remove_old_blobs(index_dir: str, generation: int):
+    '''
+    Remove the blobs of older generations (open readers keep reading theirs until they close them)
+    '''
+    for name in os.listdir(index_dir):
+        if name.startswith('corpus-') and name.endswith('.blob') and name != os.path.basename(get_blob_path(index_dir, generation)):
+            os.remove(os.path.join(index_dir, name))
+
+
+def encode_record(path: str) -> bytes:
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.dumps(json.load(f), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    except (OSError, ValueError):
+        return b''
+
+
+def pack_records(papers: list[tuple[str, str]], blob_path: str, entries: dict, current=None) -> int:
+    '''
+    A function to append the records of some papers to a blob and point their entries at them
+
+    Parameters
+    ----------
+    papers: list of (str, str)
+        (paper folder name, paper folder path)
+    current: bytes-like or None
+        content of the blob, to skip the records that did not change since they were indexed
+
+    Return
+    ------
+    int
+        number of indexed papers
+    '''
+    packed = 0
+
+    with open(blob_path, 'ab') as blob:
+        # Called under index_lock: nobody else appends, so the end of the file is where this run starts
+        offset = blob.seek(0, os.SEEK_END)
+
+        for count, (name, path) in enumerate(papers, start=1):
+            key = encode_key(name)
+            old = entries.get(key)
+            pointers = []
+
+            for position, file_name in enumerate(RECORD_FILES.values()):
+                raw = encode_record(os.path.join(path, file_name))
+
+                if old is not None and current is not None:
+                    old_offset, old_length = old[2 * position], old[2 * position + 1]
+                    if old_length == len(raw) and current[old_offset:old_offset + old_length] == raw:
+                        pointers.extend((old_offset, old_length))
+                        continue
+
+                blob.write(raw)
+                pointers.extend((offset, len(raw)))
+                offset += len(raw)
+
+            if any(pointers[1::2]):
+                entries[key] = tuple(pointers)
+                packed += 1
+
+            if len(papers) > 1000 and (count % 1000 == 0 or count == len(papers)):
+                display_progress(count, len(papers), 'Indexing papers')
+
+        blob.flush()
+        os.fsync(blob.fileno())
+
+    return packed
+
+
+def compact(entries: dict, index_dir: str, generation: int) -> int:
+    '''
+    A function to copy the live records into the blob of a new generation, dropping the records superseded by updates
+
+    Return
+    ------
+    int
+        the new generation (corpus.idx is not rewritten here)
+    '''
+    new_generation = generation + 1
+    compacted = {}
+
+    with open(get_blob_path(index_dir, generation), 'rb') as source, open(get_blob_path(index_dir, new_generation), 'wb') as blob:
+        offset = 0
+        for key in sorted(entries):
+            pointers = []
+            for old_offset, old_length in zip(entries[key][0::2], entries[key][1::2]):
+                source.seek(old_offset)
+                blob.write(source.read(old_length))
+                pointers.extend((offset, old_length))
+                offset += old_length
+            compacted[key] = tuple(pointers)
+
+        blob.flush()
+        os.fsync(blob.fileno())
+
+    entries.clear()
+    entries.update(compacted)
+    return new_generation
+
+
+def build_index(save_root: str = './Save', index_dir: str = CORPUS_INDEX_DIR) -> int:
+    '''
+    A function to build (or compact) the index of a whole ./Save tree, dropping records superseded by updates
+
+    The records are written to the blob of a new generation and corpus.idx is swapped once it is complete
+
+    Return
+    ------
+    int
+        number of indexed papers
+    '''
+    with index_lock(index_dir):
+        try:
+            _, generation = read_entries(index_dir)
+        except (OSError, ValueError):
+            generation = 0
+
+        generation += 1
+        blob_path = get_blob_path(index_dir, generation)
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+
+        entries = {}
+        packed = pack_records(sorted(iter_paper_dirs(save_root)), blob_path, entries)
+        write_entries(entries, index_dir, generation)
+        remove_old_blobs(index_dir, generation)
+
+    return packed
+
+
+def update_index(paper_ids: list[str], save_root: str = './Save', index_dir: str = CORPUS_INDEX_DIR) -> int:
+    '''
+    A function to re-index some papers (e.g. those processed by a pipeline run) without rebuilding the index
+
+    Their changed records are appended to the blob and the index is rewritten; nothing happens when no index has
+    been built yet. Once the blob holds more than CORPUS_INDEX_COMPACT_RATIO times its live records,
+    the live records are compacted into a new generation.
+
+    Return
+    ------
+    int
+        number of re-indexed papers
+    '''
+    if not os.path.exists(os.path.join(index_dir, INDEX_FILE)):
+        return 0
+
+    with index_lock(index_dir):
+        entries, generation = read_entries(index_dir)
+        blob_path = get_blob_path(index_dir, generation)
+        papers = [(get_paper_folder_name(paper_id), get_paper_dir(paper_id, save_root)) for paper_id in paper_ids]
+
+        with open(blob_path, 'rb') as f:
+            current = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+            try:
+                packed = pack_records(papers, blob_path, entries, current)
+            finally:
+                if isinstance(current, mmap.mmap):
+                    current.close()
+
+        live = sum(sum(pointers[1::2]) for pointers in entries.values())
+        if os.path.getsize(blob_path) > CORPUS_INDEX_COMPACT_RATIO * max(live, 1):
+            generation = compact(entries, index_dir, generation)
+
+        write_entries(entries, index_dir, generation)
+        remove_old_blobs(index_dir, generation)
+
+    return packed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or query the memory-mapped corpus index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='build (or compact) the index of a ./Save tree')
+    build_parser.add_argument('--save-root', default='./Save')
+    build_parser.add_argument('--index-dir', default=CORPUS_INDEX_DIR)
+
+    get_parser = subparsers.add_parser('get', help='print the metadata or references of a paper')
+    get_parser.add_argument('paper_id')
+    get_parser.add_argument('--kind', choices=list(RECORD_FILES), default='metadata')
+    get_parser.add_argument('--index-dir', default=CORPUS_INDEX_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        print(f'Indexed {build_index(args.save_root, args.index_dir)} papers into {args.index_dir}')
+        return
+
+    with CorpusIndex(args.index_dir) as index:
+        raw = index.get_raw(args.paper_id, args.kind)
+
+    if raw is None:
+        print(f'{args.paper_id} has no {args.kind} in the index')
+        return 1
+    print(json.dumps(json.loads(raw), ensure_ascii=False, indent=4))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
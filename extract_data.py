@@ -1,12 +1,15 @@
 import arxiv
-import requests
 import time
 import sys
 from dotenv import load_dotenv
 import os
 import re
 
-from config import CLIENT, SEMANTIC_RATE_LIMIT, ARXIV_RATE_LIMIT, SEMANTIC_DELAY_LOCK, semantic_last_request_time, ARXIV_DELAY_LOCK, arxiv_last_request_time
+from negative_cache import NEGATIVE_CACHE
+from network import RATE_LIMITERS, get_session, get_client
+from circuit_breaker import BREAKERS
+from task_watchdog import run_with_timeout
+from config import ARXIV_RATE_LIMIT, REQUEST_TIMEOUT, API_CALL_TIMEOUT
 
 load_dotenv()
 
@@ -26,23 +29,31 @@ def get_paper_from_id(
     list of arxiv_id without version
         a list contains id.
     '''
-    global arxiv_last_request_time
     paper = []
+    arxiv_id_list = [arxiv_id for arxiv_id in arxiv_id_list if NEGATIVE_CACHE.get('arxiv', arxiv_id) is None]
     
-    for attempt in range(1, retry_times + 1):
+    if arxiv_id_list == []:
+        return []
+    
+    breaker = BREAKERS['arxiv_api']
+    attempt = 0
+    
+    while attempt < retry_times:
+        breaker.before_request()
+        
         try:
-            with ARXIV_DELAY_LOCK:
-                time_since_last = time.time() - arxiv_last_request_time
-                
-                if time_since_last < ARXIV_RATE_LIMIT:
-                    time.sleep(ARXIV_RATE_LIMIT - time_since_last)
-                    
-                arxiv_last_request_time = time.time()
+            RATE_LIMITERS['arxiv'].wait()
             
-            paper = list(CLIENT.results(arxiv.Search(id_list=arxiv_id_list)))
+            paper = run_with_timeout(lambda: list(get_client().results(arxiv.Search(id_list=arxiv_id_list))), API_CALL_TIMEOUT)
+            breaker.record_success()
+            NEGATIVE_CACHE.add_missing('arxiv', arxiv_id_list, [result.get_short_id() for result in paper])
             break
         
         except Exception as e:
+                if breaker.record_error(e):
+                    continue
+                
+                attempt += 1
                 if attempt < retry_times:
                     time.sleep(ARXIV_RATE_LIMIT)
                 else:
@@ -81,6 +92,31 @@ def extract_metadata(
         metadata["publication_venue"] = paper_list_version[0].journal_ref
     return metadata
 
+def refresh_metadata(
+    metadata: dict,
+    paper_list_version: list[arxiv.Result],
+    known: int,
+) -> dict:
+    '''
+    A function to update a saved metadata in place with the versions published since it was written
+
+    Parameters
+    ----------
+    metadata: dict
+       content of the saved metadata.json
+    paper_list_version: list[arxiv.Result]
+       the new versions only (v{known + 1} to the latest)
+    known: int
+       number of versions the saved metadata already lists
+    Return
+        the same metadata with the revised dates of the new versions appended
+    ------
+    '''
+    revised_date = metadata.get("revised_date", [])[:known]
+    revised_date.extend(paper.updated.strftime("%Y-%m-%d") for paper in paper_list_version)
+    metadata["revised_date"] = revised_date
+    return metadata
+
 def extract_metadata_reference(
     paper: arxiv.Result
 ) -> object:
@@ -157,16 +193,8 @@ def extract_reference(
         object containing metadata
     ------
     '''
-    # Handle rate limit
-    global semantic_last_request_time
-    with SEMANTIC_DELAY_LOCK:
-        time_since_last = time.time() - semantic_last_request_time
-        
-        if time_since_last < SEMANTIC_RATE_LIMIT:
-            time.sleep(SEMANTIC_RATE_LIMIT - time_since_last)
-            
-        semantic_last_request_time = time.time()
-    
+    if NEGATIVE_CACHE.get('semantic', arxiv_id) is not None:
+        return {}
     
     url = f"https://api.semanticscholar.org/graph/v1/paper/arXiv:{arxiv_id}"
     params = {
@@ -175,26 +203,36 @@ def extract_reference(
     api_key = os.getenv("API_KEY")
     headers = {"x-api-key": api_key}
     
-    response = requests.get(url=url, params=params, headers=headers)
+    breaker = BREAKERS['semantic']
+    
+    while True:
+        breaker.before_request()
+        
+        # Handle rate limit
+        RATE_LIMITERS['semantic'].wait()
+        
+        try:
+            response = get_session().get(url=url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            if breaker.record_error(e):
+                continue
+            raise
+        
+        if response.status_code in (429, 503):
+            # Throttled: the paper is parked until the circuit closes (before_request) instead of losing its references
+            breaker.record_throttle()
+            sys.stdout.write('\n')
+            print(f"Refetch getting references of {arxiv_id} when Semantic Scholar recovers...")
+            continue
+        
+        breaker.record_success()
+        break
+    
     if response.status_code == 404 or response.status_code == 400:
         sys.stdout.write('\n')
         print(f"Paper {arxiv_id} is not found in semantic scholar")
+        NEGATIVE_CACHE.add('semantic', arxiv_id, 'not_found')
         return {}
-    
-    if response.status_code == 429:
-        for _ in range(1, retry_times + 1):
-            sys.stdout.write('\n')
-            print(f"Refetch getting references after {SEMANTIC_RATE_LIMIT} second...")
-            
-            time.sleep(SEMANTIC_RATE_LIMIT)
-            
-            response = requests.get(url=url, params=params)
-
-            if response.status_code != 429:
-                break
-            
-        if response.status_code == 429:
-            return {}
         
     try:
         data = response.json()
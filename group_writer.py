@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import threading
+from queue import Queue, Empty
+
+from config import WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, WRITE_FSYNC
+from profiling import stage
+
+
+def dump_json(data) -> bytes:
+    '''
+    Compact UTF-8 JSON of a metadata.json / references.json record
+    '''
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def sync_files(fds: list[int]):
+    '''
+    Flush the written files of a group to disk, one fsync per file
+    '''
+    for fd in fds:
+        os.fsync(fd)
+
+
+def sync_directory(directory: str):
+    '''
+    Flush a directory to disk, so that the files renamed into it survive a crash (skipped on Windows, where a
+    directory cannot be opened)
+    '''
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files_atomic(files: list[tuple[str, bytes]], fsync: bool = WRITE_FSYNC) -> list[Exception | None]:
+    '''
+    Write a group of files so that each path holds either its old content or the complete new one
+
+    Every file is written to a temp file next to its path, the temp files are synced, every temp file is renamed
+    over its path (os.replace is atomic), then every directory that received a file is synced so the renames are
+    durable too.
+
+    Parameters
+    ----------
+    files: list of tuple
+        (path, content) pairs
+    fsync: bool
+        sync the temp files before renaming them (a crash could otherwise rename a file whose data is not on disk),
+        and their directories after
+
+    Return
+    ------
+    list
+        None for every written file, the exception raised for the others
+    '''
+    errors = [None] * len(files)
+    written = []            # (index, temp path, fd)
+    directories = set()
+
+    for index, (path, content) in enumerate(files):
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        fd = None
+        try:
+            directory = os.path.dirname(path) or '.'
+            if directory not in directories:
+                os.makedirs(directory, exist_ok=True)
+                directories.add(directory)
+
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            view = memoryview(content)
+            while view:
+                view = view[os.write(fd, view):]
+            written.append((index, temp_path, fd))
+        except Exception as e:
+            errors[index] = e
+            if fd is not None:
+                os.close(fd)
+                os.remove(temp_path)
+
+    try:
+        if fsync and written:
+            sync_files([fd for _, _, fd in written])
+    except OSError as e:
+        for index, _, _ in written:
+            errors[index] = e
+    finally:
+        for _, _, fd in written:
+            os.close(fd)
+
+    for index, temp_path, _ in written:
+        if errors[index] is not None:
+            os.remove(temp_path)
+            continue
+        try:
+            os.replace(temp_path, files[index][0])
+        except OSError as e:
+            errors[index] = e
+            os.remove(temp_path)
+
+    if fsync:
+        renamed = {}
+        for index, _, _ in written:
+            if errors[index] is None:
+                renamed.setdefault(os.path.dirname(files[index][0]) or '.', []).append(index)
+
+        for directory, indexes in renamed.items():
+            try:
+                sync_directory(directory)
+            except OSError as e:
+                for index in indexes:
+                    errors[index] = e
+
+    return errors
+
+
+class GroupWriter:
+    '''
+    Writer stage of a pipeline: one thread that commits the metadata.json / references.json records in groups
+
+    Records are taken from the queue until WRITE_BATCH_SIZE are pending or WRITE_BATCH_DELAY has passed since the
+    first one, then written with write_files_atomic (one sync pass per group), and the callback
+    of every record is called.
+
+    Usage
+    -----
+    writer = GroupWriter(name='2306')
+    writer.start()
+    writer.put('Save/2306-14505/metadata.json', metadata, on_written=lambda error: ...)
+    writer.stop()    # commits what is pending, then returns
+    '''
+    def __init__(self, name: str = 'papers', batch_size: int = WRITE_BATCH_SIZE, batch_delay: float = WRITE_BATCH_DELAY,
+                 fsync: bool = WRITE_FSYNC):
+        self.name = name
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.fsync = fsync
+        self.queue = Queue()
+        self.thread = None
+        self.groups = 0
+        self.files = 0
+
+    def put(self, path: str, data, on_written=None):
+        '''
+        Queue a record, on_written(error) is called once it is on disk (error is None) or failed
+        '''
+        self.queue.put((path, data, on_written))
+
+    def next_group(self) -> tuple[list, bool]:
+        item = self.queue.get()
+        if item is None:
+            return [], True
+
+        group = [item]
+        deadline = time.time() + self.batch_delay
+
+        while len(group) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except Empty:
+                break
+            if item is None:
+                return group, True
+            group.append(item)
+
+        return group, False
+
+    def commit(self, group: list):
+        files = []
+        errors = []
+        for path, data, _ in group:
+            try:
+                files.append((path, dump_json(data)))
+                errors.append(None)
+            except (TypeError, ValueError) as e:
+                errors.append(e)
+
+        write_errors = iter(write_files_atomic(files, self.fsync))
+        errors = [error if error is not None else next(write_errors) for error in errors]
+
+        self.groups += 1
+        self.files += len(files)
+
+        for (path, _, on_written), error in zip(group, errors):
+            if error is not None:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][GroupWriter][{self.name}]: {path}: {error}')
+            if on_written is not None:
+                try:
+                    on_written(error)
+                except Exception as e:
+                    sys.stdout.write('\n')
+                    print(f'[EXCEPTION][GroupWriter][on_written]: {path}: {e}')
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            group, stopped = self.next_group()
+            if group:
+                with stage('save'):
+                    self.commit(group)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'{self.name}-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Commit every queued record and stop the thread
+        '''
+        self.queue.put(None)
+        self.thread.join()
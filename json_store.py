@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+
+
+class JsonStore:
+    '''
+    Base of the persistent stores kept as one JSON file (validator store, negative cache)
+
+    Records live in memory under `lock` and are written back every `autosave_every` updates.
+    Subclasses change `records` under the lock, then call `updated()`.
+
+    Usage
+    -----
+    class MyStore(JsonStore):
+        def add(self, key, value):
+            with self.lock:
+                self.records[key] = value
+            self.updated()
+    '''
+    def __init__(self, path: str, autosave_every: int = 50):
+        self.path = path
+        self.autosave_every = autosave_every
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.records = self._load()
+        self.pending_updates = 0
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def updated(self):
+        '''
+        Count one update and persist the store every `autosave_every` updates
+        '''
+        with self.lock:
+            self.pending_updates += 1
+            should_save = self.pending_updates >= self.autosave_every
+
+        if should_save:
+            # Autosaves run inside downloads and fetches: a persistence error must not fail the request
+            try:
+                self.save()
+            except OSError as e:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][{type(self).__name__}][save]: {e}')
+
+    def save(self):
+        # One save at a time, each through its own temp file: concurrent autosaves never replace each other's file
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.records, ensure_ascii=False)
+                self.pending_updates = 0
+
+            directory = os.path.dirname(self.path) or '.'
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
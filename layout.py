@@ -0,0 +1,76 @@
+import os
+import re
+
+from config import SAVE_LAYOUT
+
+LAYOUTS = ('flat', 'hashed')
+BUCKET_PATTERN = re.compile(r'^\d{4}$')
+
+
+def get_paper_folder_name(paper_id: str) -> str:
+    '''
+    A function to get the folder name of a paper (format: 'xxxx-xxxxx')
+    '''
+    return paper_id.replace('.', '-')
+
+
+def get_paper_dir(paper_id: str, save_root: str = './Save', layout: str = SAVE_LAYOUT) -> str:
+    '''
+    A function to get the output folder of a paper
+
+    Parameters
+    ----------
+    paper_id: str
+        paper's ID without version (format: 'xxxx.xxxxx' or 'xxxx-xxxxx')
+    save_root: str
+        root folder of the corpus
+    layout: str
+        'flat': Save/<yymm-nnnnn>/
+        'hashed': Save/<yymm>/<nn>/<yymm-nnnnn>/, nn being the last two digits of the ID, so that every folder
+        holds at most a hundred buckets or a few hundred papers
+
+    Return
+    ------
+    str
+        path of the paper's folder
+    '''
+    folder_name = get_paper_folder_name(paper_id)
+
+    if layout == 'flat':
+        return os.path.join(save_root, folder_name)
+    elif layout == 'hashed':
+        return os.path.join(save_root, folder_name[:4], folder_name[-2:], folder_name)
+    else:
+        raise ValueError(f"Unknown layout '{layout}', choose among {', '.join(LAYOUTS)}")
+
+
+def iter_paper_dirs(save_root: str = './Save'):
+    '''
+    A generator over every paper folder of a corpus, whatever its layout (flat, hashed, or mixed during a migration)
+
+    Top-level four-digit folders are 'hashed' buckets (Save/<yymm>/<nn>/), other folders are 'flat' paper folders.
+    Hidden entries and files are skipped.
+
+    Yield
+    -----
+    tuple of (str, str)
+        (paper folder name 'xxxx-xxxxx', folder path)
+    '''
+    with os.scandir(save_root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+                continue
+
+            if not BUCKET_PATTERN.match(entry.name):
+                yield entry.name, entry.path
+                continue
+
+            with os.scandir(entry.path) as buckets:
+                for bucket in buckets:
+                    if bucket.name.startswith('.') or not bucket.is_dir(follow_symlinks=False):
+                        continue
+
+                    with os.scandir(bucket.path) as papers:
+                        for paper in papers:
+                            if not paper.name.startswith('.') and paper.is_dir(follow_symlinks=False):
+                                yield paper.name, paper.path
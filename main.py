@@ -1,66 +1,163 @@
-from scraper import get_all_papers
-from utils import convert_paper_list_to_dictionary, save_dict_to_json, update_metrics, convert_second_to_format, calc_mean_paper_size, group_by_base_id_list
-from analysis import apply_analysis, analysis_reference
-from thread_process import execute_pipeline
-from config import START_ID, END_ID, NUM_FETCHING_THREADS, ANALYSIS_MODE
-import time
-
-def main(start_id:str, end_id:str, max_workers:int=5, withAnalysis:bool=False):
+from scraper import get_all_papers, get_papers_by_query
+from utils import update_metrics
+from analysis import apply_analysis
+from corpus_analysis import compute_general_metrics
+from thread_process import execute_pipeline, Pipeline, PAPER_STAGES
+from size_ledger import SizeLedger
+from refresh import LocalVersions
+from config import START_ID, END_ID, RUN_STAGES, SIZE_LEDGER_PATH, DISCOVERY_MODE, CATEGORIES, START_DATE, END_DATE, REFRESH_MODE
+from profiling import stage as profiling_stage, snapshot
+from datetime import date
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
+def get_discovery_function(discovery_mode:str, start_id:str, end_id:str, categories=CATEGORIES, start_date:str=START_DATE, end_date:str=END_DATE):
+    '''
+    A function to choose how papers are discovered
+
+    Return
+    ------
+    callable
+        a function taking (max_workers, fetch_all_versions, refresh) and returning the paper dict list
+    '''
+    if discovery_mode == 'query':
+        return partial(get_papers_by_query, list(categories), date.fromisoformat(start_date), date.fromisoformat(end_date))
+    elif discovery_mode == 'oai':
+        from oai_harvest import get_papers_by_oai
+        # OAI-PMH records carry every version, no thread fetches older versions
+        def discover_oai(max_workers, fetch_all_versions, refresh=None):
+            paper_dict_list = get_papers_by_oai(start_date, end_date, categories)
+            return paper_dict_list if refresh is None else refresh.trim(paper_dict_list)
+        return discover_oai
+    elif discovery_mode == 'id':
+        return partial(get_all_papers, start_id, end_id)
+    else:
+        raise ValueError(f"Unknown discovery mode '{discovery_mode}', choose 'id', 'query' or 'oai'")
+
+def main(start_id:str, end_id:str, max_workers:int=5, withAnalysis:bool=False, stages=RUN_STAGES, discovery_mode:str=DISCOVERY_MODE,
+         refresh:bool=REFRESH_MODE):
+    '''
+    A function to scrape every paper within start_id and end_id
+
+    Parameters
+    ----------
+    discovery_mode: str
+        'id' to enumerate every ID within start_id and end_id,
+        'query' to search the papers of CATEGORIES first submitted within START_DATE and END_DATE (config.py),
+        'oai' to harvest the OAI-PMH records of CATEGORIES updated within START_DATE and END_DATE
+    stages: iterable of str
+        stages to run among 'sources' (tex files), 'metadata' (metadata.json) and 'references' (references.json).
+        Older versions are only requested from the arXiv API when 'metadata' is enabled, and the size ledger
+        is only written when 'sources' is enabled.
+    refresh: bool
+        only fetch the versions newer than what ./Save holds: unchanged papers are dropped after discovery,
+        revised papers get their new versions, their references and their revised dates (see refresh.py)
+    '''
+    stages = [stage for stage in PAPER_STAGES if stage in stages]
+    fetch_all_versions = 'metadata' in stages
+    discover_papers = get_discovery_function(discovery_mode, start_id, end_id)
+    local_versions = LocalVersions(stages) if refresh else None
+    
+    def discover(max_workers, fetch_all_versions):
+        with profiling_stage('discovery'):
+            paper_dict_list = discover_papers(max_workers, fetch_all_versions, local_versions)
+        if local_versions is not None:
+            sys.stdout.write('\n')
+            print(f'[REFRESH]: {local_versions.summary()}')
+        # What the discovered arxiv.Result objects cost while they wait in the queues
+        snapshot('after discovery')
+        return paper_dict_list
+    
     if withAnalysis:
         metrics = {}
         metrics['time'] = {}
         metrics['memory'] = {}
         metrics['general'] = {}
-        paper_list, metric_crawl = apply_analysis('CrawlPaperID')(get_all_papers)(start_id, end_id, max_workers)
+        paper_dict_list, metric_crawl = apply_analysis('CrawlPaperID')(discover)(max_workers, fetch_all_versions)
 
         metrics = update_metrics(metrics, metric_crawl)
         
-        paper_dict_list = convert_paper_list_to_dictionary(paper_list)
-        paper_size, metric_process = apply_analysis('ProcessPaper')(execute_pipeline)(paper_dict_list)
+        paper_size, metric_process = apply_analysis('ProcessPaper')(execute_pipeline)(paper_dict_list, stages)
 
-        save_dict_to_json(paper_size, "paper_sizes.json")
-        
         metrics = update_metrics(metrics, metric_process)
 
-        group_paper_size_list = group_by_base_id_list(paper_size)
-
-        metrics['general'].update({'Number of expected crawled papers': len(paper_dict_list)})
-        metrics['general'].update({'Number of successfully crawled papers': len(group_paper_size_list)})
-        
-        if len(paper_list) == 0:
-            metrics['general'].update({'Overall success rate': f'0%'})
-        else:
-            metrics['general'].update({'Overall success rate': f'{(len(group_paper_size_list) / len(paper_dict_list)) * 100:.3f}%'})
-            
-        rate_success, count_reference_per_paper_average = analysis_reference(dirname="./Save")
-        metrics['general'].update({'Average number of references per paper': f'{count_reference_per_paper_average}'})
-        metrics['general'].update({'Average success rate for scraping reference metadata': f'{rate_success * 100:.3f}%'})
+        if 'sources' in stages:
+            paper_size.save(SIZE_LEDGER_PATH)
 
-        paper_size_before, paper_size_after = calc_mean_paper_size(paper_sizes=paper_size)
-        metrics['general'].update({'Average paper size before removing figures': f'{paper_size_before} KB'})
-        metrics['general'].update({'Average paper size after removing figures': f'{paper_size_after} KB'})
+        # Same fields as `cli.py analyze` (corpus_analysis.compute_general_metrics), from this run's ledger
+        metrics['general'].update(compute_general_metrics(
+            save_root='./Save',
+            paper_sizes=paper_size if 'sources' in stages else None,
+            expected_papers=len(paper_dict_list),
+            references='references' in stages,
+        ))
 
         return metrics
         
     else:
-        paper_list = get_all_papers(start_id, end_id, max_workers)
-        paper_dict_list = convert_paper_list_to_dictionary(paper_list)
+        paper_dict_list = discover(max_workers, fetch_all_versions)
 
-        paper_size = execute_pipeline(paper_dict_list)
-        save_dict_to_json(paper_size, "paper_sizes.json")
+        paper_size = execute_pipeline(paper_dict_list, stages)
+        
+        if 'sources' in stages:
+            paper_size.save(SIZE_LEDGER_PATH)
         return {}
 
+def run_ranges(ranges:list[tuple[str, str]], max_workers:int=5, stages=RUN_STAGES, discovery_mode:str=DISCOVERY_MODE,
+               refresh:bool=REFRESH_MODE) -> SizeLedger:
+    '''
+    A function to scrape several ranges side by side in one process (e.g. one per month)
+
+    Every range runs its own discovery then its own Pipeline, the rate limiters and the HTTP pool are shared,
+    so one range keeps the rate budget busy while another one is still discovering its papers
+
+    Parameters
+    ----------
+    ranges: list of tuple
+        (start, end) pairs: IDs for the 'id' discovery, ISO dates for 'query' and 'oai'
+    refresh: bool
+        see main
+
+    Return
+    ------
+    SizeLedger
+        sizes of every downloaded version of every range
+    '''
+    stages = [stage for stage in PAPER_STAGES if stage in stages]
+    fetch_all_versions = 'metadata' in stages
+    paper_sizes = SizeLedger()
+
+    def run_range(start:str, end:str):
+        if discovery_mode == 'id':
+            discover_papers = get_discovery_function(discovery_mode, start, end)
+        else:
+            discover_papers = get_discovery_function(discovery_mode, START_ID, END_ID, start_date=start, end_date=end)
+
+        local_versions = LocalVersions(stages) if refresh else None
+        with profiling_stage('discovery'):
+            paper_dict_list = discover_papers(max_workers, fetch_all_versions, local_versions)
+        if local_versions is not None:
+            sys.stdout.write('\n')
+            print(f'[REFRESH][{start}:{end}]: {local_versions.summary()}')
+
+        sizes = Pipeline(stages, name=f'{start}:{end}').run(paper_dict_list)
+        paper_sizes.merge(sizes)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = {executor.submit(run_range, start, end): (start, end) for start, end in ranges}
+
+        for future, (start, end) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][run_ranges]: range {start}:{end} failed: {e}')
+
+    return paper_sizes
+
 
 if __name__ == "__main__":
-    start_time = time.time()
-    metrics = main(start_id=START_ID, end_id=END_ID, max_workers=NUM_FETCHING_THREADS, withAnalysis=ANALYSIS_MODE)
-    
-    print('=' * 50)
-    
-    if metrics != {}:
-        for analysis_field, sub_dict in metrics.items():
-            print(f'{analysis_field.upper()}:')
-            for key, value in sub_dict.items():
-                print(f'- {key}: {value}')
-            
-    print("Overall Time: ", convert_second_to_format(time.time() - start_time))
\ No newline at end of file
+    # `python main.py [--stages ...]` is `python cli.py run [--stages ...]`
+    from cli import main as cli_main
+    sys.exit(cli_main(['run'] + sys.argv[1:]))
@@ -0,0 +1,101 @@
+import os
+import sys
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from layout import LAYOUTS, BUCKET_PATTERN, get_paper_dir, iter_paper_dirs
+from utils import display_progress
+
+
+def merge_move(src: str, dest: str):
+    '''
+    Move a folder into place; when the destination already exists (a run interrupted mid-migration, or papers
+    written in the new layout meanwhile), only move the entries it does not have yet
+    '''
+    if not os.path.exists(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.rename(src, dest)
+        return
+
+    for entry in os.listdir(src):
+        src_entry, dest_entry = os.path.join(src, entry), os.path.join(dest, entry)
+
+        if os.path.isdir(src_entry) and os.path.isdir(dest_entry):
+            merge_move(src_entry, dest_entry)
+        elif not os.path.exists(dest_entry):
+            os.rename(src_entry, dest_entry)
+
+    shutil.rmtree(src)
+
+
+def remove_empty_buckets(save_root: str):
+    '''
+    Remove the Save/<yymm>/<nn>/ buckets left empty after migrating to the flat layout
+    '''
+    for month in os.listdir(save_root):
+        month_dir = os.path.join(save_root, month)
+        if not BUCKET_PATTERN.match(month) or not os.path.isdir(month_dir):
+            continue
+
+        for bucket in os.listdir(month_dir):
+            bucket_dir = os.path.join(month_dir, bucket)
+            if os.path.isdir(bucket_dir) and not os.listdir(bucket_dir):
+                os.rmdir(bucket_dir)
+
+        if not os.listdir(month_dir):
+            os.rmdir(month_dir)
+
+
+def migrate_layout(save_root: str, layout: str, max_workers: int = 8) -> int:
+    '''
+    A function to move every paper folder of a corpus to a layout (see layout.get_paper_dir)
+
+    The migration is resumable: folders already in place are skipped, and rerunning after an interruption
+    finishes the remaining folders. Folders are moved with rename (no copy) by a thread pool.
+
+    Return
+    ------
+    int
+        number of moved folders
+    '''
+    moves = []
+    for name, path in iter_paper_dirs(save_root):
+        dest = get_paper_dir(name, save_root, layout)
+        if os.path.normpath(path) != os.path.normpath(dest):
+            moves.append((path, dest))
+
+    if not moves:
+        return 0
+
+    moved = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(merge_move, src, dest) for src, dest in moves]
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+                moved += 1
+            except Exception as e:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][migrate_layout]: {e}')
+
+            display_progress(moved, len(moves), f'Migrating to {layout} layout')
+
+    remove_empty_buckets(save_root)
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move an existing ./Save tree to another layout (resumable)')
+    parser.add_argument('--save-root', default='./Save')
+    parser.add_argument('--to', choices=LAYOUTS, required=True, help='target layout; set SAVE_LAYOUT in config.py accordingly')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    moved = migrate_layout(args.save_root, args.to, args.workers)
+    print(f'Moved {moved} paper folders to the {args.to} layout')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
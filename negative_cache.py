@@ -0,0 +1,161 @@
+import sys
+import time
+import argparse
+from collections import Counter
+
+from config import NEGATIVE_CACHE_PATH, NEGATIVE_CACHE_TTL
+from json_store import JsonStore
+
+ENDPOINTS = ('arxiv', 'eprint', 'semantic')
+
+
+class NegativeCache(JsonStore):
+    '''
+    A persistent cache of IDs known to have nothing to fetch on an endpoint
+
+    Every fetch path checks it before spending a rate-limit slot. Entries expire after the TTL of their reason
+    (config.NEGATIVE_CACHE_TTL), so papers that become available again are eventually retried.
+
+    Endpoints
+    ---------
+    'arxiv': arXiv API (export.arxiv.org/api/query)
+    'eprint': e-print source download (arxiv.org/e-print)
+    'semantic': Semantic Scholar graph API
+
+    Example record:
+        {'eprint:2306-14505v1': {'reason': 'pdf_only', 'time': 1697600000.0}}
+    '''
+    def __init__(self, path: str = NEGATIVE_CACHE_PATH, ttl: dict = NEGATIVE_CACHE_TTL, autosave_every: int = 50):
+        super().__init__(path, autosave_every)
+        self.ttl = ttl
+        self.hits = Counter()
+
+    @staticmethod
+    def _key(endpoint: str, paper_id: str) -> str:
+        return f"{endpoint}:{paper_id.replace('.', '-')}"
+
+    def _is_expired(self, record: dict, now: float) -> bool:
+        return now - record['time'] > self.ttl.get(record['reason'], 0)
+
+    def get(self, endpoint: str, paper_id: str) -> str | None:
+        '''
+        A function to check an ID before requesting it
+
+        Return
+        ------
+        str or None
+            the reason code when the ID is cached and not expired, otherwise None
+        '''
+        with self.lock:
+            record = self.records.get(self._key(endpoint, paper_id))
+
+            if record is None or self._is_expired(record, time.time()):
+                return None
+
+            self.hits[endpoint] += 1
+            return record['reason']
+
+    def add(self, endpoint: str, paper_id: str, reason: str):
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f'Unknown endpoint {endpoint}')
+
+        with self.lock:
+            self.records[self._key(endpoint, paper_id)] = {'reason': reason, 'time': time.time()}
+        self.updated()
+
+    def add_missing(self, endpoint: str, requested_ids: list[str], returned_ids: list[str]) -> int:
+        '''
+        Cache the requested IDs that a successful response did not return
+
+        Parameters
+        ----------
+        requested_ids: list of str
+            IDs sent in the request, with or without version
+        returned_ids: list of str
+            IDs of the returned papers, with version (format: 'xxxx.xxxxxvx')
+
+        Return
+        ------
+        int
+            number of IDs cached as 'missing'
+        '''
+        returned = set(returned_ids)
+        returned.update(paper_id.rpartition('v')[0] for paper_id in returned_ids if 'v' in paper_id)
+
+        missing = [paper_id for paper_id in requested_ids if paper_id not in returned]
+        for paper_id in missing:
+            self.add(endpoint, paper_id, 'missing')
+
+        return len(missing)
+
+    def remove(self, endpoint: str, paper_id: str):
+        with self.lock:
+            self.records.pop(self._key(endpoint, paper_id), None)
+
+    def purge_expired(self) -> int:
+        now = time.time()
+
+        with self.lock:
+            expired = [key for key, record in self.records.items() if self._is_expired(record, now)]
+            for key in expired:
+                del self.records[key]
+
+        return len(expired)
+
+    def report(self) -> dict:
+        '''
+        A function to summarize the cache
+
+        Return
+        ------
+        dict
+            {endpoint: {reason: {'active': int, 'expired': int}}} and the hits of the current process under 'hits'
+        '''
+        now = time.time()
+        summary = {}
+
+        with self.lock:
+            for key, record in self.records.items():
+                endpoint = key.split(':', 1)[0]
+                state = 'expired' if self._is_expired(record, now) else 'active'
+                reasons = summary.setdefault(endpoint, {})
+                reasons.setdefault(record['reason'], {'active': 0, 'expired': 0})[state] += 1
+
+            summary['hits'] = dict(self.hits)
+
+        return summary
+
+
+NEGATIVE_CACHE = NegativeCache()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect the negative cache of IDs skipped by the scraper')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='count cached IDs per endpoint and reason')
+    report_parser.add_argument('--list', action='store_true', help='also list every active ID')
+    subparsers.add_parser('purge', help='remove expired entries')
+    args = parser.parse_args(argv)
+
+    if args.command == 'purge':
+        print(f'Removed {NEGATIVE_CACHE.purge_expired()} expired entries')
+        NEGATIVE_CACHE.save()
+        return
+
+    summary = NEGATIVE_CACHE.report()
+    summary.pop('hits')
+
+    for endpoint, reasons in sorted(summary.items()):
+        print(f'{endpoint.upper()}:')
+        for reason, counts in sorted(reasons.items()):
+            print(f"- {reason}: {counts['active']} active, {counts['expired']} expired")
+
+    if args.list:
+        now = time.time()
+        for key, record in sorted(NEGATIVE_CACHE.records.items()):
+            if not NEGATIVE_CACHE._is_expired(record, now):
+                print(f"{key}\t{record['reason']}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
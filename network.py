@@ -0,0 +1,182 @@
+import time
+import threading
+
+from config import ARXIV_RATE_LIMIT, SEMANTIC_RATE_LIMIT, HTTP_POOL_SIZE, ARXIV_CLIENT_DELAY, CASSETTE_MODE, CASSETTE_PATH, CASSETTE_TIMING, RATE_BROKER
+
+
+class RateLimiter:
+    '''
+    A minimum interval between two requests to one host, shared by every thread (and every pipeline) of the process
+
+    With RATE_BROKER, the tokens come from the host-local broker (rate_broker.py), so several scraper processes
+    share one budget. Otherwise (or when no broker can be reached) each caller reserves the next free slot under
+    the lock and sleeps outside of it, so callers are served in arrival order and a waiting caller never blocks
+    the others' reservations
+
+    Usage
+    -----
+    RATE_LIMITERS['arxiv'].wait()
+    response = ...
+    '''
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.requests = 0
+
+    def wait(self):
+        if self.interval > 0 and RATE_BROKER:
+            broker = get_broker_client()
+            if broker is not None and broker.acquire(self.name):
+                with self.lock:
+                    self.requests += 1
+                return
+
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+            self.requests += 1
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'interval': self.interval,
+                'requests': self.requests,
+                'backlog': max(0.0, self.next_slot - time.time()),
+            }
+
+
+# arXiv asks for one request every ARXIV_RATE_LIMIT seconds across the API and the e-print host
+RATE_LIMITERS = {
+    'arxiv': RateLimiter('arxiv', ARXIV_RATE_LIMIT),
+    'semantic': RateLimiter('semantic', SEMANTIC_RATE_LIMIT),
+}
+
+_session = None
+_client = None
+_cassette = None
+_broker_client = None
+_lock = threading.Lock()
+
+
+def get_broker_client():
+    '''
+    Return the connection of this process to the rate broker, None where Unix sockets are not available
+    '''
+    global _broker_client
+
+    if _broker_client is None:
+        import rate_broker
+
+        if not rate_broker.is_supported():
+            return None
+        with _lock:
+            if _broker_client is None:
+                _broker_client = rate_broker.BrokerClient()
+
+    return _broker_client
+
+
+def get_session():
+    '''
+    Return the HTTP session of the process: one connection pool per host, reused by every thread and pipeline
+    (a new TLS connection per request costs more than the request itself)
+
+    Return
+    ------
+    requests.Session
+    '''
+    global _session, _cassette
+
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            if CASSETTE_MODE is not None:
+                from cassette import Cassette
+                _cassette = Cassette(CASSETTE_PATH, mode=CASSETTE_MODE, timing=CASSETTE_TIMING)
+                mount_cassette(session, _cassette)
+
+            _session = session
+
+        return _session
+
+
+def mount_cassette(session, cassette):
+    from cassette import CassetteAdapter
+
+    adapter = CassetteAdapter(cassette, pool_connections=8, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if cassette.mode == 'replay' and cassette.timing == 'none':
+        # Nothing upstream to protect: replay as fast as the pipeline goes
+        for limiter in RATE_LIMITERS.values():
+            limiter.interval = 0.0
+
+
+def use_cassette(cassette):
+    '''
+    Record every exchange of the shared session into a cassette, or serve them from it (see cassette.py)
+    '''
+    global _cassette
+    session = get_session()
+
+    with _lock:
+        if _cassette is not None:
+            raise RuntimeError(f'the cassette {_cassette.path} is already in use')
+        _cassette = cassette
+        mount_cassette(session, cassette)
+
+
+def close_cassette():
+    '''
+    Close the cassette in use, a recorded cassette is only readable once closed
+    '''
+    global _cassette
+
+    with _lock:
+        cassette, _cassette = _cassette, None
+    if cassette is not None:
+        cassette.close()
+
+
+def share_session(client):
+    '''
+    Make an arxiv.Client send its requests through the shared session (it creates its own otherwise)
+    '''
+    if hasattr(client, '_session'):
+        client._session = get_session()
+    return client
+
+
+def get_client():
+    '''
+    Return the arxiv.Client of the process, created on first use (arxiv and its dependencies are slow to import)
+
+    Return
+    ------
+    arxiv.Client
+    '''
+    global _client
+
+    if _client is None:
+        import arxiv
+
+        client = share_session(arxiv.Client(delay_seconds=ARXIV_CLIENT_DELAY))
+        with _lock:
+            if _client is None:
+                _client = client
+
+    return _client
@@ -0,0 +1,385 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from config import OAI_BASE_URL, OAI_SET, OAI_STATE_PATH, OAI_RECORDS_PATH, CATEGORIES, START_DATE, END_DATE
+
+NAMESPACES = {
+    'oai': 'http://www.openarchives.org/OAI/2.0/',
+    'raw': 'http://arxiv.org/OAI/arXivRaw/',
+}
+DEFAULT_RETRY_AFTER = 10
+
+
+def fetch_page(base_url:str, params:dict, retry_times:int=5) -> str:
+    '''
+    A function to fetch one OAI-PMH page, honouring the 503 + Retry-After flow control of the repository
+
+    Return
+    ------
+    str
+        the XML page
+    '''
+    from network import get_session
+    from scraper import count_request
+
+    for attempt in range(1, retry_times + 1):
+        count_request('oai_page')
+        response = get_session().get(base_url, params=params, timeout=(10, 120))
+
+        if response.status_code == 200:
+            return response.text
+
+        if response.status_code == 503 and attempt < retry_times:
+            retry_after = response.headers.get('Retry-After', '')
+            delay = int(retry_after) if retry_after.isdigit() else DEFAULT_RETRY_AFTER
+            sys.stdout.write('\n')
+            print(f'[OAI]: repository busy, retrying after {delay}s')
+            time.sleep(delay)
+            continue
+
+        raise RuntimeError(f'OAI-PMH request failed: HTTP {response.status_code}')
+
+
+def parse_authors(authors:str) -> list[str]:
+    '''
+    A function to split the arXivRaw author string ('A, B and C') into author names
+    '''
+    authors = re.sub(r'\s+', ' ', authors or '').strip()
+    return [name.strip() for name in re.split(r',\s*(?:and\s+)?|\s+and\s+', authors) if name.strip()]
+
+
+def parse_record(record:ET.Element) -> dict | None:
+    '''
+    A function to convert one arXivRaw record into a plain, JSON-serializable paper record
+
+    Return
+    ------
+    dict or None
+        {'id', 'title', 'authors', 'categories', 'journal_ref', 'comments', 'versions': [{'version', 'date', 'size'}]},
+        None for deleted records
+    '''
+    header = record.find('oai:header', NAMESPACES)
+    if header is not None and header.get('status') == 'deleted':
+        return None
+
+    raw = record.find('oai:metadata/raw:arXivRaw', NAMESPACES)
+    if raw is None:
+        return None
+
+    def text(tag):
+        element = raw.find(f'raw:{tag}', NAMESPACES)
+        return re.sub(r'\s+', ' ', element.text).strip() if element is not None and element.text else None
+
+    versions = []
+    for version in raw.findall('raw:version', NAMESPACES):
+        date = version.find('raw:date', NAMESPACES)
+        size = version.find('raw:size', NAMESPACES)
+        versions.append({
+            'version': int(version.get('version', 'v1').lstrip('v')),
+            'date': parsedate_to_datetime(date.text.strip()).isoformat() if date is not None else None,
+            'size': size.text.strip() if size is not None and size.text else None,
+        })
+
+    return {
+        'id': text('id'),
+        'title': text('title'),
+        'authors': parse_authors(text('authors')),
+        'categories': (text('categories') or '').split(),
+        'journal_ref': text('journal-ref'),
+        'comments': text('comments'),
+        'versions': sorted(versions, key=lambda version: version['version']),
+    }
+
+
+def parse_page(xml_text:str) -> tuple[list[dict], str | None]:
+    '''
+    A function to parse one ListRecords page
+
+    Return
+    ------
+    tuple of (list of dict, str or None)
+        paper records of the page and the resumption token of the next page (None on the last page)
+    '''
+    root = ET.fromstring(xml_text)
+
+    error = root.find('oai:error', NAMESPACES)
+    if error is not None:
+        if error.get('code') == 'noRecordsMatch':
+            return [], None
+        raise RuntimeError(f"OAI-PMH error {error.get('code')}: {error.text}")
+
+    records = [parse_record(record) for record in root.iterfind('oai:ListRecords/oai:record', NAMESPACES)]
+    token = root.find('oai:ListRecords/oai:resumptionToken', NAMESPACES)
+    next_token = token.text.strip() if token is not None and token.text and token.text.strip() else None
+
+    return [record for record in records if record is not None], next_token
+
+
+def load_state(state_path:str) -> dict:
+    if not os.path.exists(state_path):
+        return {}
+
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state:dict, state_path:str):
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def harvest_records(
+    from_date:str,
+    until_date:str,
+    set_spec:str | None = OAI_SET,
+    base_url:str = OAI_BASE_URL,
+    state_path:str = OAI_STATE_PATH,
+    records_path:str = OAI_RECORDS_PATH,
+    save_pages_dir:str | None = None
+) -> list[dict]:
+    '''
+    A function to harvest the arXivRaw records of a date range with ListRecords
+
+    Records are appended to records_path page by page and the resumption token is saved after each page, so an
+    interrupted harvest resumes from the last token instead of starting over.
+
+    Parameters
+    ----------
+    from_date, until_date: str
+        datestamp range (format: 'YYYY-MM-DD'); OAI datestamps are the date a record was last updated
+    set_spec: str or None
+        OAI set (e.g. 'cs'), None for every archive
+    base_url: str
+        OAI-PMH endpoint, e.g. a local replay server (see OAIReplayServer)
+    save_pages_dir: str or None
+        when given, every fetched page is also saved there, to be replayed later
+
+    Return
+    ------
+    list of dict
+        paper records (see parse_record)
+    '''
+    params = {'verb': 'ListRecords', 'metadataPrefix': 'arXivRaw', 'from': from_date, 'until': until_date}
+    if set_spec:
+        params['set'] = set_spec
+
+    state = load_state(state_path)
+    if state.get('params') == params and state.get('token'):
+        token, pages = state['token'], state['pages']
+        sys.stdout.write('\n')
+        print(f'[OAI]: resuming harvest after {pages} pages')
+    else:
+        token, pages = None, 0
+        os.makedirs(os.path.dirname(records_path) or '.', exist_ok=True)
+        open(records_path, 'w').close()
+
+    while True:
+        request_params = {'verb': 'ListRecords', 'resumptionToken': token} if token else params
+        xml_text = fetch_page(base_url, request_params)
+        records, token = parse_page(xml_text)
+        pages += 1
+
+        if save_pages_dir is not None:
+            os.makedirs(save_pages_dir, exist_ok=True)
+            with open(os.path.join(save_pages_dir, f'page-{pages:05d}.xml'), 'w', encoding='utf-8') as f:
+                f.write(xml_text)
+
+        with open(records_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        save_state({'params': params, 'token': token, 'pages': pages}, state_path)
+        sys.stdout.write(f'\r[OAI]: {pages} pages harvested')
+        sys.stdout.flush()
+
+        if token is None:
+            break
+
+    sys.stdout.write('\n')
+    with open(records_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def records_to_results(records:list[dict], categories=None) -> list:
+    '''
+    A function to turn harvested records into one arxiv.Result per version
+
+    Parameters
+    ----------
+    categories: iterable of str or None
+        keep only the papers having one of these categories
+
+    Return
+    ------
+    list of arxiv.Result
+        versions carrying entry_id, title, authors, published (v1 date), updated (version date), journal_ref and categories
+    '''
+    import arxiv
+
+    categories = set(categories) if categories else None
+    paper_list = []
+
+    for record in records:
+        if categories is not None and not categories & set(record['categories']):
+            continue
+        if not record['versions'] or record['versions'][0]['date'] is None:
+            continue
+
+        published = datetime.fromisoformat(record['versions'][0]['date'])
+        authors = [arxiv.Result.Author(name) for name in record['authors']]
+
+        for version in record['versions']:
+            paper_list.append(arxiv.Result(
+                entry_id=f"http://arxiv.org/abs/{record['id']}v{version['version']}",
+                updated=datetime.fromisoformat(version['date']) if version['date'] else published,
+                published=published,
+                title=record['title'] or '',
+                authors=authors,
+                comment=record['comments'] or '',
+                journal_ref=record['journal_ref'],
+                primary_category=record['categories'][0] if record['categories'] else '',
+                categories=record['categories'],
+            ))
+
+    return paper_list
+
+
+def get_papers_by_oai(from_date:str, until_date:str, categories=CATEGORIES, set_spec:str | None = OAI_SET, base_url:str = OAI_BASE_URL) -> list[dict]:
+    '''
+    A function to discover papers and all their versions by harvesting OAI-PMH metadata
+
+    One ListRecords page carries hundreds of records with their full version history, so no per-ID arXiv API
+    request is needed.
+
+    Return
+    ------
+    list of dictionary
+        [{'id': 'xxxx.xxxxx', 'versions': list[arxiv.Result]}, ...] (see utils.convert_paper_list_to_dictionary)
+    '''
+    from utils import convert_paper_list_to_dictionary
+
+    records = harvest_records(from_date, until_date, set_spec=set_spec, base_url=base_url)
+    return convert_paper_list_to_dictionary(records_to_results(records, categories))
+
+
+class OAIReplayServer:
+    '''
+    A local stand-in for an OAI-PMH repository replaying saved ListRecords pages
+
+    Pages are served in file name order (e.g. the page-00001.xml, page-00002.xml... saved with save_pages_dir):
+    a request without resumptionToken gets the first page, a request with the token found in page N gets page N + 1.
+    Pages whose token is empty end the list.
+
+    Example
+    -------
+    with OAIReplayServer('./oai_pages') as server:
+        records = harvest_records('2023-06-01', '2023-06-30', base_url=server.url)
+    '''
+    def __init__(self, pages_dir:str, host:str = '127.0.0.1', port:int = 0):
+        names = sorted(name for name in os.listdir(pages_dir) if name.endswith('.xml'))
+        self.pages = []
+        for name in names:
+            with open(os.path.join(pages_dir, name), encoding='utf-8') as f:
+                self.pages.append(f.read())
+
+        # token found in page N -> index of page N + 1
+        self.next_page = {}
+        for index, page in enumerate(self.pages):
+            _, token = parse_page(page)
+            if token is not None:
+                self.next_page[token] = index + 1
+
+        self.requests = []
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/oai'
+
+    def _make_handler(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                replay.requests.append(query)
+
+                index = replay.next_page.get(query['resumptionToken']) if 'resumptionToken' in query else 0
+                if index is None or index >= len(replay.pages):
+                    self.send_error(400, 'badResumptionToken')
+                    return
+
+                body = replay.pages[index].encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Harvest arXiv metadata through OAI-PMH, or replay saved pages locally')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    harvest_parser = subparsers.add_parser('harvest', help='harvest a date range (resumes an interrupted harvest)')
+    harvest_parser.add_argument('--from-date', default=START_DATE)
+    harvest_parser.add_argument('--until-date', default=END_DATE)
+    harvest_parser.add_argument('--set', default=OAI_SET)
+    harvest_parser.add_argument('--base-url', default=OAI_BASE_URL)
+    harvest_parser.add_argument('--save-pages', default=None, help='folder where fetched pages are saved for replay')
+
+    replay_parser = subparsers.add_parser('replay', help='serve saved pages as a local OAI-PMH repository')
+    replay_parser.add_argument('--pages', required=True)
+    replay_parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args(argv)
+
+    if args.command == 'replay':
+        server = OAIReplayServer(args.pages, port=args.port)
+        print(f'Replaying {len(server.pages)} pages on {server.url}')
+        try:
+            server.server.serve_forever()
+        except KeyboardInterrupt:
+            server.server.server_close()
+        return
+
+    records = harvest_records(args.from_date, args.until_date, set_spec=args.set, base_url=args.base_url, save_pages_dir=args.save_pages)
+    print(f'Harvested {len(records)} records, {sum(len(record["versions"]) for record in records)} versions')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,549 @@
+import os
+import sys
+import ast
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from config import PROFILE_DIR, MEMORY_SAMPLE_INTERVAL, MEMORY_SNAPSHOT_INTERVAL, MEMORY_TRACE_FRAMES, PROFILE_TOP_N, CPU_SAMPLE_INTERVAL
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Pipeline stages, and the functions whose work is charged to them. Memory allocated (or CPU spent) below one
+# of these functions belongs to the innermost one found on the stack, e.g. a tarball extracted by extract_source()
+# inside save_one_tex() is charged to 'extract', not 'download'.
+STAGE_FUNCTIONS = {
+    'discovery': ('get_all_papers', 'get_papers_by_query', 'get_papers_by_oai', 'collect_all_versions',
+                  'crawl_id_batches', 'crawl_lastest_papers_multithread', 'crawl_all_versions_multithread',
+                  'crawl_query_window', 'crawl_latest_papers_by_query', 'harvest_records', 'records_to_results'),
+    'download': ('save_one_tex', 'download_zip_file'),
+    'extract': ('extract_source', 'archive_source', 'compress_source', 'remove_figures'),
+    'metadata': ('extract_metadata',),
+    'references': ('extract_reference',),
+    'save': ('save_one_metadata', 'save_one_reference', 'write_files_atomic', 'commit'),
+}
+FUNCTION_STAGES = {function: stage for stage, functions in STAGE_FUNCTIONS.items() for function in functions}
+OTHER = 'other'
+
+# Stages entered through stage(): a global count (sampled with the RSS) and a per-thread stack,
+# also reachable by thread ident so that the CPU sampler can read the stage of another thread
+active_stages = Counter()
+active_stages_lock = threading.Lock()
+_local = threading.local()
+thread_stages = {}
+
+MEMORY_PROFILER = None
+
+
+@contextmanager
+def stage(name: str):
+    '''
+    Tag the work done inside the block with a pipeline stage (cheap, usable whether profiling is on or not)
+
+    Usage
+    -----
+    with stage('discovery'):
+        paper_dict_list = discover_papers(...)
+    '''
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+        thread_stages[threading.get_ident()] = stack
+
+    stack.append(name)
+    with active_stages_lock:
+        active_stages[name] += 1
+    try:
+        yield
+    finally:
+        with active_stages_lock:
+            active_stages[name] -= 1
+            if active_stages[name] == 0:
+                del active_stages[name]
+        stack.pop()
+
+
+def current_stage() -> str | None:
+    '''
+    Return the innermost stage entered by the current thread, None outside any stage
+    '''
+    stack = getattr(_local, 'stages', None)
+    return stack[-1] if stack else None
+
+
+def snapshot(label: str):
+    '''
+    Take a tracemalloc snapshot now when memory profiling is on (e.g. right after discovery), no-op otherwise
+    '''
+    if MEMORY_PROFILER is not None:
+        MEMORY_PROFILER.take_snapshot(label)
+
+
+def short_path(filename: str) -> str:
+    if filename.startswith('<'):
+        return filename
+    filename = os.path.abspath(filename)
+    return os.path.relpath(filename, PROJECT_DIR) if is_project_file(filename) else filename
+
+
+def is_project_file(filename: str) -> bool:
+    return filename.startswith(PROJECT_DIR + os.sep) and 'site-packages' not in filename
+
+
+class FunctionLocator:
+    '''
+    Map (file, line) of a tracemalloc frame to the name of the project function containing it
+    (tracemalloc frames carry no function name)
+    '''
+    def __init__(self):
+        self.functions = {}   # filename -> list of (first line, last line, name)
+
+    def load(self, filename: str) -> list:
+        if filename not in self.functions:
+            spans = []
+            if is_project_file(filename) and filename.endswith('.py'):
+                try:
+                    with open(filename, encoding='utf-8') as f:
+                        tree = ast.parse(f.read())
+                    for node in ast.walk(tree):
+                        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                            spans.append((node.lineno, node.end_lineno, node.name))
+                except (OSError, SyntaxError):
+                    pass
+            self.functions[filename] = spans
+        return self.functions[filename]
+
+    def function_at(self, filename: str, lineno: int) -> str | None:
+        innermost = None
+        for first, last, name in self.load(filename):
+            if first <= lineno <= last and (innermost is None or first > innermost[0]):
+                innermost = (first, name)
+        return innermost[1] if innermost else None
+
+
+class MemoryProfiler:
+    '''
+    Opt-in memory profiling of a run
+
+    - a sampler thread reads the RSS and the traced memory every MEMORY_SAMPLE_INTERVAL seconds (short peaks such as
+      a large tarball being extracted are not missed) and charges each sample to the stages active at that time
+    - tracemalloc snapshots (every MEMORY_SNAPSHOT_INTERVAL seconds and at snapshot() calls) attribute every live
+      allocation to a stage from its traceback (see STAGE_FUNCTIONS); for each stage the snapshot where the stage
+      held the most memory is kept as its top-allocators table
+
+    Usage
+    -----
+    profiler = MemoryProfiler()
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.write_report()
+    '''
+    def __init__(self, sample_interval: float = MEMORY_SAMPLE_INTERVAL, snapshot_interval: float = MEMORY_SNAPSHOT_INTERVAL,
+                 frames: int = MEMORY_TRACE_FRAMES, top_n: int = PROFILE_TOP_N):
+        self.sample_interval = sample_interval
+        self.snapshot_interval = snapshot_interval
+        self.frames = frames
+        self.top_n = top_n
+
+        self.locator = FunctionLocator()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+        self.start_time = 0.0
+        self.samples = 0
+        self.peak = {'rss': 0, 'traced': 0, 'time': 0.0, 'stages': []}
+        self.stage_samples = defaultdict(lambda: {'samples': 0, 'rss_sum': 0, 'rss_peak': 0, 'traced_peak': 0})
+        self.stage_peaks = {}    # stage -> {'label', 'time', 'size', 'count', 'allocators'}
+        self.snapshots = []      # (label, time, traced size) of every snapshot taken
+
+    def start(self):
+        global MEMORY_PROFILER
+        import psutil
+
+        self.process = psutil.Process()
+        self.start_time = time.time()
+        tracemalloc.start(self.frames)
+        MEMORY_PROFILER = self
+
+        self.stop_event.clear()
+        self.threads = [
+            threading.Thread(target=self.run_sampler, name='memory-sampler', daemon=True),
+            threading.Thread(target=self.run_snapshots, name='memory-snapshots', daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        global MEMORY_PROFILER
+
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        self.take_snapshot('end of run')
+        tracemalloc.stop()
+        MEMORY_PROFILER = None
+
+    def run_sampler(self):
+        while not self.stop_event.wait(self.sample_interval):
+            rss = self.process.memory_info().rss
+            traced, _ = tracemalloc.get_traced_memory()
+            with active_stages_lock:
+                stages = list(active_stages)
+
+            self.samples += 1
+            if rss > self.peak['rss']:
+                self.peak = {'rss': rss, 'traced': traced, 'time': time.time() - self.start_time, 'stages': stages}
+
+            for name in stages:
+                record = self.stage_samples[name]
+                record['samples'] += 1
+                record['rss_sum'] += rss
+                record['rss_peak'] = max(record['rss_peak'], rss)
+                record['traced_peak'] = max(record['traced_peak'], traced)
+
+    def run_snapshots(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            self.take_snapshot('periodic')
+
+    def stage_of(self, traceback) -> str:
+        # most recent frame first: the innermost stage function wins
+        for frame in reversed(traceback):
+            function = self.locator.function_at(os.path.abspath(frame.filename), frame.lineno)
+            if function in FUNCTION_STAGES:
+                return FUNCTION_STAGES[function]
+        return OTHER
+
+    def site_of(self, traceback) -> str:
+        '''
+        Describe an allocation site: the line that allocated, and the innermost project function above it
+        '''
+        frame = traceback[-1]
+        site = f'{short_path(frame.filename)}:{frame.lineno}'
+
+        for caller in reversed(traceback):
+            function = self.locator.function_at(os.path.abspath(caller.filename), caller.lineno)
+            if function is not None:
+                return f'{site} ({function})' if caller is frame else f'{site} <- {function}'
+        return site
+
+    def take_snapshot(self, label: str):
+        if not tracemalloc.is_tracing():
+            return
+
+        elapsed = time.time() - self.start_time
+        current_snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__, all_frames=True),   # the profiler's own threads
+        ))
+
+        stage_sizes = Counter()
+        stage_counts = Counter()
+        stage_sites = defaultdict(Counter)
+        stage_site_counts = defaultdict(Counter)
+
+        # Identical tracebacks are grouped by tracemalloc first, far fewer entries than traces
+        for statistic in current_snapshot.statistics('traceback'):
+            name = self.stage_of(statistic.traceback)
+            site = self.site_of(statistic.traceback)
+            stage_sizes[name] += statistic.size
+            stage_counts[name] += statistic.count
+            stage_sites[name][site] += statistic.size
+            stage_site_counts[name][site] += statistic.count
+
+        with self.lock:
+            self.snapshots.append((label, elapsed, sum(stage_sizes.values())))
+
+            for name, size in stage_sizes.items():
+                if name not in self.stage_peaks or size > self.stage_peaks[name]['size']:
+                    self.stage_peaks[name] = {
+                        'label': label,
+                        'time': elapsed,
+                        'size': size,
+                        'count': stage_counts[name],
+                        'allocators': [
+                            {'site': site, 'size': site_size, 'count': stage_site_counts[name][site]}
+                            for site, site_size in stage_sites[name].most_common(self.top_n)
+                        ],
+                    }
+
+    def report(self) -> dict:
+        with self.lock:
+            stages = {}
+            for name in list(STAGE_FUNCTIONS) + [OTHER]:
+                samples = self.stage_samples.get(name)
+                peak = self.stage_peaks.get(name)
+                if samples is None and peak is None:
+                    continue
+
+                stages[name] = {
+                    'samples': samples['samples'] if samples else 0,
+                    'rss_peak': samples['rss_peak'] if samples else 0,
+                    'rss_mean': samples['rss_sum'] / samples['samples'] if samples and samples['samples'] else 0,
+                    'traced_peak': samples['traced_peak'] if samples else 0,
+                    'held_peak': peak,
+                }
+
+            return {
+                'sample_interval': self.sample_interval,
+                'samples': self.samples,
+                'peak': self.peak,
+                'snapshots': [{'label': label, 'time': elapsed, 'size': size} for label, elapsed, size in self.snapshots],
+                'stages': stages,
+            }
+
+    def format_report(self, report: dict) -> str:
+        mb = 1024 * 1024
+        peak = report['peak']
+        lines = [
+            f"[MEMORY] {report['samples']} samples every {report['sample_interval'] * 1000:.0f} ms, "
+            f"peak RSS {peak['rss'] / mb:.1f} MB at {peak['time']:.1f}s (stages: {', '.join(peak['stages']) or '-'})",
+            f"{'stage':<12}{'peak RSS':>12}{'mean RSS':>12}{'peak traced':>14}{'held (max)':>14}",
+        ]
+        for name, record in report['stages'].items():
+            held = record['held_peak']['size'] if record['held_peak'] else 0
+            lines.append(f"{name:<12}{record['rss_peak'] / mb:>9.1f} MB{record['rss_mean'] / mb:>9.1f} MB"
+                         f"{record['traced_peak'] / mb:>11.1f} MB{held / mb:>11.1f} MB")
+
+        for name, record in report['stages'].items():
+            held = record['held_peak']
+            if not held:
+                continue
+            lines.append('')
+            lines.append(f"[MEMORY][{name}] top allocators ({held['size'] / mb:.1f} MB in {held['count']} blocks, "
+                         f"{held['label']} snapshot at {held['time']:.1f}s)")
+            for allocator in held['allocators']:
+                lines.append(f"  {allocator['size'] / mb:>9.2f} MB {allocator['count']:>9} blocks  {allocator['site']}")
+
+        return '\n'.join(lines)
+
+    def write_report(self, output_dir: str = PROFILE_DIR) -> str:
+        '''
+        Print the per-stage report and write it to output_dir (memory_report.txt / memory_report.json)
+
+        Return
+        ------
+        str
+            path of the text report
+        '''
+        report = self.report()
+        text = self.format_report(report)
+
+        os.makedirs(output_dir, exist_ok=True)
+        text_path = os.path.join(output_dir, 'memory_report.txt')
+        with open(text_path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        with open(os.path.join(output_dir, 'memory_report.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+        sys.stdout.write('\n')
+        print(text)
+        return text_path
+
+
+class CpuProfiler:
+    '''
+    Opt-in sampling CPU profiler of every thread of the process
+
+    Every CPU_SAMPLE_INTERVAL seconds the stacks of all threads are read (sys._current_frames). Each stack is weighted by
+    the CPU time its thread consumed since the previous sample (per-thread CPU clocks on Linux), so threads waiting on
+    a queue, a lock, a rate limit or a socket cost nothing; where those clocks are missing every sample weighs one
+    interval. Stacks are charged to the stage entered by their thread (stage()), or else to the innermost
+    STAGE_FUNCTIONS function on the stack. Nothing is traced: the overhead is one stack walk per thread per sample.
+
+    Outputs (write_report)
+    ------
+    cpu.collapsed: one 'stage;outer frame;...;inner frame microseconds' line per stack, readable by flamegraph.pl,
+                   inferno, speedscope
+    cpu_report.txt / cpu_report.json: CPU time per stage, self and cumulative time per function
+
+    Usage
+    -----
+    profiler = CpuProfiler()
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.write_report()
+    '''
+    def __init__(self, interval: float = CPU_SAMPLE_INTERVAL, top_n: int = PROFILE_TOP_N):
+        self.interval = interval
+        self.top_n = top_n
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.start_time = 0.0
+        self.duration = 0.0
+        self.samples = 0
+
+        self.stacks = Counter()        # (stage, frame labels from outermost to innermost) -> microseconds
+        self.labels = {}               # id(code) -> (code, label), the code object is kept so its id is never reused
+        self.cpu_times = {}            # thread ident -> CPU time at the previous sample
+        self.per_thread_clock = hasattr(time, 'pthread_getcpuclockid')
+
+    def label_of(self, code) -> str:
+        entry = self.labels.get(id(code))
+        if entry is None:
+            entry = self.labels[id(code)] = (code, f'{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})')
+        return entry[1]
+
+    def thread_cpu_time(self, ident: int) -> float | None:
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (OSError, OverflowError):
+            return None
+
+    def sample(self):
+        own_ident = threading.get_ident()
+        frames = sys._current_frames()
+        seen = set()
+
+        for ident, frame in frames.items():
+            if ident == own_ident:
+                continue
+            seen.add(ident)
+
+            if self.per_thread_clock:
+                cpu_time = self.thread_cpu_time(ident)
+                if cpu_time is None:
+                    continue
+                previous = self.cpu_times.get(ident)
+                self.cpu_times[ident] = cpu_time
+                if previous is None:
+                    continue
+                weight = int((cpu_time - previous) * 1_000_000)
+                if weight <= 0:
+                    continue
+            else:
+                weight = int(self.interval * 1_000_000)
+
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+
+            stack = thread_stages.get(ident)
+            name = stack[-1] if stack else None
+            if name is None:
+                name = next((FUNCTION_STAGES[code.co_name] for code in codes if code.co_name in FUNCTION_STAGES), OTHER)
+
+            self.stacks[(name, tuple(self.label_of(code) for code in reversed(codes)))] += weight
+
+        # forget finished threads, their ident may be reused
+        for ident in list(self.cpu_times):
+            if ident not in seen:
+                del self.cpu_times[ident]
+
+        self.samples += 1
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][CpuProfiler][sample]: {e}')
+
+    def start(self):
+        self.start_time = time.time()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='cpu-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.duration = time.time() - self.start_time
+
+    def write_collapsed(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for (name, labels), weight in sorted(self.stacks.items()):
+                # 'function (file:line)' -> 'function@file:line': flamegraph frames cannot contain spaces
+                frames = (label.replace(' (', '@').rstrip(')') for label in labels)
+                f.write(';'.join((name, *frames)) + f' {weight}\n')
+
+    def report(self) -> dict:
+        stage_times = Counter()
+        self_times = defaultdict(Counter)
+        cumulative_times = defaultdict(Counter)
+
+        for (name, labels), weight in self.stacks.items():
+            stage_times[name] += weight
+            if labels:
+                self_times[name][labels[-1]] += weight
+            for label in set(labels):   # a recursive function is counted once per stack
+                cumulative_times[name][label] += weight
+
+        def table(name: str) -> list:
+            return [
+                {'function': label, 'cumulative_ms': cumulative / 1000, 'self_ms': self_times[name][label] / 1000}
+                for label, cumulative in cumulative_times[name].most_common(self.top_n)
+            ]
+
+        total_self = Counter()
+        for counter in self_times.values():
+            total_self.update(counter)
+
+        return {
+            'weighting': 'thread CPU time' if self.per_thread_clock else 'wall time',
+            'interval': self.interval,
+            'samples': self.samples,
+            'duration': self.duration,
+            'stages': {name: {'cpu_ms': weight / 1000, 'functions': table(name)} for name, weight in stage_times.most_common()},
+            'top_self': [{'function': label, 'self_ms': weight / 1000} for label, weight in total_self.most_common(self.top_n)],
+        }
+
+    def format_report(self, report: dict) -> str:
+        total = sum(record['cpu_ms'] for record in report['stages'].values())
+        lines = [
+            f"[CPU] {report['samples']} samples every {report['interval'] * 1000:.0f} ms over {report['duration']:.1f}s, "
+            f"{total / 1000:.2f}s of {report['weighting']}",
+            f"{'stage':<12}{'CPU':>12}{'share':>8}",
+        ]
+        for name, record in report['stages'].items():
+            share = record['cpu_ms'] / total * 100 if total else 0
+            lines.append(f"{name:<12}{record['cpu_ms'] / 1000:>10.2f} s{share:>7.1f}%")
+
+        lines.append('')
+        lines.append('[CPU] top functions by self time')
+        for row in report['top_self']:
+            lines.append(f"  {row['self_ms']:>10.1f} ms  {row['function']}")
+
+        for name, record in report['stages'].items():
+            lines.append('')
+            lines.append(f'[CPU][{name}] {"cumulative":>10} {"self":>10}')
+            for row in record['functions']:
+                lines.append(f"  {row['cumulative_ms']:>10.1f} ms {row['self_ms']:>7.1f} ms  {row['function']}")
+
+        return '\n'.join(lines)
+
+    def write_report(self, output_dir: str = PROFILE_DIR) -> str:
+        '''
+        Print the per-stage report and write cpu.collapsed, cpu_report.txt and cpu_report.json to output_dir
+
+        Return
+        ------
+        str
+            path of the collapsed-stack file (e.g. `flamegraph.pl Profile/cpu.collapsed > cpu.svg`)
+        '''
+        report = self.report()
+        text = self.format_report(report)
+
+        os.makedirs(output_dir, exist_ok=True)
+        collapsed_path = os.path.join(output_dir, 'cpu.collapsed')
+        self.write_collapsed(collapsed_path)
+        with open(os.path.join(output_dir, 'cpu_report.txt'), 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        with open(os.path.join(output_dir, 'cpu_report.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+        sys.stdout.write('\n')
+        print(text)
+        return collapsed_path
@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from collections import deque
+
+from config import ARXIV_RATE_LIMIT, SEMANTIC_RATE_LIMIT, RATE_BROKER_SOCKET, RATE_BROKER_TIMEOUT
+
+try:
+    import fcntl
+except ImportError:     # Windows: no broker, every process keeps its own limits
+    fcntl = None
+
+# Protocol: one JSON object per line over a Unix socket, one connection per client thread
+#   {"op": "acquire", "host": "arxiv", "client": "1234", "label": "..."}  ->  {"ok": true} once the token is granted
+#   {"op": "status"}                                                       ->  {"hosts": {...}, "clients": {...}}
+INTERVALS = {'arxiv': ARXIV_RATE_LIMIT, 'semantic': SEMANTIC_RATE_LIMIT}
+# Absolute and independent of the working directory: every process of the user meets the same broker
+SOCKET_PATH = os.path.abspath(os.path.expanduser(RATE_BROKER_SOCKET))
+
+
+def is_supported() -> bool:
+    return fcntl is not None and hasattr(socket, 'AF_UNIX')
+
+
+class Bucket:
+    '''
+    Tokens of one upstream host, one every `interval` seconds, handed out round-robin between the client processes
+
+    A process running 10 download threads gets the same share as a process running 1 while both are waiting
+    '''
+    def __init__(self, host: str, interval: float):
+        self.host = host
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.waiting = {}           # client -> deque of tickets
+        self.order = deque()        # clients with waiting tickets, next served on the left
+        self.granted = {}           # client -> tokens granted
+        self.next_slot = 0.0
+
+    def acquire(self, client: str, is_alive=None) -> bool:
+        '''
+        Wait for a token, giving the ticket up when is_alive() turns False (the client disconnected)
+        '''
+        ticket = [False]
+
+        with self.cond:
+            if client not in self.waiting:
+                self.waiting[client] = deque()
+                self.order.append(client)
+            self.waiting[client].append(ticket)
+            self.cond.notify_all()
+
+            while not ticket[0]:
+                self.cond.wait(timeout=0.5)
+
+                if not ticket[0] and is_alive is not None and not is_alive():
+                    self.waiting[client].remove(ticket)
+                    return False
+
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.order:
+                    self.cond.wait()
+
+            delay = self.next_slot - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.cond:
+                client = self.order.popleft()
+                tickets = self.waiting[client]
+                if not tickets:
+                    # Its waiters disconnected: no token spent
+                    del self.waiting[client]
+                    continue
+                tickets.popleft()[0] = True
+
+                if tickets:
+                    self.order.append(client)
+                else:
+                    del self.waiting[client]
+
+                self.granted[client] = self.granted.get(client, 0) + 1
+                self.next_slot = time.time() + self.interval
+                self.cond.notify_all()
+
+    def status(self) -> dict:
+        with self.cond:
+            return {
+                'interval': self.interval,
+                'granted': dict(self.granted),
+                'waiting': {client: len(tickets) for client, tickets in self.waiting.items()},
+                'backlog': max(0.0, self.next_slot - time.time()),
+            }
+
+
+class RateBroker:
+    '''
+    Host-local broker of the request budget of every upstream, shared by the scraper processes of the machine
+
+    The first process that needs a token and finds no broker becomes the broker (it holds the lock file for its lifetime,
+    so a crashed broker is replaced by the next process that notices). `python rate_broker.py serve` runs it on its own.
+    '''
+    def __init__(self, path: str = SOCKET_PATH, intervals: dict = INTERVALS):
+        self.path = path
+        self.buckets = {host: Bucket(host, interval) for host, interval in intervals.items()}
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.lock_file = None
+        self.server = None
+
+    def try_start(self) -> bool:
+        '''
+        Become the broker of the machine unless another process already is
+
+        Return
+        ------
+        bool
+            True when this process now serves the socket
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(f'{self.path}.lock', 'w')
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        # Holding the lock: any socket file left is stale
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.lock_file = lock_file
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(64)
+
+        for bucket in self.buckets.values():
+            threading.Thread(target=bucket.run, daemon=True).start()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        return True
+
+    def accept_loop(self):
+        while True:
+            connection, _ = self.server.accept()
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def is_connected(connection) -> bool:
+        '''
+        Check, without blocking, that the client did not close its side (clients send nothing while they wait)
+        '''
+        try:
+            return connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def handle(self, connection):
+        try:
+            with connection, connection.makefile('rwb') as stream:
+                for line in stream:
+                    try:
+                        message = json.loads(line)
+
+                        if message['op'] == 'acquire':
+                            with self.lock:
+                                self.clients[message['client']] = {'label': message.get('label', ''), 'seen': time.time()}
+                            if not self.buckets[message['host']].acquire(message['client'], lambda: self.is_connected(connection)):
+                                return
+                            reply = {'ok': True}
+                        elif message['op'] == 'status':
+                            reply = self.status()
+                        else:
+                            reply = {'ok': False, 'error': f"unknown op {message['op']}"}
+                    except (ValueError, KeyError) as e:
+                        reply = {'ok': False, 'error': str(e)}
+
+                    stream.write(json.dumps(reply).encode() + b'\n')
+                    stream.flush()
+        except OSError:
+            # The client went away (BrokenPipe, ConnectionReset): its connection is simply closed
+            pass
+
+    def status(self) -> dict:
+        with self.lock:
+            clients = {client: dict(info) for client, info in self.clients.items()}
+        return {
+            'broker': os.getpid(),
+            'hosts': {host: bucket.status() for host, bucket in self.buckets.items()},
+            'clients': clients,
+        }
+
+
+class BrokerClient:
+    '''
+    Token requests of this process to the broker, over one connection per thread
+
+    Usage
+    -----
+    if not BROKER_CLIENT.acquire('arxiv'):
+        ...   # no broker available: fall back to the local limiter
+    '''
+    def __init__(self, path: str = SOCKET_PATH):
+        self.path = path
+        self.client = str(os.getpid())
+        self.label = ' '.join(os.path.basename(arg) if i == 0 else arg for i, arg in enumerate(sys.argv))[:80]
+        self.local = threading.local()
+        self.broker = None
+        self.lock = threading.Lock()
+        self.warned = False
+
+    def _connection(self):
+        stream = getattr(self.local, 'stream', None)
+        if stream is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(RATE_BROKER_TIMEOUT)
+            try:
+                connection.connect(self.path)
+            except OSError:
+                connection.close()
+                raise
+            stream = self.local.stream = connection.makefile('rwb')
+            self.local.connection = connection
+        return stream
+
+    def _drop_connection(self):
+        for name in ('stream', 'connection'):
+            resource = getattr(self.local, name, None)
+            if resource is not None:
+                resource.close()
+                setattr(self.local, name, None)
+
+    def _request(self, message: dict) -> dict:
+        stream = self._connection()
+        stream.write(json.dumps(message).encode() + b'\n')
+        stream.flush()
+
+        line = stream.readline()
+        if not line:
+            raise ConnectionError('the rate broker closed the connection')
+        return json.loads(line)
+
+    def ensure_broker(self):
+        '''
+        Start a broker in this process if no process serves the socket
+        '''
+        with self.lock:
+            if self.broker is None:
+                broker = RateBroker(self.path)
+                if broker.try_start():
+                    self.broker = broker
+
+    def acquire(self, host: str) -> bool:
+        '''
+        Wait for a token of `host`
+
+        Return
+        ------
+        bool
+            False when no broker can be reached or no token came within RATE_BROKER_TIMEOUT
+            (the caller uses its local limiter)
+        '''
+        for attempt in range(3):
+            try:
+                return self._request({'op': 'acquire', 'host': host, 'client': self.client, 'label': self.label})['ok']
+            except TimeoutError:
+                # The broker is alive but its backlog is too long: this request falls back, the ticket is given up
+                self._drop_connection()
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][BrokerClient][acquire]: no {host} token within {RATE_BROKER_TIMEOUT}s, using the limits of this process')
+                return False
+            except (OSError, ValueError, ConnectionError):
+                self._drop_connection()
+                self.ensure_broker()
+                # Another process holds the lock: its broker is starting or just crashed and is being replaced
+                time.sleep(0.05 * attempt)
+
+        if not self.warned:
+            self.warned = True
+            sys.stdout.write('\n')
+            print(f'[EXCEPTION][BrokerClient][acquire]: no rate broker at {self.path}, using the limits of this process only')
+        return False
+
+
+def read_status(path: str = SOCKET_PATH) -> dict | None:
+    '''
+    Status of the broker serving `path`, None when none is running
+    '''
+    if not is_supported():
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(2)
+            connection.connect(path)
+            with connection.makefile('rwb') as stream:
+                stream.write(b'{"op": "status"}\n')
+                stream.flush()
+                return json.loads(stream.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def print_status(status: dict | None, path: str = SOCKET_PATH):
+    if status is None:
+        print(f'- rate broker: none at {path}')
+        return
+
+    print(f"- rate broker: process {status['broker']}, {len(status['clients'])} client process(es)")
+    for host, bucket in status['hosts'].items():
+        granted = ', '.join(f'{client}: {count}' for client, count in sorted(bucket['granted'].items())) or 'none'
+        waiting = sum(bucket['waiting'].values())
+        print(f"  {host}: one token every {bucket['interval']}s, {waiting} waiting, "
+              f"backlog {bucket['backlog']:.1f}s, granted {granted}")
+    for client, info in sorted(status['clients'].items()):
+        print(f"  {client}: {info['label']} (last request {time.time() - info['seen']:.0f}s ago)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Share the arXiv and Semantic Scholar request budgets between '
+                                                 'the scraper processes of this machine')
+    parser.add_argument('command', choices=['serve', 'status'])
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    args = parser.parse_args(argv)
+    args.socket = os.path.abspath(os.path.expanduser(args.socket))
+
+    if not is_supported():
+        print('The rate broker needs Unix sockets and fcntl (not available on this platform)')
+        return 1
+
+    if args.command == 'status':
+        print_status(read_status(args.socket), args.socket)
+        return
+
+    broker = RateBroker(args.socket)
+    if not broker.try_start():
+        print(f'A broker already serves {args.socket}')
+        return 1
+
+    print(f'Serving {args.socket} (Ctrl+C to stop)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import os
+import json
+import threading
+
+from layout import get_paper_dir, get_paper_folder_name
+from saving import has_saved_output
+from validator_store import VALIDATOR_STORE
+from negative_cache import NEGATIVE_CACHE
+from utils import split_version_id, get_id_from_arxiv_link
+
+
+class LocalVersions:
+    '''
+    Versions of each paper already saved or recorded locally, for refresh runs that only fetch what changed upstream
+
+    A paper is known up to version k when every enabled stage has versions 1..k:
+        'sources': the version is on disk in the current storage mode, or its download is recorded
+                   (validator store with a size, or negative cache: PDF-only, withdrawn, oversized...)
+        'metadata': metadata.json lists k revised dates
+        'references': references.json exists (resolved at the version known by the other stages, or at the latest
+                      version when it is the only output of the paper)
+
+    Usage
+    -----
+    local = LocalVersions(stages)
+    known = local.known('2306.14505', latest=3)   # 2: only v3 is new
+    '''
+    def __init__(self, stages, save_root: str = './Save'):
+        self.stages = list(stages)
+        self.save_root = save_root
+        self.lock = threading.Lock()
+        self.counts = {'unchanged': 0, 'revised': 0, 'new': 0}
+
+    def known_sources(self, paper_id: str, latest: int, save_path: str) -> int:
+        folder_name = get_paper_folder_name(paper_id)
+
+        for version in range(1, latest + 1):
+            yyyymm_idv = f'{folder_name}v{version}'
+            record = VALIDATOR_STORE.get(yyyymm_idv)
+
+            if record is not None and 'size' in record:
+                continue
+            if os.path.isdir(save_path) and has_saved_output(save_path, yyyymm_idv):
+                continue
+            if NEGATIVE_CACHE.get('eprint', yyyymm_idv) is not None:
+                continue
+            return version - 1
+
+        return latest
+
+    def known_metadata(self, paper_dir: str) -> int:
+        try:
+            with open(os.path.join(paper_dir, 'metadata.json'), encoding='utf-8') as f:
+                return len(json.load(f).get('revised_date', []))
+        except (OSError, ValueError, AttributeError):
+            return 0
+
+    def known_references(self, paper_dir: str, latest: int, known_elsewhere: int) -> int:
+        if not os.path.exists(os.path.join(paper_dir, 'references.json')):
+            return 0
+        # references.json does not record its version: it was resolved at the version the other outputs know,
+        # or at the latest one when it is the only output (references-only runs)
+        return known_elsewhere or latest
+
+    def known(self, paper_id: str, latest: int) -> int:
+        '''
+        Number of versions of a paper every enabled stage already has (0 for a paper never saved)
+
+        Parameters
+        ----------
+        paper_id: str
+            paper's ID without version (format: 'xxxx.xxxxx')
+        latest: int
+            latest version found by the discovery
+
+        Return
+        ------
+        int
+            k: versions 1..k are up to date locally, versions k+1..latest have to be fetched
+        '''
+        paper_dir = get_paper_dir(paper_id, self.save_root)
+        known = {
+            'sources': self.known_sources(paper_id, latest, os.path.join(paper_dir, 'tex')),
+            'metadata': self.known_metadata(paper_dir),
+        }
+        known['references'] = self.known_references(paper_dir, latest, max(known['sources'], known['metadata']))
+
+        result = min(min((known[stage] for stage in self.stages), default=0), latest)
+
+        with self.lock:
+            if result == latest:
+                self.counts['unchanged'] += 1
+            elif result > 0:
+                self.counts['revised'] += 1
+            else:
+                self.counts['new'] += 1
+
+        return result
+
+    def trim(self, paper_dict_list: list[dict]) -> list[dict]:
+        '''
+        Keep the papers with new versions, each with only its new versions (for discoveries that return every version,
+        e.g. OAI-PMH)
+
+        Return
+        ------
+        list of dictionary
+            [{'id': 'xxxx.xxxxx', 'versions': [new versions], 'known': k}, ...]
+        '''
+        result = []
+
+        for paper_dict in paper_dict_list:
+            if not paper_dict['versions']:
+                continue
+
+            _, latest = split_version_id(get_id_from_arxiv_link(paper_dict['versions'][-1].entry_id, True))
+            known = self.known(paper_dict['id'], latest or len(paper_dict['versions']))
+
+            new_versions = [
+                paper for paper in paper_dict['versions']
+                if (split_version_id(get_id_from_arxiv_link(paper.entry_id, True))[1] or 0) > known
+            ]
+            if new_versions:
+                result.append({'id': paper_dict['id'], 'versions': new_versions, 'known': known})
+
+        return result
+
+    def summary(self) -> str:
+        return (f"{self.counts['unchanged']} papers unchanged, {self.counts['revised']} revised, "
+                f"{self.counts['new']} new")
@@ -5,11 +5,26 @@ import json
 import tarfile
 import sys
 import time
-import requests
 import gzip
+import re
+import zlib
+import tempfile
 
 from utils import get_id_from_arxiv_link, get_folder_size
-from config import ARXIV_RATE_LIMIT, ARXIV_DELAY_LOCK, arxiv_last_request_time
+from config import ARXIV_RATE_LIMIT, STORAGE_MODE, REQUEST_TIMEOUT, DOWNLOAD_DEADLINE, LARGE_SOURCE_SIZE, MAX_SOURCE_SIZE
+from validator_store import VALIDATOR_STORE
+from negative_cache import NEGATIVE_CACHE
+from network import RATE_LIMITERS, get_session
+from circuit_breaker import BREAKERS, ThrottledError
+from storage import ALLOWED_EXTS, archive_source, is_archived, get_archived_size, get_archive_paths, compress_source, get_compressed_sizes
+from layout import get_paper_dir
+from group_writer import write_files_atomic, dump_json
+from task_watchdog import TaskStalled, heartbeat, check_cancelled
+from profiling import stage
+
+NOT_MODIFIED = 'not-modified'
+OUTPUT_FILES = {'metadata': 'metadata.json', 'references': 'references.json'}
+CHUNK_SIZE = 1 << 16
 
 def remove_figures(folder_path: str):
     '''
@@ -33,23 +48,216 @@ def remove_figures(folder_path: str):
             if ext not in allowed_exts:
                 os.remove(item_path)  
 
-def download_zip_file(paper_id: str, save_dir: str):
+def has_extracted_output(extract_dir: str) -> bool:
+    '''
+    Check whether a version has already been extracted (the folder exists and is not empty)
+
+    Versions are extracted into '<folder>.tmp' and renamed once complete, so an existing folder is never partial
+    '''
+    try:
+        with os.scandir(extract_dir) as entries:
+            return any(True for _ in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+class SourceTooLarge(Exception):
+    '''
+    Raised when an e-print goes past MAX_SOURCE_SIZE while it is being read
+    '''
+
+
+class CappedStream:
+    '''
+    Read-only file object over a download body: counts the bytes, stops at a cap and enforces the deadline
+
+    The first chunk is read ahead (`head`) to sniff the file type before anything is written
+    '''
+    def __init__(self, raw, paper_id: str, limit: int, deadline: float):
+        self.raw = raw
+        self.paper_id = paper_id
+        self.limit = limit
+        self.deadline = deadline
+        self.downloaded = 0
+        self.head = self._read_raw(CHUNK_SIZE)
+        self.pending = self.head
+
+    def _read_raw(self, size: int) -> bytes:
+        chunk = self.raw.read(size)
+        self.downloaded += len(chunk)
+
+        if self.downloaded > self.limit:
+            raise SourceTooLarge(f"e-print {self.paper_id} is larger than {self.limit} bytes")
+        # REQUEST_TIMEOUT only bounds the silence between two packets: a source trickling in
+        # is stopped by the overall deadline, a cancelled task between two chunks
+        if time.time() > self.deadline:
+            raise TimeoutError(f"e-print {self.paper_id} not downloaded within {DOWNLOAD_DEADLINE}s")
+        check_cancelled()
+        heartbeat()
+
+        return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        return self._read_raw(size)
+
+
+def is_tar_gz(head: bytes) -> bool:
+    '''
+    Check whether the first bytes of a gzip stream start with a tar header
+    '''
+    try:
+        block = zlib.decompressobj(zlib.MAX_WBITS | 16).decompress(head, tarfile.BLOCKSIZE)
+        tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape')
+        return True
+    except (zlib.error, tarfile.HeaderError):
+        return False
+
+
+def filter_tar_stream(stream: CappedStream, dest_path: str) -> dict:
+    '''
+    Copy the '.tex'/'.bib' members of a streamed tarball into a small '.tar.gz', skipping the others as they go by
+
+    Reading stops at the cap of the stream: the members read completely so far are kept, the member being read
+    is dropped, and the output is always a complete archive. Each kept member is buffered (spilled to a temp file
+    when large) before it is added, so a member cut by the cap never reaches the output.
+
+    Return
+    ------
+    dict
+        'unpacked' (bytes of every member seen), 'kept' (members copied), 'truncated' (cap reached)
+    '''
+    info = {'unpacked': 0, 'kept': 0, 'truncated': False}
+
+    with tarfile.open(dest_path, 'w:gz') as tar_out:
+        try:
+            with tarfile.open(fileobj=stream, mode='r|gz') as tar_in:
+                for member in tar_in:
+                    info['unpacked'] += member.size
+                    if member.isfile() and os.path.splitext(member.name)[1] in ALLOWED_EXTS:
+                        with tempfile.SpooledTemporaryFile(max_size=LARGE_SOURCE_SIZE) as buffer:
+                            shutil.copyfileobj(tar_in.extractfile(member), buffer, CHUNK_SIZE)
+                            buffer.seek(0)
+                            tar_out.addfile(member, buffer)
+                        info['kept'] += 1
+        except SourceTooLarge:
+            info['truncated'] = True
+
+    return info
+
+
+def is_oversized(download_info: dict) -> bool:
+    '''
+    Check whether a filtered download was larger than LARGE_SOURCE_SIZE or stopped at MAX_SOURCE_SIZE
+    '''
+    return bool(download_info) and (download_info['truncated'] or download_info['downloaded'] > LARGE_SOURCE_SIZE)
+
+
+def download_zip_file(paper_id: str, save_dir: str, headers: dict | None = None, download_info: dict | None = None):
+    '''
+    Download the e-print source of one version
+
+    A PDF is recognized from its first chunk and not downloaded. A tarball larger than LARGE_SOURCE_SIZE
+    (or without Content-Length) is filtered while it streams, and no e-print is read past MAX_SOURCE_SIZE
+
+    Parameters
+    ----------
+    paper_id: str
+        version's ID (format: 'xxxx-xxxxxvx')
+    save_dir: str
+        folder to save the downloaded file
+    headers: dict
+        optional conditional headers (If-None-Match / If-Modified-Since)
+    download_info: dict
+        optional, filled with 'content_length', 'downloaded', 'unpacked' and 'truncated' when the source was large
+
+    Return
+    ------
+    str or None
+        path of the downloaded file, '' when there is no source to extract (PDF only, deleted or oversized),
+        NOT_MODIFIED when the server answered 304, None on other HTTP errors
+
+    Raise
+    -----
+    ThrottledError
+        when the server answered 429 or 503
+    TimeoutError
+        when the download did not finish within DOWNLOAD_DEADLINE seconds
+    TaskStalled
+        when the watchdog cancelled the download
+    '''
     url = f"https://arxiv.org/e-print/{paper_id.replace('-', '.')}"
     os.makedirs(save_dir, exist_ok=True)
     
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
+    response = get_session().get(url, stream=True, headers=headers or {}, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        return NOT_MODIFIED
+    elif response.status_code == 200:
         temp_path = os.path.join(save_dir, f"{paper_id}.tmp")
+
+        content_length = response.headers.get('Content-Length', '')
+        content_length = int(content_length) if content_length.isdigit() else None
+        is_large = content_length is None or content_length > LARGE_SOURCE_SIZE
+        filtered = None
         
-        with open(temp_path, "wb") as f:
-            shutil.copyfileobj(response.raw, f)
-        
-        with open(temp_path, "rb") as f:
-            magic = f.read(4)
+        try:
+            stream = CappedStream(response.raw, paper_id, MAX_SOURCE_SIZE, time.time() + DOWNLOAD_DEADLINE)
+            magic = stream.head[:4]
+
+            if magic[:2] == b'%P':  # PDF file (%PDF): nothing to extract, the rest is not downloaded
+                response.close()
+            elif is_large and magic[:2] == b'\x1f\x8b' and is_tar_gz(stream.head):
+                filtered = filter_tar_stream(stream, temp_path)
+                response.close()
+            else:
+                with open(temp_path, "wb") as f:
+                    while chunk := stream.read(CHUNK_SIZE):
+                        f.write(chunk)
+        except SourceTooLarge:
+            # Not a tarball (or a lying Content-Length): nothing usable was read
+            response.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            filtered = {'unpacked': 0, 'kept': 0, 'truncated': True}
+        except BaseException:
+            response.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        if filtered is not None and download_info is not None:
+            download_info.update(content_length=content_length, downloaded=stream.downloaded,
+                                 unpacked=filtered['unpacked'], truncated=filtered['truncated'])
+
+        if filtered is not None and filtered['truncated'] and filtered['kept'] == 0:
+            kind = 'oversized'
+        else:
+            kind = 'pdf' if magic[:2] == b'%P' else 'source'
+
+        VALIDATOR_STORE.update(
+            paper_id,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            content_length=content_length if content_length is not None else stream.downloaded,
+            kind=kind
+        )
         
-        if magic[:2] == b'%P':  # PDF file (%PDF)
-            os.remove(temp_path)
+        if kind == 'pdf':
+            NEGATIVE_CACHE.add('eprint', paper_id, 'pdf_only')
+            return ''
+        elif kind == 'oversized':
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            sys.stdout.write('\n')
+            print(f"{paper_id} is oversized: no .tex/.bib within the first {stream.downloaded} bytes")
+            NEGATIVE_CACHE.add('eprint', paper_id, 'oversized')
             return ''
+        elif filtered is not None:
+            ext = '.tar.gz'
         elif magic[:2] == b'\x1f\x8b':  # gzip magic number
             if tarfile.is_tarfile(temp_path):
                 ext = '.tar.gz'
@@ -60,118 +268,230 @@ def download_zip_file(paper_id: str, save_dir: str):
         os.rename(temp_path, dest_path)
         
         return dest_path
+    elif response.status_code in (429, 503):
+        raise ThrottledError(f"HTTP {response.status_code} for e-print {paper_id}")
     elif response.status_code == 404:
         sys.stdout.write('\n')
         print(f"{paper_id} has been deleted! (404 NOT FOUND)")
+        NEGATIVE_CACHE.add('eprint', paper_id, 'deleted')
         return ''
     else:
         sys.stdout.write('\n')
         print(f"[Exception][download_zip_file]: Failed to download {paper_id}: HTTP {response.status_code}")
         return None
 
+def extract_source(source_path: str, extract_dir: str) -> tuple[int, int]:
+    '''
+    Extract a downloaded '.tar.gz' / '.gz' source into a folder and remove its figures
+
+    Return
+    ------
+    tuple of int
+        (folder size before removing figures, folder size after removing figures) in bytes
+    '''
+    # Extracted into a temporary folder renamed once complete: a failed extraction never looks like a saved version
+    temp_dir = extract_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    try:
+        if source_path.endswith('.tar.gz'):
+            if tarfile.is_tarfile(source_path):
+                with tarfile.open(source_path, "r:gz") as tar:
+                    tar.extractall(path=temp_dir)
+
+        else:
+            with gzip.open(source_path, 'rb') as f_in:
+                file_name = getattr(f_in, 'name', None)
+                
+                if not file_name:
+                    file_name = os.path.basename(source_path)[:-3]
+                    
+                file_name = os.path.splitext(os.path.basename(file_name))[0]
+
+                output_path = os.path.join(temp_dir, file_name + '.tex')
+                
+                with open(output_path, "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+        #Remove figures
+        paper_size_before = get_folder_size(temp_dir)
+        remove_figures(temp_dir)
+        paper_size_after = get_folder_size(temp_dir)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    os.replace(temp_dir, extract_dir)
+    os.remove(source_path)
+
+    return paper_size_before, paper_size_after
+
+def has_saved_output(save_path: str, yyyymm_idv: str) -> bool:
+    '''
+    Check whether the source of a version is already on disk in the current storage mode
+
+    In archive mode, a version extracted before the corpus switched to STORAGE_MODE = 'archive' counts as saved too
+    '''
+    if STORAGE_MODE == 'archive' and is_archived(save_path, yyyymm_idv):
+        return True
+    return has_extracted_output(os.path.join(save_path, yyyymm_idv))
+
+def get_cached_paper_size(yyyymm_idv: str, save_path: str, report_size: bool = False) -> dict:
+    '''
+    Build the size report of a version that was skipped because it is already on disk or unchanged upstream
+    '''
+    if not report_size:
+        return {}
+
+    record = VALIDATOR_STORE.get(yyyymm_idv) or {}
+    size = record.get('size')
+
+    if size is None:
+        if STORAGE_MODE == 'archive' and is_archived(save_path, yyyymm_idv):
+            after = get_archived_size(save_path, yyyymm_idv)
+            size = {"before": after, "after": after, "compressed": os.path.getsize(get_archive_paths(save_path, yyyymm_idv)[0])}
+        elif STORAGE_MODE == 'zstd':
+            after, compressed = get_compressed_sizes(save_path, yyyymm_idv)
+            size = {"before": after, "after": after, "compressed": compressed}
+        else:
+            after = get_folder_size(os.path.join(save_path, yyyymm_idv))
+            size = {"before": after, "after": after}
+
+    return {'id': yyyymm_idv, 'size': dict(size), 'cached': True}
+
+def is_withdrawn(paper: arxiv.Result) -> bool:
+    '''
+    Check whether a version has been withdrawn, from the comment arXiv attaches to withdrawn versions
+    '''
+    comment = getattr(paper, 'comment', None) or ''
+    return re.search(r'\b(paper|article|submission|version) (has been|is) withdrawn\b', comment, re.IGNORECASE) is not None
+
 def save_one_tex(paper: arxiv.Result, save_root: str = "./Save", report_size: bool = False, retry_times:int=3):
     """
     Download all available versions of a paper given yyyymm-id (e.g., '2306-14525').
     """
 
-    global arxiv_last_request_time
-
     #Download the tar.gz
     yyyymm_idv = get_id_from_arxiv_link(paper.entry_id, True)
     base_id = get_id_from_arxiv_link(paper.entry_id, False)
     
     yyyymm_idv, base_id = yyyymm_idv.replace('.', '-'), base_id.replace('.', '-')
 
-    save_path = os.path.join(save_root, base_id, "tex")
+    save_path = os.path.join(get_paper_dir(base_id, save_root), "tex")
     os.makedirs(save_path, exist_ok=True)
-    
+    extract_dir = os.path.join(save_path, yyyymm_idv)
+
+    # A version's source never changes, so a saved version is never requested again
+    if has_saved_output(save_path, yyyymm_idv):
+        return get_cached_paper_size(yyyymm_idv, save_path, report_size)
+
+    reason = NEGATIVE_CACHE.get('eprint', yyyymm_idv)
+    if reason is None and is_withdrawn(paper):
+        reason = 'withdrawn'
+        NEGATIVE_CACHE.add('eprint', yyyymm_idv, reason)
+
+    if reason is not None:
+        return {'id': yyyymm_idv, 'size': {"before": 0, "after": 0}, 'skipped': reason}
+
+    headers = VALIDATOR_STORE.conditional_headers(yyyymm_idv)
     dest_path = None
+    download_info = {}
 
-    for attempt in range(1, retry_times + 1):
-        with ARXIV_DELAY_LOCK:
-            time_since_last = time.time() - arxiv_last_request_time
-            
-            if time_since_last < ARXIV_RATE_LIMIT:
-                time.sleep(ARXIV_RATE_LIMIT - time_since_last)
-                
-            arxiv_last_request_time = time.time()
+    breaker = BREAKERS['eprint']
+    attempt = 0
+
+    while attempt < retry_times:
+        breaker.before_request()
+        
+        RATE_LIMITERS['arxiv'].wait()
         
         try:
-            dest_path = download_zip_file(paper_id=yyyymm_idv, save_dir=save_path)
+            dest_path = download_zip_file(paper_id=yyyymm_idv, save_dir=save_path, headers=headers, download_info=download_info)
+            breaker.record_success()
             break
 
+        except TaskStalled:
+            raise
+
         except Exception as e:
-            if '429' in str(e):
-                sys.stdout.write('\n')
-                print(f'429: Request too many times. Attempt {attempt}')
-            else:
+            if breaker.record_error(e):
+                # Throttled: the version waits for the circuit instead of spending its retry budget
                 sys.stdout.write('\n')
-                print(f'[EXCEPTION][save_one_tex][download_source]: {e}.')
+                print(f'429: Request too many times. {yyyymm_idv} parked until e-print host recovers')
+                continue
+            
+            attempt += 1
+            sys.stdout.write('\n')
+            print(f'[EXCEPTION][save_one_tex][download_source]: {e}.')
             
             if attempt == retry_times:
                 return {}
             
             time.sleep(ARXIV_RATE_LIMIT)
 
-    if dest_path is not None and dest_path != '':
-        #Extract the tar file
-        extract_dir = os.path.join(save_path, yyyymm_idv)
-        os.makedirs(extract_dir, exist_ok=True)
+    if dest_path == NOT_MODIFIED:
+        return get_cached_paper_size(yyyymm_idv, save_path, report_size)
 
-        tar_path = os.path.join(save_path, f"{yyyymm_idv}.tar.gz")
-        gz_path = os.path.join(save_path, f"{yyyymm_idv}.gz")
-        
+    if dest_path is not None and dest_path != '':
         try:
-            if os.path.exists(tar_path):
-                if tarfile.is_tarfile(tar_path):
-                    with tarfile.open(tar_path, "r:gz") as tar:
-                        tar.extractall(path=extract_dir)
-                os.remove(tar_path)
-                        
-            else:
-                with gzip.open(gz_path, 'rb') as f_in:
-                    file_name = getattr(f_in, 'name', None)
-                    
-                    if not file_name:
-                        file_name = os.path.basename(gz_path)[:-3]
-                        
-                    file_name = os.path.splitext(os.path.basename(file_name))[0]
-
-                    output_path = os.path.join(extract_dir, file_name + '.tex')
-                    
-                    with open(output_path, "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                        
-                os.remove(gz_path)
+            with stage('extract'):
+                if STORAGE_MODE == 'archive':
+                    paper_size_before, paper_size_after = archive_source(dest_path, save_path, yyyymm_idv)
+                    size = {"before": paper_size_before, "after": paper_size_after,
+                            "compressed": os.path.getsize(get_archive_paths(save_path, yyyymm_idv)[0])}
+                elif STORAGE_MODE == 'zstd':
+                    paper_size_before, paper_size_after, paper_size_compressed = compress_source(dest_path, save_path, yyyymm_idv, save_root)
+                    size = {"before": paper_size_before, "after": paper_size_after, "compressed": paper_size_compressed}
+                else:
+                    paper_size_before, paper_size_after = extract_source(dest_path, extract_dir)
+                    size = {"before": paper_size_before, "after": paper_size_after}
         
         except Exception as e:
             sys.stdout.write('\n')
-            print(f"[EXCEPTION][save_one_tex][extract]: Failed to extract {tar_path}: {e}")
+            print(f"[EXCEPTION][save_one_tex][extract]: Failed to extract {dest_path}: {e}")
             return {}
 
-        #Remove figures
+        if download_info:
+            # Only the kept members reached the disk, 'before' is the size of every member that was streamed
+            size['before'] = max(size['before'], download_info['unpacked'])
+
+        VALIDATOR_STORE.update(yyyymm_idv, size=size)
+
         paper_size = {}
         if (report_size):
-            paper_size_before = get_folder_size(extract_dir)
-            remove_figures(extract_dir)
-            paper_size_after = get_folder_size(extract_dir)
-
             #Update paper_size
             paper_size['id'] = yyyymm_idv
-            paper_size['size'] = {"before": paper_size_before, "after": paper_size_after}
-        else:
-            remove_figures(extract_dir)
+            paper_size['size'] = dict(size)
+            if is_oversized(download_info):
+                paper_size['oversized'] = download_info
         return paper_size
     
     elif dest_path == '':
+        if VALIDATOR_STORE.get(yyyymm_idv) is not None:
+            VALIDATOR_STORE.update(yyyymm_idv, size={"before": 0, "after": 0})
+
         paper_size = {}
         paper_size['id'] = yyyymm_idv
         paper_size['size'] = {"before": 0, "after": 0}
+        if is_oversized(download_info):
+            paper_size['oversized'] = download_info
         return paper_size
 
     else:
         return {}
 
+def get_output_path(
+    id: str,
+    kind: str,
+    save_root="./Save",
+) -> str:
+    '''
+    Path of the metadata.json ('metadata') or references.json ('references') of a paper
+    '''
+    return os.path.join(get_paper_dir(id, save_root), OUTPUT_FILES[kind])
+
 def save_one_metadata(
     id: str, 
     metadata: dict, 
@@ -180,12 +500,23 @@ def save_one_metadata(
     if metadata == {}:
         return
     
-    save_dir = os.path.join(save_root, id.replace('.', '-'))
-    os.makedirs(save_dir, exist_ok=True)
+    # The pipeline writes through its GroupWriter, this is the one-off equivalent
+    error, = write_files_atomic([(get_output_path(id, 'metadata', save_root), dump_json(metadata))])
+    if error is not None:
+        raise error
 
-    save_path = os.path.join(save_dir, "metadata.json")
-    with open(save_path, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=4)
+def load_metadata(
+    id: str,
+    save_root="./Save",
+) -> dict | None:
+    '''
+    Read the saved metadata.json of a paper, None when it is missing or unreadable
+    '''
+    try:
+        with open(get_output_path(id, 'metadata', save_root), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
 def save_one_reference(
     id: str, 
@@ -195,9 +526,6 @@ def save_one_reference(
     if reference == {}:
         return
     
-    save_dir = os.path.join(save_root, id.replace('.', '-'))
-    os.makedirs(save_dir, exist_ok=True)
-
-    save_path = os.path.join(save_dir, "references.json")
-    with open(save_path, "w", encoding="utf-8") as f:
-        json.dump(reference, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+    error, = write_files_atomic([(get_output_path(id, 'references', save_root), dump_json(reference))])
+    if error is not None:
+        raise error
@@ -1,14 +1,28 @@
 import arxiv
-from datetime import timedelta
+from datetime import date, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+import threading
 import time
 import sys
 
-from utils import get_id_from_arxiv_link, display_progress, is_month_different, find_first_id, find_last_id
-from config import CLIENT, ARXIV_RATE_LIMIT, FETCHING_BATCH_SIZE, ARXIV_DELAY_LOCK, arxiv_last_request_time
+from utils import get_id_from_arxiv_link, display_progress, is_month_different, find_first_id, find_last_id, VersionGrouper, split_version_id
+from negative_cache import NEGATIVE_CACHE
+from network import RATE_LIMITERS, get_client, share_session
+from circuit_breaker import BREAKERS
+from task_watchdog import run_with_timeout
+from config import ARXIV_RATE_LIMIT, FETCHING_BATCH_SIZE, QUERY_PAGE_SIZE, QUERY_WINDOW_DAYS, API_CALL_TIMEOUT
 
+# Number of requests sent to the arXiv API by the discovery functions (see benchmark.py)
+REQUEST_COUNTS = Counter()
+request_count_lock = threading.Lock()
 
-def get_remaining_versions_of_paper(arxiv_id):
+def count_request(kind:str, amount:int=1):
+    with request_count_lock:
+        REQUEST_COUNTS[kind] += amount
+
+
+def get_remaining_versions_of_paper(arxiv_id, first_version=1):
     '''
     A function to get all the versions of a paper's ID
 
@@ -16,6 +30,8 @@ def get_remaining_versions_of_paper(arxiv_id):
     ---------
     arxiv_id: str
         newest version's ID of a paper (format: 'xxxx.xxxxxvx', x is a digit from 0 to 9)
+    first_version: int
+        first version to list (refresh runs skip the versions already on disk)
 
     Return
     ------
@@ -29,13 +45,13 @@ def get_remaining_versions_of_paper(arxiv_id):
 
     versions_id = []
 
-    for version in range(int(number_of_version) - 1):
-        versions_id.append(base_paper_id + 'v' + str(version + 1))
+    for version in range(first_version, int(number_of_version)):
+        versions_id.append(base_paper_id + 'v' + str(version))
 
     return versions_id
 
     
-def expand_to_all_versions(paper_ids:list[str]) -> list[str]:
+def expand_to_all_versions(paper_ids:list[str], first_versions:dict | None = None) -> list[str]:
     '''
     A function to get all the remaining versions
     
@@ -43,6 +59,8 @@ def expand_to_all_versions(paper_ids:list[str]) -> list[str]:
     ---------
     paper_ids: list of str
         A list contains papers' id (format: 'xxxx.xxxxxvx', x is a digit from 0 to 9)
+    first_versions: dict or None
+        base ID -> first version to list (default 1)
     
     Return
     ------
@@ -51,7 +69,8 @@ def expand_to_all_versions(paper_ids:list[str]) -> list[str]:
     '''
     expanded = []
     for paper_id in paper_ids:
-        expanded.extend(get_remaining_versions_of_paper(paper_id))
+        first_version = (first_versions or {}).get(get_id_from_arxiv_link(paper_id, False), 1)
+        expanded.extend(get_remaining_versions_of_paper(paper_id, first_version))
         
     return expanded
             
@@ -73,30 +92,38 @@ def crawl_id_batches(batch:list[str], retry_times:int=3) -> list[arxiv.Result]:
         a list contains elements with arxiv.Result type
     '''
     
-    global arxiv_last_request_time
     result = []
+    batch = [paper_id for paper_id in batch if NEGATIVE_CACHE.get('arxiv', paper_id) is None]
+    
+    if batch == []:
+        return []
+    
+    breaker = BREAKERS['arxiv_api']
+    attempt = 0
     
-    for attempt in range(1, retry_times + 1):
+    while attempt < retry_times:
+        breaker.before_request()
+        
         try:
-            with ARXIV_DELAY_LOCK:
-                time_since_last = time.time() - arxiv_last_request_time
-                
-                if time_since_last < ARXIV_RATE_LIMIT:
-                    time.sleep(ARXIV_RATE_LIMIT - time_since_last)
-                    
-                arxiv_last_request_time = time.time()
+            RATE_LIMITERS['arxiv'].wait()
                 
             search = arxiv.Search(id_list=batch)
-            result = (list(CLIENT.results(search)))
+            count_request('id_batch')
+            result = run_with_timeout(lambda: list(get_client().results(search)), API_CALL_TIMEOUT)
+            breaker.record_success()
+            NEGATIVE_CACHE.add_missing('arxiv', batch, [get_id_from_arxiv_link(paper.entry_id, with_version=True) for paper in result])
             break
             
         except Exception as e:
-            if '429' in str(e):
-                sys.stdout.write('\n')
-                print(f'429: Request too many times. Attempt {attempt}')
-            else:
+            if breaker.record_error(e):
+                # Throttled: the batch waits for the circuit instead of spending its retry budget
                 sys.stdout.write('\n')
-                print(f"[ERROR][crawl_id_batches]: {e}")
+                print('429: Request too many times. Batch parked until arXiv API recovers')
+                continue
+            
+            attempt += 1
+            sys.stdout.write('\n')
+            print(f"[ERROR][crawl_id_batches]: {e}")
                 
             if attempt == retry_times:
                 return []
@@ -106,7 +133,26 @@ def crawl_id_batches(batch:list[str], retry_times:int=3) -> list[arxiv.Result]:
     return result
 
 
-def crawl_lastest_papers_multithread(start_id, end_id, batch_size, max_workers=5):
+def crawl_lastest_papers_multithread(start_id, end_id, batch_size, max_workers=5, on_result=None):
+    '''
+    A function to crawl the latest version of every paper within start_id and end_id using multiple threads
+
+    Parameters
+    ----------
+    start_id, end_id: str
+        paper's start/end ID (format: 'xxxx.xxxxx', x is a digit from 0 to 9)
+    batch_size: int
+        number of IDs per request
+    max_workers: int
+        number of threads
+    on_result: callable or None
+        when given, every crawled paper is passed to it as soon as its batch arrives instead of being accumulated
+
+    Return
+    ------
+    tuple of (list of arxiv.Result, list of str)
+        crawled papers (empty when on_result is given) and their IDs with version
+    '''
     paper_ids = []
     start_id_int = int(start_id.replace('.', ''))
     end_id_int = int(end_id.replace('.', ''))
@@ -136,23 +182,27 @@ def crawl_lastest_papers_multithread(start_id, end_id, batch_size, max_workers=5
         futures = [executor.submit(crawl_id_batches, batch) for batch in paper_id_batches]
         
         paper_list = []
+        paper_id_list = []
         completed = 0
         
         for future in as_completed(futures):
             completed += 1
             result = future.result()
             
-            if result:
-                paper_list.extend(result)
+            for paper in result:
+                paper_id_list.append(get_id_from_arxiv_link(paper.entry_id, with_version=True))
+                
+                if on_result is not None:
+                    on_result(paper)
+                else:
+                    paper_list.append(paper)
             
             display_progress(completed, len(paper_id_batches), 'Get latest versions')
             
-    paper_id_list = [get_id_from_arxiv_link(paper.entry_id, with_version=True) for paper in paper_list]
-            
     return paper_list, paper_id_list
 
 
-def crawl_all_versions_multithread(paper_ids:list[str], batch_size:int, max_workers:int=5) -> list[arxiv.Result]:
+def crawl_all_versions_multithread(paper_ids:list[str], batch_size:int, max_workers:int=5, on_result=None) -> list[arxiv.Result]:
     '''
     A function to crawl all the versions using multiple threads
     
@@ -164,11 +214,13 @@ def crawl_all_versions_multithread(paper_ids:list[str], batch_size:int, max_work
         number of batches
     max_workers: int
         number of threads
+    on_result: callable or None
+        when given, every crawled paper is passed to it as soon as its batch arrives instead of being accumulated
         
     Return
     ------
     list of arxiv.Result
-        a list contains elements with arxiv.Result type
+        a list contains elements with arxiv.Result type (empty when on_result is given)
     '''
     paper_id_batches = [paper_ids[i:i + batch_size] for i in range(0, len(paper_ids), batch_size)]
     
@@ -182,36 +234,299 @@ def crawl_all_versions_multithread(paper_ids:list[str], batch_size:int, max_work
             completed += 1
             result = future.result()
             
-            if result:
-                paper_list.extend(result)
+            for paper in result:
+                if on_result is not None:
+                    on_result(paper)
+                else:
+                    paper_list.append(paper)
             
             display_progress(completed, len(paper_id_batches), 'Get remaining versions')
             
     return paper_list
 
-def get_all_papers(start_id:str, end_id:str, num_threads:int=5):
+def make_version_placeholders(paper_id:str, first_version:int=1) -> list[arxiv.Result]:
+    '''
+    A function to build ID-only results for the older versions of a paper, without requesting them
+
+    Parameter
+    ---------
+    paper_id: str
+        newest version's ID of a paper (format: 'xxxx.xxxxxvx', x is a digit from 0 to 9)
+    first_version: int
+        first version to build
+
+    Return
+    ------
+    list of arxiv.Result
+        results carrying only entry_id, enough for downloading sources
+    '''
+    return [arxiv.Result(entry_id=f'http://arxiv.org/abs/{version_id}') for version_id in get_remaining_versions_of_paper(paper_id, first_version)]
+
+
+def build_category_query(categories:list[str], start_date:date, end_date:date) -> str:
+    '''
+    A function to build an arXiv search query selecting the papers of some categories first submitted in a date window
+
+    Example
+    -------
+    build_category_query(['cs.CL', 'cs.LG'], date(2023, 6, 1), date(2023, 6, 7))
+    -> '(cat:cs.CL OR cat:cs.LG) AND submittedDate:[202306010000 TO 202306072359]'
+    '''
+    category_query = ' OR '.join(f'cat:{category}' for category in categories)
+    return f"({category_query}) AND submittedDate:[{start_date:%Y%m%d}0000 TO {end_date:%Y%m%d}2359]"
+
+
+def split_date_range(start_date:date, end_date:date, window_days:int) -> list[tuple[date, date]]:
+    '''
+    A function to split a date range into windows of window_days days, keeping every query far from the API paging limit
+    '''
+    windows = []
+    window_start = start_date
+    
+    while window_start <= end_date:
+        window_end = min(window_start + timedelta(days=window_days - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+        
+    return windows
+
+
+def crawl_query_window(query:str, page_size:int=QUERY_PAGE_SIZE, on_result=None, retry_times:int=3) -> list[arxiv.Result]:
+    '''
+    A function to fetch every result of a search query, page by page
+
+    Every page is one request paced by RATE_LIMITERS['arxiv'] and guarded by the arXiv API breaker; a throttled
+    or failed page is retried from the current offset, so already received results are not requested again.
+
+    Parameters
+    ----------
+    query: str
+        arXiv search query
+    page_size: int
+        number of results per request
+    on_result: callable or None
+        when given, every result is passed to it instead of being accumulated
+    retry_times: int
+        failed requests of one page before giving up (throttled answers wait for the breaker instead)
+
+    Return
+    ------
+    list of arxiv.Result
+        latest versions matching the query (empty when on_result is given)
+
+    Raises
+    ------
+    RuntimeError
+        when a page keeps failing: the window is incomplete and must not be reported as crawled
+    '''
+    # No client-side paging, delay or retries: the shared limiter and the breaker pace and retry every page
+    client = share_session(arxiv.Client(page_size=page_size, delay_seconds=0, num_retries=0))
+    breaker = BREAKERS['arxiv_api']
+    
+    paper_list = []
+    offset = 0
+    failures = 0
+    
+    while True:
+        breaker.before_request()
+        
+        RATE_LIMITERS['arxiv'].wait()
+        
+        try:
+            # max_results ends the client's paging after this page
+            search = arxiv.Search(query=query, max_results=offset + page_size, sort_by=arxiv.SortCriterion.SubmittedDate, sort_order=arxiv.SortOrder.Ascending)
+            count_request('query_page')
+            page = run_with_timeout(lambda: list(client.results(search, offset=offset)), API_CALL_TIMEOUT)
+            breaker.record_success()
+        
+        except Exception as e:
+            if breaker.record_error(e):
+                continue
+            
+            failures += 1
+            sys.stdout.write('\n')
+            print(f"[ERROR][crawl_query_window]: {e}")
+            
+            if failures == retry_times:
+                raise RuntimeError(f'search stopped at result {offset} after {retry_times} failed requests: {query}') from e
+            
+            time.sleep(ARXIV_RATE_LIMIT)
+            continue
+        
+        failures = 0
+        offset += len(page)
+        
+        for paper in page:
+            if on_result is not None:
+                on_result(paper)
+            else:
+                paper_list.append(paper)
+        
+        # A short page is the last one
+        if len(page) < page_size:
+            return paper_list
+
+
+def crawl_latest_papers_by_query(categories:list[str], start_date:date, end_date:date, on_result=None):
+    '''
+    A function to find the latest version of every paper of some categories first submitted between start_date and end_date
+
+    Parameters
+    ----------
+    categories: list of str
+        arXiv categories (e.g. ['cs.CL', 'cs.LG']), a paper matches if any of its categories is listed
+    start_date, end_date: datetime.date
+        submission date window of the first version (inclusive)
+    on_result: callable or None
+        when given, every found paper is passed to it instead of being accumulated
+
+    Return
+    ------
+    tuple of (list of arxiv.Result, list of str)
+        found papers (empty when on_result is given) and their IDs with version
+
+    Raises
+    ------
+    RuntimeError
+        when a window could not be fetched completely (see crawl_query_window)
+    '''
+    paper_list = []
+    paper_id_list = []
+    windows = split_date_range(start_date, end_date, QUERY_WINDOW_DAYS)
+    
+    def collect(paper):
+        paper_id_list.append(get_id_from_arxiv_link(paper.entry_id, with_version=True))
+        
+        if on_result is not None:
+            on_result(paper)
+        else:
+            paper_list.append(paper)
+    
+    for completed, (window_start, window_end) in enumerate(windows, start=1):
+        crawl_query_window(build_category_query(categories, window_start, window_end), on_result=collect)
+        display_progress(completed, len(windows), 'Get latest versions')
+        
+    return paper_list, paper_id_list
+
+
+def collect_all_versions(crawl_latest, num_threads:int=5, fetch_all_versions:bool=True, refresh=None) -> list[dict]:
+    '''
+    A function to group the latest versions found by a discovery function with all their older versions
+
+    Parameters
+    ----------
+    crawl_latest: callable
+        discovery function taking an on_result callback and returning (_, list of latest version IDs)
+    num_threads: int
+        number of threads fetching older versions
+    fetch_all_versions: bool
+        whether to request the metadata of older versions (needed by the 'metadata' stage only);
+        otherwise they are built from the latest version's 'vN' without any request
+    refresh: refresh.LocalVersions or None
+        when given, papers whose latest version is already saved are dropped, and only the versions newer
+        than the disk are fetched and grouped for the others (their dict gets 'known': versions already saved)
+
+    Return
+    ------
+    list of dictionary
+        [{'id': 'xxxx.xxxxx', 'versions': list[arxiv.Result]}, ...] with versions sorted from v1 to the latest
+    '''
+    grouper = VersionGrouper()
+    paper_dict_list = []
+    first_versions = {}
+    lock = threading.Lock()
+
+    def collect(paper, is_latest=False):
+        base_id, version = split_version_id(get_id_from_arxiv_link(paper.entry_id, True))
+        
+        if is_latest and refresh is not None and version is not None:
+            known = refresh.known(base_id, version)
+            if known == version:
+                return
+            with lock:
+                first_versions[base_id] = known + 1
+        
+        paper_dict = grouper.add(paper, is_latest=is_latest, first_version=first_versions.get(base_id, 1))
+        
+        if paper_dict is not None:
+            paper_dict_list.append(paper_dict)
+
+    _, paper_id_list = crawl_latest(on_result=lambda paper: collect(paper, is_latest=True))
+
+    sys.stdout.write('\n')
+
+    if refresh is not None:
+        paper_id_list = [paper_id for paper_id in paper_id_list if get_id_from_arxiv_link(paper_id, False) in first_versions]
+
+    if fetch_all_versions:
+        expanded_id_list = expand_to_all_versions(paper_id_list, first_versions)
+        crawl_all_versions_multithread(expanded_id_list, FETCHING_BATCH_SIZE, num_threads, on_result=collect)
+        sys.stdout.write('\n')
+    else:
+        for paper_id in paper_id_list:
+            for placeholder in make_version_placeholders(paper_id, first_versions.get(get_id_from_arxiv_link(paper_id, False), 1)):
+                collect(placeholder)
+
+    NEGATIVE_CACHE.save()
+    paper_dict_list.extend(grouper.flush())
+
+    if refresh is not None:
+        for paper_dict in paper_dict_list:
+            paper_dict['known'] = first_versions.get(paper_dict['id'], 1) - 1
+    return paper_dict_list
+
+
+def get_all_papers(start_id:str, end_id:str, num_threads:int=5, fetch_all_versions:bool=True, refresh=None) -> list[dict]:
     '''
     A function to crawl all the papers (all version from each paper) within start_id and end_id using arxiv API
 
+    Versions are grouped by paper as they arrive from both crawl phases (see utils.VersionGrouper).
+
     Parameters
     ----------
     start_id: str
         paper's start ID (format: 'xxxx.xxxxx', x is a digit from 0 to 9)
     end_id: str
         paper's end ID (format: 'xxxx.xxxxx', x is a digit from 0 to 9)
+    fetch_all_versions: bool
+        whether to request the metadata of older versions (needed by the 'metadata' stage only);
+        otherwise they are built from the latest version's 'vN' without any request
+    refresh: refresh.LocalVersions or None
+        see collect_all_versions
 
     Returns
     ------
-    list of arxiv.Result
-        a list contains crawled papers
+    list of dictionary
+        [{'id': 'xxxx.xxxxx', 'versions': list[arxiv.Result]}, ...] with versions sorted from v1 to the latest
     '''
-    paper_list, paper_id_list = crawl_lastest_papers_multithread(start_id, end_id, FETCHING_BATCH_SIZE, num_threads)
+    def crawl_latest(on_result):
+        return crawl_lastest_papers_multithread(start_id, end_id, FETCHING_BATCH_SIZE, num_threads, on_result=on_result)
 
-    expanded_id_list = expand_to_all_versions(paper_id_list)
+    return collect_all_versions(crawl_latest, num_threads, fetch_all_versions, refresh)
 
-    sys.stdout.write('\n')
 
-    expanded_list = crawl_all_versions_multithread(expanded_id_list, FETCHING_BATCH_SIZE, num_threads)
+def get_papers_by_query(categories:list[str], start_date:date, end_date:date, num_threads:int=5, fetch_all_versions:bool=True, refresh=None) -> list[dict]:
+    '''
+    A function to crawl all the papers (all version from each paper) of some categories first submitted between
+    start_date and end_date, using paged arXiv search queries instead of enumerating every ID
 
-    sys.stdout.write('\n')
-    return sorted(paper_list + expanded_list, key=lambda d: d.entry_id)
\ No newline at end of file
+    Parameters
+    ----------
+    categories: list of str
+        arXiv categories (e.g. ['cs.CL', 'cs.LG'])
+    start_date, end_date: datetime.date
+        submission date window of the first version (inclusive)
+    num_threads: int
+        number of threads fetching older versions
+    fetch_all_versions, refresh:
+        see collect_all_versions
+
+    Returns
+    ------
+    list of dictionary
+        [{'id': 'xxxx.xxxxx', 'versions': list[arxiv.Result]}, ...] with versions sorted from v1 to the latest
+    '''
+    def crawl_latest(on_result):
+        return crawl_latest_papers_by_query(categories, start_date, end_date, on_result=on_result)
+
+    return collect_all_versions(crawl_latest, num_threads, fetch_all_versions, refresh)
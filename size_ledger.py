@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import argparse
+import threading
+import numpy as np
+
+from config import SIZE_LEDGER_PATH
+from utils import split_version_id
+
+# Flags of a version, one bit each
+CACHED = 1       # already on disk or unchanged upstream, sizes come from the validator store
+SKIPPED = 2      # nothing to download (negative cache)
+OVERSIZED = 4    # larger than LARGE_SOURCE_SIZE, filtered while it streamed
+TRUNCATED = 8    # reading stopped at MAX_SOURCE_SIZE
+
+COLUMNS = {
+    'paper': np.int64,      # yymm * 100000 + number, -(1 + position in other_ids) for old-style IDs
+    'version': np.uint16,
+    'category': np.uint16,  # position in categories
+    'before': np.int64,     # bytes before removing figures
+    'after': np.int64,      # bytes after removing figures
+    'compressed': np.int64, # bytes on disk in the archive/zstd storage modes, -1 otherwise
+    'downloaded': np.int64, # bytes read from an oversized e-print, -1 otherwise
+    'content_length': np.int64,
+    'flags': np.uint8,
+}
+PERCENTILES = (50, 90, 99)
+
+
+def decode_paper(key: int) -> str:
+    '''
+    Base ID of a new-style paper key (numbers have 4 digits before 2015, 5 digits since)
+    '''
+    month, number = divmod(key, 100000)
+    return f'{month:04d}-{number:04d}' if month < 1501 else f'{month:04d}-{number:05d}'
+
+
+def first_rows(values: np.ndarray) -> np.ndarray:
+    '''
+    Rows where each distinct value first appears (one sort, faster than np.unique on large columns)
+    '''
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    is_first = np.ones(len(values), dtype=bool)
+    is_first[1:] = sorted_values[1:] != sorted_values[:-1]
+    return order[is_first]
+
+
+class SizeLedger:
+    '''
+    Append-only table of the sizes of every downloaded version, one typed array per column
+
+    Appending is thread-safe and amortized O(1) (arrays grow by doubling), summaries are vectorized,
+    so stats over millions of versions take milliseconds. Saved as one .npz file, exported to the
+    list of dicts of the former paper_sizes.json.
+
+    Usage
+    -----
+    ledger = SizeLedger()
+    ledger.append({'id': '2306-14505v2', 'size': {'before': 10240, 'after': 2048}}, category='cs.CL')
+    ledger.stats()['after']['mean']
+    ledger.breakdown('month')
+    ledger.save('paper_sizes.npz')
+    '''
+    def __init__(self, capacity: int = 1024):
+        self.lock = threading.Lock()
+        self.size = 0
+        self.arrays = {name: np.zeros(capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.categories = ['']
+        self.category_codes = {'': 0}
+        self.other_ids = []
+        self.other_codes = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _reserve(self, count: int):
+        capacity = len(self.arrays['flags'])
+        if self.size + count <= capacity:
+            return
+
+        capacity = max(capacity * 2, self.size + count)
+        for name, array in self.arrays.items():
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+
+    def _category_code(self, category: str) -> int:
+        code = self.category_codes.get(category)
+        if code is None:
+            code = self.category_codes[category] = len(self.categories)
+            self.categories.append(category)
+        return code
+
+    def _paper_key(self, base_id: str) -> int:
+        month, _, number = base_id.partition('-')
+        if len(month) == 4 and month.isdigit() and number.isdigit():
+            return int(month) * 100000 + int(number)
+
+        code = self.other_codes.get(base_id)
+        if code is None:
+            code = self.other_codes[base_id] = len(self.other_ids)
+            self.other_ids.append(base_id)
+        return -(code + 1)
+
+    def paper_id(self, key: int) -> str:
+        return decode_paper(key) if key >= 0 else self.other_ids[-key - 1]
+
+    def paper_ids(self) -> list[str]:
+        '''
+        Distinct base IDs of the ledger (format: 'xxxx-xxxxx')
+        '''
+        papers = self.columns()['paper']
+        return [self.paper_id(int(key)) for key in papers[first_rows(papers)]]
+
+    def append(self, record: dict, category: str = ''):
+        '''
+        Add the size report of one version, as returned by saving.save_one_tex (empty reports are ignored)
+        '''
+        if not record or 'id' not in record:
+            return
+
+        # Reports use 'xxxx-xxxxxvx' IDs, a version without suffix is stored as version 0
+        base_id, version = split_version_id(record['id'].replace('.', '-'))
+        version = version or 0
+        size = record.get('size', {})
+        oversized = record.get('oversized')
+
+        flags = 0
+        if record.get('cached'):
+            flags |= CACHED
+        if record.get('skipped'):
+            flags |= SKIPPED
+        if oversized:
+            flags |= OVERSIZED | (TRUNCATED if oversized.get('truncated') else 0)
+
+        with self.lock:
+            self._reserve(1)
+            row = self.size
+            self.arrays['paper'][row] = self._paper_key(base_id)
+            self.arrays['version'][row] = version
+            self.arrays['category'][row] = self._category_code(category or '')
+            self.arrays['before'][row] = size.get('before', 0)
+            self.arrays['after'][row] = size.get('after', 0)
+            self.arrays['compressed'][row] = size.get('compressed', -1)
+            self.arrays['downloaded'][row] = oversized.get('downloaded', -1) if oversized else -1
+            content_length = oversized.get('content_length') if oversized else None
+            self.arrays['content_length'][row] = -1 if content_length is None else content_length
+            self.arrays['flags'][row] = flags
+            self.size += 1
+
+    def extend(self, records: list[dict], category: str = ''):
+        for record in records or []:
+            self.append(record, category)
+
+    def merge(self, other: 'SizeLedger'):
+        '''
+        Append every row of another ledger (e.g. the ledger of another range)
+        '''
+        columns = other.columns()
+
+        with self.lock:
+            categories = np.array([self._category_code(category) for category in other.categories], dtype=np.uint16)
+            # Old-style IDs are renumbered from their position in other to their position in self
+            other_ids = np.array([self._paper_key(paper_id) for paper_id in other.other_ids], dtype=np.int64)
+            papers = columns['paper'].copy()
+            is_other = papers < 0
+            papers[is_other] = other_ids[-papers[is_other] - 1]
+
+            count = len(columns['flags'])
+            self._reserve(count)
+            for name, array in columns.items():
+                if name == 'category':
+                    array = categories[array]
+                elif name == 'paper':
+                    array = papers
+                self.arrays[name][self.size:self.size + count] = array
+            self.size += count
+
+    def columns(self) -> dict:
+        '''
+        Views of the filled part of every column
+        '''
+        with self.lock:
+            return {name: array[:self.size] for name, array in self.arrays.items()}
+
+    def stats(self) -> dict:
+        '''
+        Summary of the ledger
+
+        Return
+        ------
+        dict
+            {
+                'versions': int, 'papers': int (distinct base IDs), 'oversized': int, 'truncated': int,
+                'before'/'after'/'compressed': {'total', 'mean', 'p50', 'p90', 'p99'} in bytes ('compressed' over the
+                versions stored compressed only),
+                'compression_ratio': after / compressed bytes of those versions (None without any)
+            }
+        '''
+        columns = self.columns()
+        flags = columns['flags']
+
+        summary = {
+            'versions': len(flags),
+            'papers': len(first_rows(columns['paper'])),
+            'oversized': int(np.count_nonzero(flags & OVERSIZED)),
+            'truncated': int(np.count_nonzero(flags & TRUNCATED)),
+        }
+
+        has_compressed = columns['compressed'] >= 0
+        for name, values in (('before', columns['before']), ('after', columns['after']),
+                             ('compressed', columns['compressed'][has_compressed])):
+            summary[name] = {'total': int(values.sum()), 'mean': float(values.mean()) if len(values) else 0.0}
+            percentiles = np.percentile(values, PERCENTILES) if len(values) else [0.0] * len(PERCENTILES)
+            summary[name].update({f'p{q}': float(value) for q, value in zip(PERCENTILES, percentiles)})
+
+        compressed_total = summary['compressed']['total']
+        summary['compression_ratio'] = (float(columns['after'][has_compressed].sum()) / compressed_total
+                                        if compressed_total else None)
+        return summary
+
+    def breakdown(self, by: str = 'month') -> dict:
+        '''
+        Versions, distinct papers and mean sizes per month (yymm) or per primary category
+
+        Return
+        ------
+        dict
+            {month or category: {'versions', 'papers', 'before', 'after' (mean bytes), 'compressed' (total bytes)}}
+        '''
+        if by not in ('month', 'category'):
+            raise ValueError(f"unknown breakdown '{by}', choose among month, category")
+
+        columns = self.columns()
+        if by == 'month':
+            values = np.where(columns['paper'] >= 0, columns['paper'] // 100000, 0)
+        else:
+            values = columns['category']
+        # Months and category codes are small integers: they index the bincounts directly
+        versions = np.bincount(values)
+        keys = np.flatnonzero(versions)
+        before = np.bincount(values, weights=columns['before'])
+        after = np.bincount(values, weights=columns['after'])
+        compressed = np.bincount(values, weights=np.maximum(columns['compressed'], 0))
+        papers = np.bincount(values[first_rows(columns['paper'])], minlength=len(versions))
+
+        if by == 'month':
+            labels = [f'{key:04d}' if key else 'old-style' for key in keys]
+        else:
+            labels = [self.categories[key] or 'unknown' for key in keys]
+        return {
+            label: {
+                'versions': int(versions[key]),
+                'papers': int(papers[key]),
+                'before': float(before[key] / versions[key]),
+                'after': float(after[key] / versions[key]),
+                'compressed': int(compressed[key]),
+            }
+            for key, label in zip(keys, labels)
+        }
+
+    def to_records(self) -> list[dict]:
+        '''
+        Rows as the size reports of saving.save_one_tex (the format of the former paper_sizes.json)
+        '''
+        columns = self.columns()
+        records = []
+
+        for row in range(len(columns['flags'])):
+            flags = int(columns['flags'][row])
+            size = {'before': int(columns['before'][row]), 'after': int(columns['after'][row])}
+            if columns['compressed'][row] >= 0:
+                size['compressed'] = int(columns['compressed'][row])
+
+            record = {'id': f"{self.paper_id(int(columns['paper'][row]))}v{columns['version'][row]}", 'size': size}
+            if self.categories[columns['category'][row]]:
+                record['category'] = self.categories[columns['category'][row]]
+            if flags & CACHED:
+                record['cached'] = True
+            if flags & SKIPPED:
+                record['skipped'] = True
+            if flags & OVERSIZED:
+                content_length = int(columns['content_length'][row])
+                record['oversized'] = {
+                    'content_length': None if content_length < 0 else content_length,
+                    'downloaded': int(columns['downloaded'][row]),
+                    'truncated': bool(flags & TRUNCATED),
+                }
+            records.append(record)
+
+        return records
+
+    def save(self, path: str = SIZE_LEDGER_PATH):
+        '''
+        Write the ledger as one uncompressed .npz file (temp file then rename, readers never see a partial file)
+        '''
+        columns = self.columns()
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'wb') as f:
+            np.savez(f, categories=np.array(self.categories), other_ids=np.array(self.other_ids, dtype=str), **columns)
+        os.replace(temp_path, path)
+
+    def export_json(self, path: str):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_records(), f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str = SIZE_LEDGER_PATH) -> 'SizeLedger':
+        '''
+        Read a ledger saved by save(), or a paper_sizes.json list of size reports (empty ledger when missing)
+        '''
+        ledger = cls()
+        if not os.path.exists(path):
+            return ledger
+
+        if path.endswith('.json'):
+            with open(path, encoding='utf-8') as f:
+                for record in json.load(f):
+                    if record:
+                        ledger.append(record, record.get('category', ''))
+            return ledger
+
+        with np.load(path, allow_pickle=False) as data:
+            ledger.categories = [str(category) for category in data['categories']]
+            ledger.category_codes = {category: code for code, category in enumerate(ledger.categories)}
+            ledger.other_ids = [str(paper_id) for paper_id in data['other_ids']]
+            ledger.other_codes = {paper_id: code for code, paper_id in enumerate(ledger.other_ids)}
+            ledger.size = len(data['flags'])
+            ledger.arrays = {name: data[name].astype(dtype) for name, dtype in COLUMNS.items()}
+
+        return ledger
+
+
+def format_size(num_bytes: float) -> str:
+    return f'{num_bytes / 1024:.3f} KB'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize or export the size ledger of the downloaded versions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stats_parser = subparsers.add_parser('stats', help='sizes, percentiles and compression ratio')
+    stats_parser.add_argument('--ledger', default=SIZE_LEDGER_PATH, help='.npz ledger or paper_sizes.json')
+    stats_parser.add_argument('--by', choices=['month', 'category'], default=None, help='also break the sizes down')
+
+    export_parser = subparsers.add_parser('export', help='write the ledger as a JSON list of size reports')
+    export_parser.add_argument('output')
+    export_parser.add_argument('--ledger', default=SIZE_LEDGER_PATH)
+
+    args = parser.parse_args(argv)
+    ledger = SizeLedger.load(args.ledger)
+
+    if args.command == 'export':
+        ledger.export_json(args.output)
+        print(f'{len(ledger)} versions written to {args.output}')
+        return
+
+    summary = ledger.stats()
+    print(f"{summary['versions']} versions of {summary['papers']} papers "
+          f"({summary['oversized']} oversized, {summary['truncated']} stopped at the size cap)")
+    for name in ('before', 'after', 'compressed'):
+        values = summary[name]
+        print(f"- {name}: mean {format_size(values['mean'])}, "
+              + ', '.join(f"p{q} {format_size(values[f'p{q}'])}" for q in PERCENTILES))
+    if summary['compression_ratio'] is not None:
+        print(f"- compression ratio: {summary['compression_ratio']:.2f}x")
+
+    if args.by:
+        print(f'BY {args.by.upper()}:')
+        for label, row in ledger.breakdown(args.by).items():
+            print(f"- {label}: {row['versions']} versions of {row['papers']} papers, "
+                  f"mean {format_size(row['before'])} -> {format_size(row['after'])}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
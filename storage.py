@@ -0,0 +1,590 @@
+import os
+import io
+import sys
+import json
+import gzip
+import zlib
+import shutil
+import struct
+import tarfile
+import zipfile
+import argparse
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import ZSTD_LEVEL, ZSTD_DICT_SIZE, ZSTD_DICT_SAMPLES
+from layout import iter_paper_dirs
+
+ALLOWED_EXTS = {'.tex', '.bib'}
+ARCHIVE_EXT = '.zip'
+INDEX_EXT = '.index.json'
+ZSTD_EXT = '.zst'
+ZSTD_DICT_FOLDER = '.zstd'        # <save_root>/.zstd/<dict id>.dict, 'current' names the dictionary used for new files
+
+# Local file header: signature, version, flags, method, time, date, crc, sizes, name length, extra length
+LOCAL_HEADER_FORMAT = '<4s5HI2I2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+
+
+def get_archive_paths(save_path: str, yyyymm_idv: str) -> tuple[str, str]:
+    '''
+    A function to get the archive path and the member index path of a version
+
+    Parameters
+    ----------
+    save_path: str
+        the paper's tex folder (format: 'Save/xxxx-xxxxx/tex')
+    yyyymm_idv: str
+        version's ID (format: 'xxxx-xxxxxvx')
+
+    Return
+    ------
+    tuple of str
+        (archive path, index path)
+    '''
+    base = os.path.join(save_path, yyyymm_idv)
+    return base + ARCHIVE_EXT, base + INDEX_EXT
+
+
+def is_archived(save_path: str, yyyymm_idv: str) -> bool:
+    archive_path, index_path = get_archive_paths(save_path, yyyymm_idv)
+    return os.path.exists(archive_path) and os.path.exists(index_path)
+
+
+def normalize_member_name(name: str) -> str | None:
+    '''
+    Normalize a tar member name, returning None for names escaping the archive root
+    '''
+    name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+
+    if name in ('', '.') or name.startswith('..'):
+        return None
+    return name
+
+
+def iter_source_members(source_path: str):
+    '''
+    A generator over the members of a downloaded e-print source
+
+    Parameters
+    ----------
+    source_path: str
+        a '.tar.gz' bundle or a single gzipped '.gz' file
+
+    Yield
+    -----
+    tuple of (str, int, callable)
+        member name, uncompressed size and a function reading the member's bytes
+    '''
+    if source_path.endswith('.tar.gz') and tarfile.is_tarfile(source_path):
+        with tarfile.open(source_path, 'r:gz') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                name = normalize_member_name(member.name)
+                if name is None:
+                    continue
+
+                yield name, member.size, lambda member=member: tar.extractfile(member).read()
+    else:
+        with gzip.open(source_path, 'rb') as f_in:
+            data = f_in.read()
+            file_name = getattr(f_in, 'name', None) or os.path.basename(source_path)[:-3]
+
+        file_name = os.path.splitext(os.path.basename(file_name))[0]
+        yield file_name + '.tex', len(data), lambda: data
+
+
+def build_member_index(archive_path: str) -> list[dict]:
+    '''
+    A function to locate the compressed data of every member of a zip archive
+
+    Return
+    ------
+    list of dict
+        [{'name', 'offset', 'size', 'compressed_size', 'method', 'crc'}, ...]
+        where 'offset' points at the first byte of the member's compressed data
+    '''
+    index = []
+
+    with zipfile.ZipFile(archive_path) as zf, open(archive_path, 'rb') as f:
+        for info in zf.infolist():
+            f.seek(info.header_offset)
+            header = struct.unpack(LOCAL_HEADER_FORMAT, f.read(LOCAL_HEADER_SIZE))
+            name_length, extra_length = header[-2], header[-1]
+
+            index.append({
+                'name': info.filename,
+                'offset': info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length,
+                'size': info.file_size,
+                'compressed_size': info.compress_size,
+                'method': info.compress_type,
+                'crc': info.CRC
+            })
+
+    return index
+
+
+def archive_source(source_path: str, save_path: str, yyyymm_idv: str, allowed_exts: set = ALLOWED_EXTS) -> tuple[int, int]:
+    '''
+    Keep the '.tex'/'.bib' members of a downloaded source in one recompressed archive instead of an extracted tree
+
+    The archive is a standard zip file (readable by any tool) next to a member index giving the offset and
+    size of each member, which lets ArchiveReader read single files with one seek.
+
+    Parameters
+    ----------
+    source_path: str
+        the downloaded '.tar.gz' / '.gz' file, removed once archived
+    save_path: str
+        the paper's tex folder
+    yyyymm_idv: str
+        version's ID (format: 'xxxx-xxxxxvx')
+
+    Return
+    ------
+    tuple of int
+        (size of all members, size of the kept members) in bytes
+    '''
+    archive_path, index_path = get_archive_paths(save_path, yyyymm_idv)
+    temp_archive_path = archive_path + '.tmp'
+    size_before, size_after = 0, 0
+
+    try:
+        with zipfile.ZipFile(temp_archive_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+            for name, size, read in iter_source_members(source_path):
+                size_before += size
+
+                if os.path.splitext(name)[1] not in allowed_exts:
+                    continue
+
+                zf.writestr(name, read())
+                size_after += size
+
+        index = build_member_index(temp_archive_path)
+
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'archive': os.path.basename(archive_path), 'members': index}, f, ensure_ascii=False)
+    except Exception:
+        for temp_path in (temp_archive_path, index_path + '.tmp'):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+
+    os.replace(temp_archive_path, archive_path)
+    os.replace(index_path + '.tmp', index_path)
+    os.remove(source_path)
+
+    return size_before, size_after
+
+
+class ArchiveReader:
+    '''
+    Lazy reader over an archived version: members are read by seeking to their offset, nothing is extracted
+
+    Example
+    -------
+    with ArchiveReader('Save/2306-14505/tex', '2306-14505v2') as reader:
+        for name in reader.names():
+            if name.endswith('.tex'):
+                text = reader.read_text(name)
+    '''
+    def __init__(self, save_path: str, yyyymm_idv: str):
+        self.archive_path, index_path = get_archive_paths(save_path, yyyymm_idv)
+
+        with open(index_path, encoding='utf-8') as f:
+            self.members = {member['name']: member for member in json.load(f)['members']}
+
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def names(self) -> list[str]:
+        return list(self.members)
+
+    def size(self, name: str) -> int:
+        return self.members[name]['size']
+
+    def read(self, name: str) -> bytes:
+        member = self.members[name]
+
+        if self.file is None:
+            self.file = open(self.archive_path, 'rb')
+
+        self.file.seek(member['offset'])
+        data = self.file.read(member['compressed_size'])
+
+        if member['method'] == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        elif member['method'] != zipfile.ZIP_STORED:
+            raise ValueError(f'Unsupported compression method {member["method"]} for {name}')
+
+        if zlib.crc32(data) != member['crc']:
+            raise ValueError(f'CRC mismatch for {name} in {self.archive_path}')
+        return data
+
+    def read_text(self, name: str, encoding: str = 'utf-8', errors: str = 'replace') -> str:
+        return self.read(name).decode(encoding, errors=errors)
+
+    def open(self, name: str) -> io.BytesIO:
+        return io.BytesIO(self.read(name))
+
+
+def get_archived_size(save_path: str, yyyymm_idv: str) -> int:
+    '''
+    Total uncompressed size of the members kept in an archived version
+    '''
+    _, index_path = get_archive_paths(save_path, yyyymm_idv)
+
+    with open(index_path, encoding='utf-8') as f:
+        return sum(member['size'] for member in json.load(f)['members'])
+
+
+# ========== zstd storage ==========
+# Every kept member is written as its own zstd frame (Save/<id>/tex/<idvN>/<name>.zst), compressed with a shared
+# dictionary trained on the corpus: most .tex/.bib files are a few KB, too small to compress well on their own.
+# Each frame records the ID of its dictionary, so files written before a retraining stay readable.
+
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+
+
+def get_dictionary_dir(save_root: str) -> str:
+    return os.path.join(save_root, ZSTD_DICT_FOLDER)
+
+
+def load_dictionary(save_root: str, dict_id: int | None = None):
+    '''
+    A function to load a zstd dictionary of the corpus (cached per process)
+
+    Parameters
+    ----------
+    dict_id: int
+        ID recorded in a frame, None for the dictionary used to compress new files
+
+    Return
+    ------
+    zstandard.ZstdCompressionDict or None
+        None when dict_id is None and no dictionary has been trained yet
+    '''
+    import zstandard
+
+    dictionary_dir = get_dictionary_dir(save_root)
+
+    if dict_id is None:
+        try:
+            with open(os.path.join(dictionary_dir, 'current'), encoding='utf-8') as f:
+                dict_id = int(f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    key = (os.path.abspath(dictionary_dir), dict_id)
+    with _dictionaries_lock:
+        if key not in _dictionaries:
+            with open(os.path.join(dictionary_dir, f'{dict_id}.dict'), 'rb') as f:
+                _dictionaries[key] = zstandard.ZstdCompressionDict(f.read())
+        return _dictionaries[key]
+
+
+def iter_corpus_samples(save_root: str, allowed_exts: set = ALLOWED_EXTS):
+    '''
+    A generator over the content of the kept files of a corpus, whatever the storage mode they were saved in
+    '''
+    for _, paper_dir in iter_paper_dirs(save_root):
+        tex_dir = os.path.join(paper_dir, 'tex')
+        if not os.path.isdir(tex_dir):
+            continue
+
+        for entry in os.scandir(tex_dir):
+            if entry.name.endswith(INDEX_EXT):
+                with ArchiveReader(tex_dir, entry.name[:-len(INDEX_EXT)]) as reader:
+                    for name in reader.names():
+                        yield reader.read(name)
+
+            elif entry.is_dir():
+                for dirpath, _, file_names in os.walk(entry.path):
+                    for file_name in file_names:
+                        path = os.path.join(dirpath, file_name)
+                        if file_name.endswith(ZSTD_EXT):
+                            yield read_stored_file(path, save_root)
+                        elif os.path.splitext(file_name)[1] in allowed_exts:
+                            with open(path, 'rb') as f:
+                                yield f.read()
+
+
+def train_dictionary(save_root: str = './Save', dict_size: int = ZSTD_DICT_SIZE, max_samples: int = ZSTD_DICT_SAMPLES) -> int:
+    '''
+    A function to train the shared dictionary on files already saved, and use it for every new file
+
+    Samples are capped at 128 KB each: the dictionary is meant for the beginning of files (preamble, packages,
+    bibliography entries), large files compress well without it
+
+    Return
+    ------
+    int
+        the dictionary ID
+    '''
+    import zstandard
+
+    samples = []
+    for data in iter_corpus_samples(save_root):
+        if data:
+            samples.append(data[:128 * 1024])
+        if len(samples) >= max_samples:
+            break
+
+    if len(samples) < 10:
+        raise ValueError(f'Only {len(samples)} files found in {save_root}, save some papers before training a dictionary')
+
+    dictionary = zstandard.train_dictionary(dict_size, samples, level=ZSTD_LEVEL)
+    dict_id = dictionary.dict_id()
+
+    dictionary_dir = get_dictionary_dir(save_root)
+    os.makedirs(dictionary_dir, exist_ok=True)
+
+    with open(os.path.join(dictionary_dir, f'{dict_id}.dict.tmp'), 'wb') as f:
+        f.write(dictionary.as_bytes())
+    os.replace(os.path.join(dictionary_dir, f'{dict_id}.dict.tmp'), os.path.join(dictionary_dir, f'{dict_id}.dict'))
+
+    with open(os.path.join(dictionary_dir, 'current.tmp'), 'w', encoding='utf-8') as f:
+        f.write(str(dict_id))
+    os.replace(os.path.join(dictionary_dir, 'current.tmp'), os.path.join(dictionary_dir, 'current'))
+
+    return dict_id
+
+
+def compress_source(source_path: str, save_path: str, yyyymm_idv: str, save_root: str = './Save',
+                    allowed_exts: set = ALLOWED_EXTS) -> tuple[int, int, int]:
+    '''
+    Keep the '.tex'/'.bib' members of a downloaded source as zstd frames, in the folder an extraction would use
+
+    The members are compressed straight from the downloaded bundle (no plain copy is written) into a temporary
+    folder renamed once complete, so an interrupted version is never mistaken for a saved one.
+
+    Parameters
+    ----------
+    source_path: str
+        the downloaded '.tar.gz' / '.gz' file, removed once compressed
+    save_path: str
+        the paper's tex folder
+    yyyymm_idv: str
+        version's ID (format: 'xxxx-xxxxxvx')
+    save_root: str
+        corpus root holding the shared dictionary
+
+    Return
+    ------
+    tuple of int
+        (size of all members, size of the kept members, size of the compressed files) in bytes
+    '''
+    import zstandard
+
+    extract_dir = os.path.join(save_path, yyyymm_idv)
+    temp_dir = extract_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=load_dictionary(save_root), write_content_size=True)
+    size_before, size_after, size_compressed = 0, 0, 0
+
+    try:
+        for name, size, read in iter_source_members(source_path):
+            size_before += size
+
+            if os.path.splitext(name)[1] not in allowed_exts:
+                continue
+
+            output_path = os.path.join(temp_dir, name + ZSTD_EXT)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            data = compressor.compress(read())
+
+            with open(output_path, 'wb') as f:
+                f.write(data)
+
+            size_after += size
+            size_compressed += len(data)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    os.replace(temp_dir, extract_dir)
+    os.remove(source_path)
+
+    return size_before, size_after, size_compressed
+
+
+def read_stored_file(path: str, save_root: str = './Save') -> bytes:
+    '''
+    Read a saved file, decompressing it when it is a zstd frame (path ending with '.zst')
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not path.endswith(ZSTD_EXT):
+        return data
+
+    import zstandard
+
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    dictionary = load_dictionary(save_root, dict_id) if dict_id else None
+    return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+
+
+def get_compressed_sizes(save_path: str, yyyymm_idv: str) -> tuple[int, int]:
+    '''
+    Sizes of a zstd-stored version, read from the frame headers (nothing is decompressed)
+
+    Plain files (versions extracted before the corpus switched to STORAGE_MODE = 'zstd') count with their size on disk
+
+    Return
+    ------
+    tuple of int
+        (uncompressed size, compressed size) in bytes
+    '''
+    import zstandard
+
+    size_after, size_compressed = 0, 0
+    for dirpath, _, file_names in os.walk(os.path.join(save_path, yyyymm_idv)):
+        for file_name in file_names:
+            path = os.path.join(dirpath, file_name)
+            size = os.path.getsize(path)
+            size_compressed += size
+
+            if not file_name.endswith(ZSTD_EXT):
+                size_after += size
+                continue
+
+            with open(path, 'rb') as f:
+                header = f.read(18)   # the frame header is at most 18 bytes
+            size_after += zstandard.get_frame_parameters(header).content_size
+
+    return size_after, size_compressed
+
+
+class SourceReader:
+    '''
+    Read the files of a saved version the same way whether it was extracted or stored as zstd frames
+
+    Example
+    -------
+    with SourceReader('Save/2306-14505/tex', '2306-14505v2') as reader:
+        for name in reader.names():        # 'main.tex', 'sections/intro.tex', ...
+            text = reader.read_text(name)
+    '''
+    def __init__(self, save_path: str, yyyymm_idv: str, save_root: str = './Save'):
+        self.folder = os.path.join(save_path, yyyymm_idv)
+        self.save_root = save_root
+        self.paths = {}
+
+        for dirpath, _, file_names in os.walk(self.folder):
+            for file_name in file_names:
+                path = os.path.join(dirpath, file_name)
+                name = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                self.paths[name[:-len(ZSTD_EXT)] if name.endswith(ZSTD_EXT) else name] = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def names(self) -> list[str]:
+        return list(self.paths)
+
+    def read(self, name: str) -> bytes:
+        return read_stored_file(self.paths[name], self.save_root)
+
+    def read_text(self, name: str, encoding: str = 'utf-8', errors: str = 'replace') -> str:
+        return self.read(name).decode(encoding, errors=errors)
+
+    def open(self, name: str) -> io.BytesIO:
+        return io.BytesIO(self.read(name))
+
+
+def export_paper(paper_dir: str, dest_dir: str, save_root: str) -> int:
+    '''
+    Copy one paper folder, writing zstd frames back as plain files
+
+    Return
+    ------
+    int
+        number of decompressed files
+    '''
+    decompressed = 0
+
+    for dirpath, _, file_names in os.walk(paper_dir):
+        target_dir = os.path.join(dest_dir, os.path.relpath(dirpath, paper_dir))
+        os.makedirs(target_dir, exist_ok=True)
+
+        for file_name in file_names:
+            path = os.path.join(dirpath, file_name)
+
+            if file_name.endswith(ZSTD_EXT):
+                with open(os.path.join(target_dir, file_name[:-len(ZSTD_EXT)]), 'wb') as f:
+                    f.write(read_stored_file(path, save_root))
+                decompressed += 1
+            else:
+                shutil.copy2(path, os.path.join(target_dir, file_name))
+
+    return decompressed
+
+
+def export_corpus(save_root: str, dest_root: str, workers: int = 8) -> tuple[int, int]:
+    '''
+    A function to export a corpus with plain '.tex'/'.bib' files (for tools that cannot read zstd),
+    the folder layout of save_root is kept
+
+    Return
+    ------
+    tuple of int
+        (number of papers, number of decompressed files)
+    '''
+    save_root_abs = os.path.abspath(save_root)
+    jobs = [
+        (paper_dir, os.path.join(dest_root, os.path.relpath(os.path.abspath(paper_dir), save_root_abs)))
+        for _, paper_dir in iter_paper_dirs(save_root)
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        decompressed = sum(executor.map(lambda job: export_paper(job[0], job[1], save_root), jobs))
+
+    return len(jobs), decompressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage zstd-compressed sources (STORAGE_MODE = "zstd")')
+    parser.add_argument('--save-root', default='./Save')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train-dict', help='train the shared dictionary on the files already saved')
+    train_parser.add_argument('--size', type=int, default=ZSTD_DICT_SIZE, help='dictionary size in bytes')
+    train_parser.add_argument('--samples', type=int, default=ZSTD_DICT_SAMPLES, help='maximum number of sample files')
+
+    export_parser = subparsers.add_parser('export', help='copy the corpus with every .zst file decompressed')
+    export_parser.add_argument('dest_root')
+    export_parser.add_argument('--workers', type=int, default=8)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'train-dict':
+        dict_id = train_dictionary(args.save_root, args.size, args.samples)
+        print(f'Trained dictionary {dict_id}, used for every file compressed from now on')
+    else:
+        papers, decompressed = export_corpus(args.save_root, args.dest_root, args.workers)
+        print(f'Exported {papers} papers to {args.dest_root} ({decompressed} files decompressed)')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
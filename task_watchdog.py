@@ -0,0 +1,249 @@
+import sys
+import time
+import threading
+
+from config import STALL_TIMEOUT, STALL_GRACE, STALL_RETRY_BUDGET
+
+RUNNING = 'running'
+DONE = 'done'
+ABANDONED = 'abandoned'
+
+# The task run by the current worker thread (set by Watchdog.start_task)
+_current = threading.local()
+
+
+class TaskStalled(Exception):
+    '''
+    Raised inside a task the watchdog has cancelled, or when a network operation missed its deadline
+    '''
+
+
+def is_stall_error(e: Exception) -> bool:
+    '''
+    Check whether an exception means the task stalled (cancelled, socket timeout, missed deadline)
+    rather than failed: requests raises ConnectTimeout / ReadTimeout, futures raise TimeoutError
+    '''
+    return isinstance(e, (TaskStalled, TimeoutError)) or 'Timeout' in type(e).__name__
+
+
+def heartbeat():
+    '''
+    Tell the watchdog the task of the current thread is making progress (resets its stall timer)
+    '''
+    task = getattr(_current, 'task', None)
+    if task is not None:
+        task.last_progress = time.time()
+
+
+def check_cancelled():
+    '''
+    Raise TaskStalled when the watchdog has cancelled the task of the current thread,
+    long loops (e.g. a download) call it between two chunks to stop cooperatively
+    '''
+    task = getattr(_current, 'task', None)
+    if task is not None and task.cancel.is_set():
+        raise TaskStalled(f'{task.stage} task {task.item_id} cancelled by the watchdog')
+
+
+def run_with_timeout(function, timeout: float, *args, **kwargs):
+    '''
+    Run a blocking call that has no timeout of its own (e.g. arxiv.Client.results) with a deadline
+
+    The call runs in a daemon helper thread; when the deadline passes the helper is abandoned
+    (it ends with its socket) and the caller gets a TimeoutError instead of hanging
+
+    Raise
+    -----
+    TimeoutError
+        when the call did not return within timeout seconds
+    '''
+    outcome = {}
+
+    def target():
+        try:
+            outcome['value'] = function(*args, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+
+    helper = threading.Thread(target=target, daemon=True)
+    helper.start()
+    helper.join(timeout)
+
+    if helper.is_alive():
+        raise TimeoutError(f'{getattr(function, "__name__", "call")} did not return within {timeout}s')
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['value']
+
+
+class Task:
+    def __init__(self, stage: str, item_id: str, item, queue, on_give_up=None):
+        self.stage = stage
+        self.item_id = item_id
+        self.item = item
+        self.queue = queue
+        self.on_give_up = on_give_up
+        self.started = time.time()
+        self.last_progress = self.started
+        self.cancel = threading.Event()
+        self.cancelled_at = None
+        self.state = RUNNING
+
+
+class Watchdog:
+    '''
+    Track every in-flight task of the pipeline and recover the ones that stop making progress
+
+    A task stalls when it has not called heartbeat() (every request and every downloaded chunk does) for
+    stall_timeout seconds. The watchdog first cancels it (check_cancelled() raises TaskStalled in the worker,
+    which requeues the item). A task still running stall_grace seconds later is stuck in a call that cannot
+    be interrupted: the watchdog abandons it, requeues its item itself, releases the queue slot and asks
+    for a replacement worker. An item is requeued at most retry_budget times, then its ID is reported.
+
+    Usage
+    -----
+    watchdog = Watchdog()
+    watchdog.start()
+    ...
+    task = watchdog.start_task(stage, paper_id, item, queue, on_give_up)
+    try:
+        result = process(item)
+    except Exception as e:
+        stalled = is_stall_error(e)
+
+    if not watchdog.finish_task(task):
+        return                              # abandoned: the watchdog requeued the item and released the slot
+    if stalled:
+        watchdog.retry_or_give_up(task)
+    queue.task_done()
+    '''
+    def __init__(self, stall_timeout: float = STALL_TIMEOUT, grace: float = STALL_GRACE,
+                 retry_budget: int = STALL_RETRY_BUDGET, interval: float = 5.0):
+        self.stall_timeout = stall_timeout
+        self.grace = grace
+        self.retry_budget = retry_budget
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.tasks = set()
+        self.retries = {}       # (stage, item_id) -> times requeued
+        self.stalled = []       # (stage, item_id) that ran out of retries
+        self.on_abandon = None  # callback(task) starting a replacement worker
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start_task(self, stage: str, item_id: str, item, queue, on_give_up=None) -> Task:
+        task = Task(stage, item_id, item, queue, on_give_up)
+        with self.lock:
+            self.tasks.add(task)
+        _current.task = task
+        return task
+
+    def finish_task(self, task: Task) -> bool:
+        '''
+        Return
+        ------
+        bool
+            True when the caller still owns the queue slot of the task (call queue.task_done()),
+            False when the watchdog has abandoned the task and released the slot itself
+        '''
+        _current.task = None
+        with self.lock:
+            self.tasks.discard(task)
+            if task.state == ABANDONED:
+                return False
+            task.state = DONE
+            return True
+
+    def retry_or_give_up(self, task: Task):
+        '''
+        Requeue a stalled item, or report it once its retry budget is spent
+        The item is put back before the slot is released so that queue.join() cannot return in between
+        '''
+        key = (task.stage, task.item_id)
+        with self.lock:
+            retries = self.retries.get(key, 0)
+            if retries < self.retry_budget:
+                self.retries[key] = retries + 1
+            else:
+                self.stalled.append(key)
+                retries = None
+
+        if retries is not None:
+            sys.stdout.write('\n')
+            print(f'[WATCHDOG]: {task.stage} task {task.item_id} stalled, requeued ({retries + 1}/{self.retry_budget})')
+            task.queue.put(task.item)
+        else:
+            sys.stdout.write('\n')
+            print(f'[WATCHDOG]: {task.stage} task {task.item_id} stalled {self.retry_budget + 1} times, giving up')
+            if task.on_give_up is not None:
+                task.on_give_up()
+
+    def scan(self):
+        '''
+        Cancel the tasks without progress for stall_timeout seconds, abandon the cancelled ones that did not stop
+        '''
+        now = time.time()
+        abandoned = []
+
+        with self.lock:
+            for task in list(self.tasks):
+                idle = now - task.last_progress
+
+                if not task.cancel.is_set():
+                    if idle > self.stall_timeout:
+                        task.cancel.set()
+                        task.cancelled_at = now
+                        sys.stdout.write('\n')
+                        print(f'[WATCHDOG]: {task.stage} task {task.item_id} idle for {idle:.0f}s, cancelling')
+
+                elif now - task.cancelled_at > self.grace:
+                    task.state = ABANDONED
+                    self.tasks.discard(task)
+                    abandoned.append(task)
+
+        for task in abandoned:
+            sys.stdout.write('\n')
+            print(f'[WATCHDOG]: {task.stage} task {task.item_id} did not stop, abandoning its worker')
+            self.retry_or_give_up(task)
+            task.queue.task_done()
+
+            if self.on_abandon is not None:
+                self.on_abandon(task)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.scan()
+            except Exception as e:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][Watchdog][scan]: {e}')
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def reset(self):
+        with self.lock:
+            self.tasks.clear()
+            self.retries.clear()
+            self.stalled = []
+
+    def report(self) -> list[tuple[str, str]]:
+        '''
+        Return
+        ------
+        list of tuple
+            (stage, ID) of every task that stalled more than retry_budget times
+        '''
+        with self.lock:
+            return list(self.stalled)
+
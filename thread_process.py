@@ -1,149 +1,306 @@
 from utils import display_progress
-from extract_data import extract_metadata, extract_reference
-from saving import save_one_tex, save_one_metadata, save_one_reference
+from extract_data import extract_metadata, refresh_metadata, extract_reference
+from saving import save_one_tex, get_output_path, load_metadata
+from group_writer import GroupWriter
+from validator_store import VALIDATOR_STORE
+from negative_cache import NEGATIVE_CACHE
+from corpus_index import update_index
+from citation_graph import CITATION_GRAPH
+from task_watchdog import Watchdog, is_stall_error
+from profiling import stage as profiling_stage
+from size_ledger import SizeLedger
 
-from config import NUM_DOWNLOAD_THREADS, NUM_EXTRACT_THREADS, NUM_SAVE_THREADS
+from config import NUM_DOWNLOAD_THREADS, NUM_EXTRACT_THREADS, NUM_REFERENCE_THREADS
 import threading
 from queue import Queue
-from concurrent.futures import ThreadPoolExecutor
 import sys
 
-q_extract = Queue()
-q_download = Queue()
-q_save = Queue()
+# Pipeline DAG: every paper is sent to three independent stages, only the outputs are joined
+#
+#   paper_dict -> q_download  -> downloading_worker  (tex sources)
+#              -> q_extract   -> extracting_worker   (metadata, local)  -> writer (GroupWriter)
+#              -> q_reference -> referencing_worker  (Semantic Scholar) -> writer (GroupWriter)
+#
+# The writer commits metadata.json / references.json in groups: temp files, one sync, atomic renames.
+#
+# Queues, counters and workers belong to a Pipeline object, so several pipelines can run side by side in one
+# process (e.g. one per month). Rate limits and HTTP connections are shared process-wide (network.py).
+PAPER_STAGES = ('sources', 'metadata', 'references')
+# Name of each stage in the profiling reports (see profiling.STAGE_FUNCTIONS)
+PROFILING_STAGES = {'sources': 'download', 'metadata': 'metadata', 'references': 'references'}
 
-progress_lock = threading.Lock()
-paper_size_update_lock = threading.Lock()
-completed = 0
-total = 0
-            
-def downloading_worker(paper_sizes):
-    while True:
-        paper_dict = q_download.get()
+# The caches, the citation graph and the corpus index are shared files: one pipeline persists them at a time
+persist_lock = threading.Lock()
+
+def download_paper(paper_dict):
+    return [save_one_tex(paper=paper_version, report_size=True) for paper_version in paper_dict['versions']]
+
+def extract_paper_metadata(item):
+    paper_id, versions, known = item
+    
+    try:
+        if known > 0:
+            # Refresh run: only the new versions were fetched, the saved metadata gets their revised dates
+            metadata = load_metadata(paper_id)
+            if metadata is not None:
+                return refresh_metadata(metadata, versions, known)
+        return extract_metadata(paper_id, versions)
+    except Exception as e:
+        sys.stdout.write('\n')
+        print(f'[EXCEPTION][extract_paper_metadata]: Cannot get metadata of {paper_id}: {type(e).__name__} - {e}')
+        return None
+
+def extract_paper_reference(paper_id):
+    meta_data_reference = extract_reference(paper_id)
+    
+    if meta_data_reference == {}:
+        sys.stdout.write('\n')
+        print(f'Cannot get refs of {paper_id}')
+        return None
+    
+    return meta_data_reference
+
+class Pipeline:
+    '''
+    A run of the download / metadata / references stages over a list of papers, with its own queues,
+    counters, worker threads and watchdog
+
+    Usage
+    -----
+    pipeline = Pipeline(stages=('sources', 'metadata'), name='2306')
+    paper_sizes = pipeline.run(paper_dict_list)
+    '''
+    def __init__(self, stages=PAPER_STAGES, name: str = 'papers', num_download_threads: int = NUM_DOWNLOAD_THREADS,
+                 num_extract_threads: int = NUM_EXTRACT_THREADS, num_reference_threads: int = NUM_REFERENCE_THREADS):
+        self.stages = [stage for stage in PAPER_STAGES if stage in stages]
+        self.name = name
         
-        if paper_dict is None:            
-            q_download.task_done()
-            break
+        self.q_extract = Queue()
+        self.q_download = Queue()
+        self.q_reference = Queue()
+        self.writer = None
         
+        self.num_workers = {
+            'sources': num_download_threads if 'sources' in self.stages else 0,
+            'metadata': num_extract_threads if 'metadata' in self.stages else 0,
+            'references': num_reference_threads if 'references' in self.stages else 0,
+        }
+        self.queues = {'sources': self.q_download, 'metadata': self.q_extract, 'references': self.q_reference}
+        self.workers = {'sources': self.downloading_worker, 'metadata': self.extracting_worker, 'references': self.referencing_worker}
         
-        try:
-            paper_id = paper_dict['id']
-            versions = paper_dict['versions']
-            
-            for paper_version in versions:
-                size = save_one_tex(paper=paper_version, report_size=True)
+        self.progress_lock = threading.Lock()
+        self.remaining_stages = {}
+        self.completed = 0
+        self.total = 0
+        self.paper_sizes = SizeLedger()
+        
+        self.watchdog = Watchdog()
+        self.watchdog.on_abandon = lambda task: self.start_worker(self.workers[task.stage])
+        self.running = False
+
+    def mark_stage_done(self, paper_id):
+        '''
+        Count a finished stage of a paper, the paper is completed once all its stages are done
+        '''
+        with self.progress_lock:
+            try:
+                self.remaining_stages[paper_id] -= 1
                 
-                with paper_size_update_lock:
-                    paper_sizes.append(size)
-            
-            q_extract.put((paper_id, versions))
-        except Exception as e:
-            sys.stdout.write('\n')
-            print(f'[EXCEPTION][downloading_worker]: {e}')
+                if self.remaining_stages[paper_id] == 0:
+                    del self.remaining_stages[paper_id]
+                    self.completed += 1
+                    display_progress(self.completed, self.total, f"Processing {self.name}")
+            except Exception as e:
+                sys.stdout.write('\n')
+                print(f'[EXCEPTION][progress_lock][mark_stage_done]: {e}')
+                
+    def run_worker(self, queue, stage, get_item_id, process, on_done, on_give_up):
+        '''
+        Worker loop shared by the stages calling the network, every task is watched by the pipeline's watchdog
+
+        Parameters
+        ----------
+        queue: Queue
+            queue of the stage, None stops the worker
+        stage: str
+            stage name reported by the watchdog
+        get_item_id: function
+            item -> paper ID
+        process: function
+            item -> result, the work of the stage (result is None when it failed)
+        on_done: function
+            (item, result) -> None, hands the result to the next stage
+        on_give_up: function
+            item -> None, called instead of on_done when the item stalled more than STALL_RETRY_BUDGET times
+        '''
+        while True:
+            item = queue.get()
             
-        finally:     
-            q_download.task_done()
-        
-def extracting_worker():
-    while True:
-        item = q_extract.get()
-        
-        if item is None:                
-            q_extract.task_done()
-            break
-        
-        paper_id, versions = item
-        
-        try:
-            meta_data_paper = extract_metadata(paper_id, versions)
+            if item is None:
+                queue.task_done()
+                break
             
-        except Exception as e:
-            meta_data_paper = None
-            sys.stdout.write('\n')
-            print(f'Cannot get metadata of {paper_id}')
-        
-        
-        try:
-            meta_data_reference = extract_reference(paper_id)
+            item_id = get_item_id(item)
+            task = self.watchdog.start_task(stage, item_id, item, queue, on_give_up=lambda item=item: on_give_up(item))
+            result = None
+            stalled = False
             
-            if meta_data_reference == {}:
-                meta_data_reference = None
-                sys.stdout.write('\n')
-                print(f'Cannot get refs of {paper_id}')
+            try:
+                with profiling_stage(PROFILING_STAGES[stage]):
+                    result = process(item)
                 
-        except Exception as e:
-            meta_data_reference = None
-            sys.stdout.write('\n')
-            print(f'Unexpected error during reference extraction for {paper_id}: {type(e).__name__} - {e}')
+            except Exception as e:
+                stalled = is_stall_error(e)
                 
-        q_save.put((paper_id, meta_data_paper, meta_data_reference))
-        q_extract.task_done()
+                if not stalled:
+                    sys.stdout.write('\n')
+                    print(f'[EXCEPTION][{stage}_worker]: {item_id}: {type(e).__name__} - {e}')
             
-def saving_worker():
-    global completed
-    while True:
-        item = q_save.get()
-        
-        if item is None:
+            if not self.watchdog.finish_task(task):
+                # Abandoned: the watchdog already requeued the item, released its slot and started a replacement worker
+                break
             
-            q_save.task_done()
-            break
-        
-        paper_id, meta_data_paper, meta_data_reference = item
-        
-        try:
-            if meta_data_paper is not None:
-                save_one_metadata(id=paper_id, metadata=meta_data_paper)
+            if stalled:
+                self.watchdog.retry_or_give_up(task)
+            else:
+                on_done(item, result)
                 
-            if meta_data_reference is not None:
-                save_one_reference(id=paper_id, reference=meta_data_reference)
-        except Exception as e:
-            sys.stdout.write('\n')
-            print(f'[EXCEPTION][saving_worker]: {e}')
-            
-        finally:
-            with progress_lock:
-                try:
-                    completed += 1
-                    display_progress(completed, total, "Processing papers")
-                except Exception as e:
-                    sys.stdout.write('\n')
-                    print(f'[EXCEPTION][progress_lock][saving_worker]: {e}')
+            queue.task_done()
 
-            q_save.task_done()
-    
+    def downloading_worker(self):
+        def on_done(paper_dict, sizes):
+            category = getattr(paper_dict['versions'][0], 'primary_category', '') if paper_dict['versions'] else ''
+            self.paper_sizes.extend(sizes, category)
+            self.mark_stage_done(paper_dict['id'])
             
-def execute_pipeline(paper_dict_list):
-    global total, completed
-    total = len(paper_dict_list)
-    completed = 0
-    paper_sizes = []
-    
-    for paper_dict in paper_dict_list:
-        q_download.put(paper_dict)
-        
-    with ThreadPoolExecutor(max_workers=NUM_DOWNLOAD_THREADS + NUM_EXTRACT_THREADS + NUM_SAVE_THREADS) as executor:
-        for _ in range(NUM_DOWNLOAD_THREADS):
-            executor.submit(downloading_worker, paper_sizes)
+        self.run_worker(self.q_download, 'sources', lambda paper_dict: paper_dict['id'], download_paper,
+                        on_done, lambda paper_dict: self.mark_stage_done(paper_dict['id']))
             
-        for _ in range(NUM_EXTRACT_THREADS):
-            executor.submit(extracting_worker)
+    def extracting_worker(self):
+        self.run_worker(self.q_extract, 'metadata', lambda item: item[0], extract_paper_metadata,
+                        lambda item, metadata: self.save_output('metadata', item[0], metadata),
+                        lambda item: self.mark_stage_done(item[0]))
             
-        for _ in range(NUM_SAVE_THREADS):
-            executor.submit(saving_worker)
+    def referencing_worker(self):
+        self.run_worker(self.q_reference, 'references', lambda paper_id: paper_id, extract_paper_reference,
+                        lambda paper_id, reference: self.save_output('references', paper_id, reference),
+                        lambda paper_id: self.mark_stage_done(paper_id))
+                
+    def save_output(self, kind, paper_id, data):
+        '''
+        Hand a metadata / references record to the writer, the stage of the paper is done once it is on disk
+        '''
+        if not data:
+            self.mark_stage_done(paper_id)
+            return
+
+        def on_written(error):
+            try:
+                if error is None and kind == 'references':
+                    CITATION_GRAPH.add_references(paper_id, data)
+            finally:
+                self.mark_stage_done(paper_id)
+
+        self.writer.put(get_output_path(paper_id, kind), data, on_written)
+
+    def start_worker(self, target):
+        # Daemon threads: a worker stuck in a call that cannot be interrupted must not keep the process alive
+        threading.Thread(target=target, name=f'{self.name}-{target.__name__}', daemon=True).start()
+
+    def run(self, paper_dict_list):
+        '''
+        Download, extract and save every paper, return once all of them went through every enabled stage
+
+        Parameters
+        ----------
+        paper_dict_list: list of dict
+            [{'id': 'xxxx.xxxxx', 'versions': list[arxiv.Result]}, ...], with 'known': k on refresh runs
+            (versions holds v{k + 1} to the latest only, see refresh.LocalVersions)
+
+        Return
+        ------
+        SizeLedger
+            sizes of every downloaded version (empty when 'sources' is disabled)
+        '''
+        if self.running:
+            raise RuntimeError(f'Pipeline {self.name} is already running')
+        self.running = True
+        
+        self.total = len(paper_dict_list)
+        self.completed = 0
+        self.paper_sizes = SizeLedger()
+        self.remaining_stages = {}
+        self.watchdog.reset()
+        
+        for paper_dict in paper_dict_list:
+            self.remaining_stages[paper_dict['id']] = len(self.stages)
             
+            if 'metadata' in self.stages:
+                self.q_extract.put((paper_dict['id'], paper_dict['versions'], paper_dict.get('known', 0)))
+            if 'references' in self.stages:
+                self.q_reference.put(paper_dict['id'])
+            if 'sources' in self.stages:
+                self.q_download.put(paper_dict)
             
+        self.watchdog.start()
+        self.writer = GroupWriter(name=self.name)
+        self.writer.start()
+        
+        for stage, count in self.num_workers.items():
+            for _ in range(count):
+                self.start_worker(self.workers[stage])
+        
+        # Stop the workers only once their queue is drained: a stalled item is requeued behind everything else
+        for stage in ('metadata', 'references', 'sources'):
+            queue = self.queues[stage]
+            queue.join()
             
-        for _ in range(NUM_DOWNLOAD_THREADS):
-            q_download.put(None)
-        q_download.join()        
+            for _ in range(self.num_workers[stage]):
+                queue.put(None)
+            queue.join()
         
-        for _ in range(NUM_EXTRACT_THREADS):
-            q_extract.put(None)
-        q_extract.join()
+        self.watchdog.stop()
         
-        for _ in range(NUM_SAVE_THREADS):
-            q_save.put(None)
-        q_save.join()
+        self.writer.stop()
         
-    return paper_sizes
\ No newline at end of file
+        stalled = self.watchdog.report()
+        if stalled:
+            sys.stdout.write('\n')
+            print(f'[WATCHDOG][{self.name}]: {len(stalled)} task(s) stalled and were given up: '
+                  + ', '.join(f'{paper_id} ({stage})' for stage, paper_id in stalled))
+            
+        with persist_lock:
+            VALIDATOR_STORE.save()
+            NEGATIVE_CACHE.save()
+            
+            if 'references' in self.stages:
+                CITATION_GRAPH.save()
+            
+            if 'metadata' in self.stages or 'references' in self.stages:
+                try:
+                    update_index([paper_dict['id'] for paper_dict in paper_dict_list])
+                except Exception as e:
+                    sys.stdout.write('\n')
+                    print(f'[EXCEPTION][Pipeline][update_index]: {e}')
+        
+        self.running = False
+        return self.paper_sizes
+
+
+def execute_pipeline(paper_dict_list, stages=PAPER_STAGES, name: str = 'papers'):
+    '''
+    A function to download, extract and save every paper (one Pipeline run)
+
+    Parameters
+    ----------
+    paper_dict_list: list of dict
+        [{'id': 'xxxx.xxxxx', 'versions': list[arxiv.Result]}, ...]
+    stages: iterable of str
+        enabled stages among 'sources', 'metadata' and 'references'; disabled stages get no queue items and no workers
+
+    Return
+    ------
+    SizeLedger
+        sizes of every downloaded version (empty when 'sources' is disabled)
+    '''
+    return Pipeline(stages, name=name).run(paper_dict_list)
@@ -1,8 +1,17 @@
+from __future__ import annotations   # arxiv.Result annotations are not evaluated: importing utils must not import arxiv
+
 import os
 import json
-import arxiv
-from collections import defaultdict
 import sys
+import threading
+from typing import TYPE_CHECKING
+
+from task_watchdog import run_with_timeout
+from config import API_CALL_TIMEOUT
+
+if TYPE_CHECKING:
+    import arxiv
+
 
 def save_paperlist_to_json(paper_list: list[arxiv.Result], save_path: str = "paperList.json"):
     """
@@ -116,6 +125,104 @@ def display_progress(current_value, total_value, display_text, length=50, end=Fa
         sys.stdout.write('\n')
 
 
+def split_version_id(version_id:str) -> tuple[str, int | None]:
+    '''
+    A function to split a version's ID into its base ID and version number
+
+    Parameter
+    ---------
+    version_id: str
+        version's ID (format: 'xxxx.xxxxxvx'), or a base ID without version
+
+    Return
+    ------
+    tuple of (str, int or None)
+        ('xxxx.xxxxx', x) or (version_id, None) when there is no version suffix
+    '''
+    base_id, sep, version = version_id.rpartition('v')
+
+    if not sep or not base_id or not version.isdigit():
+        return version_id, None
+    return base_id, int(version)
+
+
+class VersionGrouper:
+    '''
+    Incremental grouping of paper versions by base ID
+
+    Versions can be added in any order as they arrive from either crawl phase. The latest version of a paper
+    tells how many versions to expect (its 'vN'), and the paper is emitted as soon as all of them have arrived,
+    so no global sort or full-list regroup is needed. Papers still missing versions are returned by flush().
+
+    Example
+    -------
+    grouper = VersionGrouper()
+    grouper.add(latest_v2, is_latest=True)  # None, waiting for v1
+    grouper.add(v1)                         # {'id': '2306.14505', 'versions': [v1, latest_v2]}
+    '''
+    def __init__(self, get_version_id=None):
+        self.get_version_id = get_version_id or (lambda paper: get_id_from_arxiv_link(paper.entry_id, True))
+        self.pending = {}
+        self.expected = {}
+        self.emitted = set()
+        self.lock = threading.Lock()
+
+    def add(self, item, is_latest:bool=False, first_version:int=1) -> dict | None:
+        '''
+        Add one version
+
+        Parameters
+        ----------
+        item: any
+            a version (arxiv.Result by default)
+        is_latest: bool
+            whether this is the latest version of its paper, which sets the expected number of versions
+        first_version: int
+            first version expected with the latest one (refresh runs only group the versions newer than the disk)
+
+        Return
+        ------
+        dict or None
+            {'id': base_id, 'versions': [...]} (sorted by version) once the paper is complete, otherwise None
+        '''
+        base_id, version = split_version_id(self.get_version_id(item))
+
+        with self.lock:
+            if base_id in self.emitted:
+                return None
+
+            versions = self.pending.setdefault(base_id, {})
+            versions[version or 0] = item
+
+            if is_latest and version is not None:
+                self.expected[base_id] = version - first_version + 1
+
+            expected = self.expected.get(base_id)
+            if expected is None or len(versions) < expected:
+                return None
+
+            del self.pending[base_id]
+            del self.expected[base_id]
+            self.emitted.add(base_id)
+
+        return {'id': base_id, 'versions': [versions[key] for key in sorted(versions)]}
+
+    def flush(self) -> list[dict]:
+        '''
+        Emit every paper that is still incomplete (some versions could not be fetched) or has no expected count
+        '''
+        with self.lock:
+            result = [
+                {'id': base_id, 'versions': [versions[key] for key in sorted(versions)]}
+                for base_id, versions in self.pending.items()
+            ]
+            self.emitted.update(self.pending)
+            self.pending.clear()
+            self.expected.clear()
+
+        return result
+
+
 def convert_paper_list_to_dictionary(paper_list:list[arxiv.Result])->list[dict]:
     '''
     A function to group papers'id 
@@ -141,49 +248,25 @@ def convert_paper_list_to_dictionary(paper_list:list[arxiv.Result])->list[dict]:
             }
         ]
     '''
-    
-    paper_dict = defaultdict(list)
+    grouper = VersionGrouper()
     
     for paper in paper_list:
-        paper_id = get_id_from_arxiv_link(paper.entry_id, False)
-        paper_dict[paper_id].append(paper)
+        grouper.add(paper)
         
-    format_paper_dict = [{'id': paper_id, 'versions': versions} for paper_id, versions in paper_dict.items()]
-        
-    return format_paper_dict
-
-
-def group_by_base_id_list(data_list):
-    """
-    Groups papers by their base ID (removing 'vX' version suffix) 
-    and returns the result as a list of dictionaries.
-    """
-    paper_dict = defaultdict(list)
-    
-    try:
-        for item in data_list:
-            if item is not None and 'id' in item:
-                base_id = get_id_from_arxiv_link(item['id'], with_version=False)
-                paper_dict[base_id].append(item)
-            
-        result_list = [
-            {
-                "id": base_id,
-                "versions": versions_list
-            }
-            for base_id, versions_list in paper_dict.items()
-        ]
-        return result_list
-    
-    except:
-        return []
+    return grouper.flush()
 
 
 def is_id_existed(paper_id):
+    import arxiv
+    from network import share_session
+    from scraper import count_request
+
     search = arxiv.Search(id_list=[paper_id])
-    client = arxiv.Client(page_size=1, delay_seconds=0.2)
+    client = share_session(arxiv.Client(page_size=1, delay_seconds=0.2))
+    # The bisection of find_first_id / find_last_id is part of the ID enumeration's traffic (see benchmark.py)
+    count_request('id_probe')
     try:
-        next(client.results(search))
+        run_with_timeout(next, API_CALL_TIMEOUT, client.results(search))
         return True
     except StopIteration:
         return False
@@ -247,17 +330,3 @@ def convert_second_to_format(value:float):
     second = value % 60
     
     return f'{minute}m {second}s'
-
-def calc_mean_paper_size(paper_sizes: list):
-    before = []
-    after = []
-    count_paper = 0
-    for ps in paper_sizes:
-        if ps is not None:
-            count_paper += 1
-            before.append(ps['size']['before'])
-            after.append(ps['size']['after'])
-    
-    avg_size_before = round(sum(before)/(count_paper * 1024), 3)
-    avg_size_after = round(sum(after)/(count_paper * 1024), 3)
-    return avg_size_before, avg_size_after
\ No newline at end of file
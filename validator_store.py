@@ -0,0 +1,68 @@
+from config import VALIDATOR_STORE_PATH
+from json_store import JsonStore
+
+
+class ValidatorStore(JsonStore):
+    '''
+    A persistent store of HTTP validators (ETag, Last-Modified, size) for each e-print version
+
+    A version's source never changes once published, so the recorded validators let a refresh run
+    send conditional requests and the recorded sizes let it report skipped versions without downloading them.
+
+    Example record:
+        {
+            '2306-14505v2': {
+                'etag': '"abc"',
+                'last_modified': 'Tue, 27 Jun 2023 00:55:41 GMT',
+                'content_length': 1523000,
+                'kind': 'source',
+                'size': {'before': 4210000, 'after': 83000}
+            }
+        }
+    '''
+    def __init__(self, path: str = VALIDATOR_STORE_PATH, autosave_every: int = 50):
+        super().__init__(path, autosave_every)
+
+    def get(self, version_id: str) -> dict | None:
+        with self.lock:
+            record = self.records.get(version_id)
+            return dict(record) if record is not None else None
+
+    def update(self, version_id: str, **fields):
+        '''
+        Merge fields into the record of a version and persist the store every `autosave_every` updates
+        '''
+        with self.lock:
+            self.records.setdefault(version_id, {}).update(fields)
+        self.updated()
+
+    def conditional_headers(self, version_id: str) -> dict:
+        '''
+        A function to build conditional request headers for a version
+
+        Validators are only sent for versions that left nothing on disk (PDF-only sources or sources made
+        only of figures): a 304 for a version whose extracted output is missing would lose its data.
+
+        Return
+        ------
+        dict
+            'If-None-Match' / 'If-Modified-Since' headers, or an empty dict when the request must be unconditional
+        '''
+        record = self.get(version_id)
+
+        if record is None:
+            return {}
+
+        retained = record.get('size', {}).get('after', 0)
+        if record.get('kind') != 'pdf' and retained != 0:
+            return {}
+
+        headers = {}
+        if record.get('etag'):
+            headers['If-None-Match'] = record['etag']
+        if record.get('last_modified'):
+            headers['If-Modified-Since'] = record['last_modified']
+        return headers
+
+
+VALIDATOR_STORE = ValidatorStore()